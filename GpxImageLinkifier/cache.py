@@ -0,0 +1,313 @@
+from array import array
+import datetime
+import calendar
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+
+import pytz
+
+from GpxImageLinkifier.index import load_numpy
+
+NAIVE_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def stat_key(path):
+    """Returns the (size, mtime in nanoseconds) pair cached entries are
+    validated against."""
+    stat = os.stat(path)
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 1000000000)
+    return stat.st_size, mtime_ns
+
+
+class TimestampCache():
+    """An on-disk cache of image timestamps (naive, or UTC for files that
+    record their timezone) in a SQLite file under cache_dir, keyed by
+    absolute path and validated against the file's size and mtime. Once it
+    holds more than max_entries images, the least recently used are evicted
+    when it is flushed. The cache file of earlier versions is migrated, and
+    deleted, when it is opened. hits and misses count lookups since it was
+    opened."""
+
+    file_name = 'timestamps2.sqlite'
+    # the cache file of earlier versions, without the utc column: its
+    # timestamps are all naive
+    old_file_name = 'timestamps.sqlite'
+
+    def __init__(self, cache_dir, max_entries=1000000):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.path = os.path.join(cache_dir, self.file_name)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.used = int(time.time())
+        self.pending = []
+        self.pending_hits = []
+
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS timestamps (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            timestamp INTEGER,
+            utc INTEGER,
+            used INTEGER)''')
+        self.connection.execute('''CREATE INDEX IF NOT EXISTS timestamps_used
+            ON timestamps (used)''')
+        self.connection.commit()
+        self.migrate(os.path.join(cache_dir, self.old_file_name))
+
+    def migrate(self, path):
+        """Copies the entries of the cache file of earlier versions at path
+        into this one, then deletes it."""
+        if not os.path.isfile(path):
+            return
+
+        try:
+            self.connection.execute('ATTACH DATABASE ? AS old', (path,))
+            try:
+                self.connection.execute('''INSERT OR IGNORE INTO timestamps
+                    SELECT path, size, mtime_ns, timestamp, 0, used
+                    FROM old.timestamps''')
+                self.connection.commit()
+            finally:
+                self.connection.rollback()
+                self.connection.execute('DETACH DATABASE old')
+        except sqlite3.Error:
+            # it is only a cache: entries that can't be copied are read again
+            pass
+
+        try:
+            os.remove(path)
+        except OSError:
+            # another process migrated it first
+            pass
+
+    def get(self, path):
+        """Returns (timestamp, key) for the image at path. timestamp is None
+        when the image is not cached or has changed since; pass key on to
+        set() once it has been read."""
+        path = os.path.abspath(path)
+        key = (path,) + stat_key(path)
+        row = self.connection.execute(
+            '''SELECT size, mtime_ns, timestamp, utc FROM timestamps
+            WHERE path = ?''', (path,)).fetchone()
+
+        if row is None or tuple(row[:2]) != key[1:]:
+            self.misses += 1
+            return None, key
+
+        self.hits += 1
+        self.pending_hits.append(path)
+        timestamp = NAIVE_EPOCH + datetime.timedelta(seconds=row[2])
+        if row[3]:
+            timestamp = pytz.utc.localize(timestamp)
+        return timestamp, key
+
+    def set(self, key, timestamp):
+        """Caches the timestamp of an image, by the key get() returned for
+        it. Images without one are read again next time."""
+        if timestamp is None:
+            return
+
+        utc = timestamp.tzinfo is not None
+        if utc:
+            timestamp = timestamp.astimezone(pytz.utc)
+        self.pending.append(
+            key + (calendar.timegm(timestamp.timetuple()), int(utc),
+                   self.used))
+
+        if len(self.pending) >= 1000:
+            self.flush()
+
+    def flush(self):
+        """Writes pending entries and evicts the least recently used ones
+        over max_entries."""
+        connection = self.connection
+        connection.executemany(
+            'INSERT OR REPLACE INTO timestamps VALUES (?, ?, ?, ?, ?, ?)',
+            self.pending)
+        connection.executemany(
+            'UPDATE timestamps SET used = ? WHERE path = ?',
+            [(self.used, path) for path in self.pending_hits])
+        self.pending = []
+        self.pending_hits = []
+
+        count = connection.execute(
+            'SELECT COUNT(*) FROM timestamps').fetchone()[0]
+        if count > self.max_entries:
+            connection.execute(
+                '''DELETE FROM timestamps WHERE path IN (
+                SELECT path FROM timestamps ORDER BY used LIMIT ?)''',
+                (count - self.max_entries,))
+
+        connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class GpxIndexCache():
+    """Compiled GPX indexes under cache_dir/gpx. Each holds the runs (track
+    segments and waypoints) of one GPX file: the run lengths, whether each run
+    is a track segment, then the sorted time, latitude, longitude and
+    elevation columns of every run as native doubles. Files are named by the
+    SHA-1 of the GPX file's content and the GPX timezone the index was built
+    with. Indexes are memory-mapped when loaded, so processes using the same
+    track share its pages.
+
+    A small reference file per GPX path remembers the content hash for the
+    file's size and mtime, so an unchanged file is not hashed again. hits and
+    misses count loads since it was created."""
+
+    magic = b'GILIDX3' + (sys.byteorder == 'little' and b'l' or b'b')
+    header = struct.Struct('=8sQQ')
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.join(cache_dir, 'gpx')
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+    def content_hash(self, path):
+        """Returns the SHA-1 of the file at path, reusing the one remembered
+        for its size and mtime if there is one."""
+        path = os.path.abspath(path)
+        key = '%d %d' % stat_key(path)
+        reference = os.path.join(
+            self.cache_dir,
+            hashlib.sha1(path.encode('utf-8')).hexdigest() + '.ref')
+
+        try:
+            with open(reference) as f:
+                remembered_key, content_hash = f.read().rsplit(' ', 1)
+            if remembered_key == key:
+                return content_hash
+        except (IOError, OSError, ValueError):
+            pass
+
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(chunk)
+        content_hash = sha1.hexdigest()
+
+        self.write_atomic(reference, ('%s %s' % (key, content_hash)).encode())
+        return content_hash
+
+    def index_path(self, path, tz_name):
+        return os.path.join(self.cache_dir, '%s-%s.idx' % (
+            self.content_hash(path), tz_name.replace('/', '_')))
+
+    def load(self, path, tz_name):
+        """Returns the runs of the GPX file at path as a list of
+        (columns, track) pairs, columns being memory-mapped (times, latitudes,
+        longitudes, elevations) and track False for waypoints. Returns None if
+        the file has no compiled index yet, or only an empty or truncated
+        one."""
+        try:
+            f = open(self.index_path(path, tz_name), 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+
+        with f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # empty, like after a crash mid-write: it is rebuilt
+                self.misses += 1
+                return None
+
+        try:
+            magic, run_count, count = self.header.unpack_from(mapped)
+            lengths = struct.unpack_from('=%dQ' % run_count, mapped,
+                                         self.header.size)
+            tracks = struct.unpack_from('=%dQ' % run_count, mapped,
+                                        self.header.size + 8 * run_count)
+        except struct.error:
+            self.misses += 1
+            return None
+
+        offset = self.header.size + 16 * run_count
+        if magic != self.magic or sum(lengths) != count or\
+                len(mapped) != offset + 32 * count:
+            self.misses += 1
+            return None
+
+        columns = map_columns(mapped, offset, count)
+        runs = []
+        start = 0
+        for length, track in zip(lengths, tracks):
+            runs.append(([column[start:start + length] for column in columns],
+                         bool(track)))
+            start += length
+
+        self.hits += 1
+        return runs
+
+    def save(self, path, tz_name, runs):
+        """Compiles the runs of the GPX file at path, given as (columns,
+        track) pairs of sorted (times, latitudes, longitudes, elevations)
+        columns."""
+        lengths = [len(columns[0]) for columns, track in runs]
+        data = [self.header.pack(self.magic, len(runs), sum(lengths)),
+                struct.pack('=%dQ' % len(runs), *lengths),
+                struct.pack('=%dQ' % len(runs),
+                            *[int(track) for columns, track in runs])]
+        for i in range(4):
+            data.extend(column_bytes(columns[i]) for columns, track in runs)
+        self.write_atomic(self.index_path(path, tz_name), b''.join(data))
+
+    def write_atomic(self, path, data):
+        """Writes data to a temporary file next to path and renames it into
+        place, so concurrent readers never see a partial file."""
+        handle, temp_path = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+
+def column_bytes(column):
+    if not isinstance(column, array):
+        column = array('d', column)
+    if hasattr(column, 'tobytes'):
+        return column.tobytes()
+    return column.tostring()
+
+
+def map_columns(mapped, offset, count):
+    """Returns count-long columns of doubles laid out one after the other in
+    mapped from offset. The columns share mapped's memory with numpy or
+    Python 3 memoryviews; otherwise they are copied into arrays."""
+    numpy = load_numpy()
+    if numpy is not None:
+        return [numpy.frombuffer(mapped, numpy.float64, count,
+                                 offset + 8 * count * i) for i in range(4)]
+
+    try:
+        view = memoryview(mapped)[offset:].cast('d')
+        return [view[count * i:count * (i + 1)] for i in range(4)]
+    except (AttributeError, TypeError):
+        columns = []
+        for i in range(4):
+            column = array('d')
+            start = offset + 8 * count * i
+            column.fromstring(mapped[start:start + 8 * count])
+            columns.append(column)
+        return columns
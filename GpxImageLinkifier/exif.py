@@ -0,0 +1,433 @@
+import datetime
+# Python 2 imports _strptime on the first strptime call, which fails when
+# that first call is on several threads at once; import it up front.
+import _strptime  # noqa
+import os
+import shutil
+import struct
+import tempfile
+
+import pytz
+
+# tags
+DATETIME = 0x0132
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+DATETIME_ORIGINAL = 0x9003
+
+# GPS IFD tags
+GPS_VERSION_ID = 0x0000
+GPS_LATITUDE_REF = 0x0001
+GPS_LATITUDE = 0x0002
+GPS_LONGITUDE_REF = 0x0003
+GPS_LONGITUDE = 0x0004
+GPS_ALTITUDE_REF = 0x0005
+GPS_ALTITUDE = 0x0006
+GPS_TIMESTAMP = 0x0007
+GPS_DATESTAMP = 0x001d
+
+# TIFF field types, and their sizes in bytes
+BYTE, ASCII, SHORT, LONG, RATIONAL = 1, 2, 3, 4, 5
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8,
+              11: 4, 12: 8}
+
+# denominators of the rationals GPS values are written as: seconds of arc to
+# 1/10000 (3mm), altitudes to the millimetre.
+SECONDS_DENOMINATOR = 10000
+ALTITUDE_DENOMINATOR = 1000
+
+# the IFDs of a typical camera JPEG fit in the first few KB of its APP1
+# segment. Anything further away is read with an extra seek.
+CHUNK_SIZE = 4096
+
+EXIF_DATETIME_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+# TIFF headers by byte order, including the variants of Olympus ORF and
+# Panasonic RW2 RAW files
+TIFF_BYTE_ORDERS = {
+    b'II*\x00': '<',
+    b'MM\x00*': '>',
+    b'IIRO': '<',
+    b'IIRS': '<',
+    b'MMOR': '>',
+    b'IIU\x00': '<',
+}
+
+
+class CountingFile():
+    """Wraps a file object to count the bytes read from it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def read(self, size):
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+
+class HeaderReader():
+    """Reads byte ranges of a file through a buffer of the first CHUNK_SIZE
+    bytes at base, seeking only for ranges outside of it. bytes_read counts
+    everything read from the file."""
+
+    def __init__(self, f, base=0):
+        self.f = f
+        self.base = base
+        self.bytes_read = 0
+        f.seek(base)
+        self.buffer = self.read(CHUNK_SIZE)
+
+    def read(self, size):
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def read_at(self, offset, size):
+        """Returns size bytes at offset (relative to base), or fewer at the
+        end of the file."""
+        if offset + size <= len(self.buffer):
+            return self.buffer[offset:offset + size]
+        self.f.seek(self.base + offset)
+        return self.read(size)
+
+
+def read_tiff_datetime(reader, tags=(DATETIME, DATETIME_ORIGINAL)):
+    """Reads the first of tags found in a TIFF structure (IFD0, then the EXIF
+    IFD) starting at reader.base. Returns a naive datetime or None."""
+    header = reader.read_at(0, 8)
+    order = tiff_byte_order(header)
+    if order is None:
+        return None
+
+    values = {}
+
+    def read_ifd(offset):
+        """Collects wanted ASCII values and the EXIF IFD pointer of one
+        IFD."""
+        count_data = reader.read_at(offset, 2)
+        if len(count_data) < 2:
+            return
+        count = struct.unpack(order + 'H', count_data)[0]
+        entries = reader.read_at(offset + 2, count * 12)
+
+        for i in range(len(entries) // 12):
+            tag, kind, length, value = struct.unpack(
+                order + 'HHI4s', entries[i * 12:i * 12 + 12])
+
+            if tag in tags and kind == 2:
+                if length > 4:
+                    value = reader.read_at(
+                        struct.unpack(order + 'I', value)[0], length)
+                values[tag] = value[:length]
+            elif tag == EXIF_IFD:
+                values[EXIF_IFD] = struct.unpack(order + 'I', value)[0]
+
+    read_ifd(struct.unpack(order + 'I', header[4:8])[0])
+
+    if EXIF_IFD in values and not all(tag in values for tag in tags):
+        read_ifd(values[EXIF_IFD])
+
+    for tag in tags:
+        if tag in values:
+            text = values[tag].split(b'\x00')[0].decode('ascii', 'replace')
+            try:
+                return datetime.datetime.strptime(text.strip(),
+                                                  EXIF_DATETIME_FORMAT)
+            except ValueError:
+                pass
+
+    return None
+
+
+def read_jpeg_datetime(f):
+    """Reads the EXIF DateTime (or DateTimeOriginal) of the JPEG file object
+    f by walking its segment headers to the APP1 Exif segment. No image data
+    is read. Returns a naive datetime, or None if the file is not a JPEG or
+    has no usable timestamp."""
+    if f.read(2) != b'\xff\xd8':
+        return None
+
+    while True:
+        segment = f.read(4)
+        if len(segment) < 4 or segment[0:1] != b'\xff':
+            return None
+
+        marker = segment[1:2]
+        length = struct.unpack('>H', segment[2:4])[0]
+
+        if marker in (b'\xda', b'\xd9'):
+            # start of scan or end of image: the headers are over.
+            return None
+
+        payload = f.tell()
+        if marker == b'\xe1' and f.read(6) == b'Exif\x00\x00':
+            return read_tiff_datetime(HeaderReader(f, payload + 6))
+
+        # the segment length includes its own two bytes
+        f.seek(payload + length - 2)
+
+
+def read_exif_datetime(path, counts=None):
+    """Reads the EXIF timestamp of the JPEG at path. Returns a naive datetime
+    or None. If a counts dict is given, the bytes read from the file are
+    added to its 'bytes_read'."""
+    f = open(path, 'rb')
+    try:
+        if counts is None:
+            return read_jpeg_datetime(f)
+
+        counting_file = CountingFile(f)
+        try:
+            return read_jpeg_datetime(counting_file)
+        finally:
+            counts['bytes_read'] = counts.get('bytes_read', 0) +\
+                counting_file.bytes_read
+    finally:
+        f.close()
+
+
+def tiff_byte_order(tiff):
+    """Returns the struct byte order of a TIFF header, or None."""
+    return TIFF_BYTE_ORDERS.get(tiff[:4])
+
+
+def read_ifd_entries(tiff, order, offset):
+    """Returns ({tag: packed 12 byte entry}, next IFD offset) of the IFD at
+    offset in tiff."""
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    start = offset + 2
+    entries = dict((struct.unpack(order + 'H', tiff[i:i + 2])[0],
+                    tiff[i:i + 12])
+                   for i in range(start, start + 12 * count, 12))
+    next_offset = struct.unpack(
+        order + 'I', tiff[start + 12 * count:start + 12 * count + 4])[0]
+    return entries, next_offset
+
+
+def ifd_end(tiff, order, offset):
+    """Returns where the IFD at offset in tiff, and the values it points to,
+    end."""
+    entries, next_offset = read_ifd_entries(tiff, order, offset)
+    end = offset + 6 + 12 * len(entries)
+    for entry in entries.values():
+        tag, kind, count = struct.unpack(order + 'HHI', entry[:8])
+        size = TYPE_SIZES.get(kind, 1) * count
+        if size > 4:
+            value_offset = struct.unpack(order + 'I', entry[8:12])[0]
+            end = max(end, value_offset + size + size % 2)
+    return end
+
+
+def pack_ifd(order, offset, entries, next_offset=0):
+    """Packs an IFD that will be at offset in a TIFF structure, followed by
+    its values that don't fit in an entry. entries maps tags to a packed 12
+    byte entry, copied as is, or to (type, count, packed value)."""
+    data_offset = offset + 6 + 12 * len(entries)
+    packed_entries = []
+    values = []
+
+    for tag in sorted(entries):
+        entry = entries[tag]
+        if not isinstance(entry, tuple):
+            packed_entries.append(entry)
+            continue
+
+        kind, count, value = entry
+        if len(value) <= 4:
+            field = value + b'\x00' * (4 - len(value))
+        else:
+            # values start on word boundaries
+            value += b'\x00' * (len(value) % 2)
+            field = struct.pack(order + 'I', data_offset)
+            data_offset += len(value)
+            values.append(value)
+        packed_entries.append(struct.pack(order + 'HHI', tag, kind, count) +
+                              field)
+
+    return struct.pack(order + 'H', len(entries)) + b''.join(packed_entries) +\
+        struct.pack(order + 'I', next_offset) + b''.join(values)
+
+
+def gps_entries(order, latitude, longitude, elevation=None, time=None):
+    """Returns the GPS IFD entries of a location, for pack_ifd. elevation is
+    in metres; the GPS time and date are only written for a timezone-aware
+    time."""
+    def rationals(*values):
+        return struct.pack(order + '%dI' % (2 * len(values)),
+                           *[part for value in values for part in value])
+
+    def degrees(value):
+        seconds = int(round(abs(value) * 3600 * SECONDS_DENOMINATOR))
+        minutes, seconds = divmod(seconds, 60 * SECONDS_DENOMINATOR)
+        degrees, minutes = divmod(minutes, 60)
+        return (RATIONAL, 3, rationals((degrees, 1), (minutes, 1),
+                                       (seconds, SECONDS_DENOMINATOR)))
+
+    entries = {
+        GPS_VERSION_ID: (BYTE, 4, b'\x02\x03\x00\x00'),
+        GPS_LATITUDE_REF: (ASCII, 2, b'N\x00' if latitude >= 0 else b'S\x00'),
+        GPS_LATITUDE: degrees(latitude),
+        GPS_LONGITUDE_REF: (ASCII, 2,
+                            b'E\x00' if longitude >= 0 else b'W\x00'),
+        GPS_LONGITUDE: degrees(longitude),
+    }
+
+    if elevation is not None and elevation == elevation:
+        entries[GPS_ALTITUDE_REF] = (BYTE, 1, b'\x00' if elevation >= 0
+                                     else b'\x01')
+        entries[GPS_ALTITUDE] = (RATIONAL, 1, rationals(
+            (int(round(abs(elevation) * ALTITUDE_DENOMINATOR)),
+             ALTITUDE_DENOMINATOR)))
+
+    if time is not None and time.tzinfo is not None:
+        time = time.astimezone(pytz.utc)
+        entries[GPS_TIMESTAMP] = (RATIONAL, 3, rationals(
+            (time.hour, 1), (time.minute, 1), (time.second, 1)))
+        entries[GPS_DATESTAMP] = (ASCII, 11, time.strftime(
+            '%Y:%m:%d').encode('ascii') + b'\x00')
+
+    return entries
+
+
+def appended_gps(tiff, order, ifd0_offset, entries, next_offset):
+    """Returns True if IFD0 and its GPS IFD are laid out the way
+    add_tiff_gps appends them: the GPS IFD right after IFD0, both at the end
+    of tiff, and nothing else after IFD0."""
+    gps_offset = struct.unpack(order + 'I', entries[GPS_IFD][8:12])[0]
+    if gps_offset != ifd0_offset + 6 + 12 * len(entries) or\
+            ifd_end(tiff, order, gps_offset) != len(tiff) or\
+            next_offset >= ifd0_offset:
+        return False
+
+    for tag, entry in entries.items():
+        kind, count = struct.unpack(order + 'HI', entry[2:8])
+        if tag == EXIF_IFD or TYPE_SIZES.get(kind, 1) * count > 4:
+            if tag != GPS_IFD and\
+                    struct.unpack(order + 'I', entry[8:12])[0] >= ifd0_offset:
+                return False
+
+    return True
+
+
+def add_tiff_gps(tiff, latitude, longitude, elevation=None, time=None):
+    """Returns the TIFF structure tiff (bytes from its header on) with a GPS
+    IFD for the location. Nothing in tiff moves: a copy of IFD0 that points
+    to the new GPS IFD is appended with it, and the header points to the
+    copy, so offsets into the old data (from maker notes, say) stay valid.
+    What an earlier call appended is replaced rather than added to. Raises
+    ValueError if tiff is not a TIFF structure."""
+    order = tiff_byte_order(tiff)
+    if order is None:
+        raise ValueError('Not a TIFF structure')
+
+    ifd0_offset = struct.unpack(order + 'I', tiff[4:8])[0]
+    entries, next_offset = read_ifd_entries(tiff, order, ifd0_offset)
+
+    if GPS_IFD in entries and appended_gps(tiff, order, ifd0_offset,
+                                           entries, next_offset):
+        tiff = tiff[:ifd0_offset]
+
+    tiff += b'\x00' * (len(tiff) % 2)
+    ifd0_offset = len(tiff)
+    gps_offset = ifd0_offset + 6 + 12 * len(set(entries) | set([GPS_IFD]))
+    entries[GPS_IFD] = (LONG, 1, struct.pack(order + 'I', gps_offset))
+
+    return tiff[:4] + struct.pack(order + 'I', ifd0_offset) + tiff[8:] +\
+        pack_ifd(order, ifd0_offset, entries, next_offset) +\
+        pack_ifd(order, gps_offset, gps_entries(order, latitude, longitude,
+                                                elevation, time))
+
+
+def write_jpeg_gps(path, latitude, longitude, elevation=None, time=None):
+    """Writes a GPS IFD for the location into the EXIF data of the JPEG at
+    path (see add_tiff_gps). Only the APP1 Exif segment is rebuilt, or added
+    if there is none; every other byte, including the compressed image data,
+    is copied as is. The file is replaced by renaming a complete copy over
+    it, unless the segment already holds exactly what would be written: then
+    the file, and its mtime, are left alone. Returns True if the file was
+    written. Raises ValueError if path is not a JPEG or its EXIF data would
+    not fit in a segment."""
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            raise ValueError('Not a JPEG')
+
+        # insert an APP1 Exif segment after SOI, or after an APP0 (JFIF)
+        # segment that directly follows it, unless there is one already.
+        start = end = 2
+        tiff = existing = None
+        while True:
+            segment = f.read(4)
+            if len(segment) < 4 or segment[0:1] != b'\xff':
+                raise ValueError('Bad JPEG segment')
+
+            marker = segment[1:2]
+            if marker in (b'\xda', b'\xd9'):
+                break
+
+            payload = f.tell()
+            length = struct.unpack('>H', segment[2:4])[0]
+            if marker == b'\xe1':
+                data = f.read(length - 2)
+                if data[:6] == b'Exif\x00\x00':
+                    start, end = payload - 4, payload + length - 2
+                    tiff = data[6:]
+                    existing = data
+                    break
+            elif marker == b'\xe0' and payload == 6:
+                start = end = payload + length - 2
+
+            f.seek(payload + length - 2)
+
+        if tiff is None:
+            # an empty IFD0
+            tiff = b'MM\x00*' + struct.pack('>IHI', 8, 0, 0)
+
+        data = b'Exif\x00\x00' + add_tiff_gps(tiff, latitude, longitude,
+                                               elevation, time)
+        if len(data) + 2 > 0xffff:
+            raise ValueError('EXIF data too large for a JPEG segment')
+        if data == existing:
+            return False
+
+        folder, name = os.path.split(os.path.abspath(path))
+        fd, temporary_path = tempfile.mkstemp(prefix='.' + name + '.',
+                                              dir=folder)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                f.seek(0)
+                out.write(f.read(start))
+                out.write(b'\xff\xe1' + struct.pack('>H', len(data) + 2))
+                out.write(data)
+                f.seek(end)
+                shutil.copyfileobj(f, out, 1 << 20)
+                out.flush()
+                os.fsync(out.fileno())
+
+            shutil.copymode(path, temporary_path)
+            replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    return True
+
+
+def replace(source, destination):
+    """Renames source over destination, atomically where the OS can."""
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    elif os.name == 'nt':
+        # Python 2 can't rename over a file on Windows
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+    else:
+        os.rename(source, destination)
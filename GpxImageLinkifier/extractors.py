@@ -0,0 +1,330 @@
+import datetime
+import io
+import os
+import re
+import struct
+
+import pytz
+
+from GpxImageLinkifier.exif import CountingFile, HeaderReader,\
+    read_jpeg_datetime, read_tiff_datetime
+
+# extractors by lowercase file extension, and (offset, magic bytes, extractor)
+# in the order they are tried. Files are recognised by their magic bytes
+# first, so a misnamed file is still read by the right extractor.
+by_extension = {}
+by_magic = []
+
+# how many bytes of a file are compared against magic bytes
+HEADER_SIZE = 16
+
+MP4_EPOCH = pytz.utc.localize(datetime.datetime(1904, 1, 1))
+
+# Canon's CR3 metadata box, which holds TIFF structures like a CR2's
+CANON_UUID = b'\x85\xc0\xb6\x87\x82\x0f\x11\xe0\x81\x11\xf4\xce\x46\x2b\x6a\x48'
+
+# sidecars are small, and their dates are near the top
+XMP_READ_SIZE = 1 << 20
+XMP_DATE_EXPRESSIONS = [re.compile(
+    name + br'\s*(?:=\s*["\']|>)\s*'
+    br'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?'
+    br'(Z|[+-]\d\d:\d\d)?')
+    for name in (br'exif:DateTimeOriginal', br'xmp:CreateDate',
+                 br'photoshop:DateCreated')]
+
+
+def register(extensions, magic=()):
+    """Registers the decorated function as the timestamp extractor of files
+    with extensions (lowercase, with the dot) or that start with any of
+    magic, a list of (offset, bytes) pairs. An extractor is called with the
+    file open in binary mode at offset 0 and returns its capture time
+    without reading pixel data: a naive datetime in camera time, a
+    timezone-aware one if the file records its timezone, or None."""
+    def decorator(extractor):
+        for extension in extensions:
+            by_extension[extension] = extractor
+        for offset, data in magic:
+            by_magic.append((offset, data, extractor))
+        return extractor
+
+    return decorator
+
+
+def find_extractor(path, header):
+    """Returns the extractor for the file at path, given its first
+    HEADER_SIZE bytes, or None."""
+    for offset, data, extractor in by_magic:
+        if header[offset:offset + len(data)] == data:
+            return extractor
+
+    return by_extension.get(os.path.splitext(path)[1].lower())
+
+
+def read_timestamp(path, counts=None):
+    """Reads the capture time of the file at path with its extractor.
+    Returns a datetime (see register), or None if the file has none or no
+    extractor reads it. If a counts dict is given, the bytes read are added
+    to its 'bytes_read'."""
+    with open(path, 'rb') as f:
+        if counts is not None:
+            f = CountingFile(f)
+
+        try:
+            extractor = find_extractor(path, f.read(HEADER_SIZE))
+            if extractor is None:
+                return None
+
+            f.seek(0)
+            return extractor(f)
+        finally:
+            if counts is not None:
+                counts['bytes_read'] = counts.get('bytes_read', 0) +\
+                    f.bytes_read
+
+
+def iter_boxes(f, start=0, end=None):
+    """Yields (type, payload offset, end offset) of the ISO base media file
+    format boxes in f from start to end (the end of the file if None),
+    seeking from box header to box header."""
+    offset = start
+    while end is None or offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+
+        size, kind = struct.unpack('>I4s', header)
+        payload = offset + 8
+        if size == 1:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            size = struct.unpack('>Q', header)[0]
+            payload += 8
+        elif size == 0:
+            # the box runs to the end
+            if end is None:
+                f.seek(0, 2)
+                end = f.tell()
+            yield kind, payload, end
+            return
+
+        if size < payload - offset:
+            return
+
+        yield kind, payload, offset + size
+        offset += size
+
+
+def find_box(f, kind, start=0, end=None):
+    """Returns (payload offset, end offset) of the first box of type kind
+    between start and end, or None."""
+    for box_kind, payload, box_end in iter_boxes(f, start, end):
+        if box_kind == kind:
+            return payload, box_end
+    return None
+
+
+@register(['.jpg', '.jpeg', '.jpe'], [(0, b'\xff\xd8\xff')])
+def read_jpeg(f):
+    return read_jpeg_datetime(f)
+
+
+@register(['.tif', '.tiff', '.dng', '.nef', '.nrw', '.cr2', '.arw', '.srf',
+           '.sr2', '.orf', '.rw2', '.pef', '.srw', '.erf', '.3fr', '.kdc',
+           '.mos', '.iiq', '.mef'],
+          [(0, b'II*\x00'), (0, b'MM\x00*'), (0, b'IIRO'), (0, b'IIRS'),
+           (0, b'MMOR'), (0, b'IIU\x00')])
+def read_tiff(f):
+    """TIFF based RAW files: the timestamp is in IFD0 or the EXIF IFD."""
+    return read_tiff_datetime(HeaderReader(f))
+
+
+@register(['.raf'], [(0, b'FUJIFILMCCD-RAW')])
+def read_raf(f):
+    """Fujifilm RAF: the header points to an embedded JPEG preview, whose
+    EXIF data is read."""
+    f.seek(84)
+    header = f.read(4)
+    if len(header) < 4:
+        return None
+
+    f.seek(struct.unpack('>I', header)[0])
+    return read_jpeg_datetime(f)
+
+
+@register(['.cr3'], [(8, b'crx ')])
+def read_cr3(f):
+    """Canon CR3: moov holds a uuid box whose CMT1 box is a TIFF structure
+    with IFD0, and CMT2 one with the EXIF IFD."""
+    moov = find_box(f, b'moov')
+    if moov is None:
+        return None
+
+    for kind, payload, end in iter_boxes(f, *moov):
+        f.seek(payload)
+        if kind == b'uuid' and f.read(16) == CANON_UUID:
+            for name in (b'CMT1', b'CMT2'):
+                box = find_box(f, name, payload + 16, end)
+                if box is not None:
+                    timestamp = read_tiff_datetime(HeaderReader(f, box[0]))
+                    if timestamp is not None:
+                        return timestamp
+            return None
+
+    return None
+
+
+@register(['.heic', '.heif', '.hif', '.avif'],
+          [(8, b'heic'), (8, b'heix'), (8, b'heim'), (8, b'heis'),
+           (8, b'hevc'), (8, b'mif1'), (8, b'msf1'), (8, b'avif')])
+def read_heif(f):
+    """HEIF: the item of type Exif, found through the meta box's item info
+    (iinf) and item locations (iloc), holds a TIFF structure."""
+    meta = find_box(f, b'meta')
+    if meta is None:
+        return None
+
+    # meta is small: read it, after its version and flags
+    f.seek(meta[0] + 4)
+    data = io.BytesIO(f.read(meta[1] - meta[0] - 4))
+
+    exif_item = None
+    locations = {}
+    for kind, payload, end in iter_boxes(data):
+        data.seek(payload)
+        box = data.read(end - payload)
+        if kind == b'iinf':
+            exif_item = read_iinf_exif_item(box)
+        elif kind == b'iloc':
+            locations = read_iloc(box)
+
+    if exif_item not in locations:
+        return None
+
+    # the item starts with the offset of the TIFF header in what follows
+    offset = locations[exif_item]
+    f.seek(offset)
+    header = f.read(4)
+    if len(header) < 4:
+        return None
+
+    return read_tiff_datetime(HeaderReader(
+        f, offset + 4 + struct.unpack('>I', header)[0]))
+
+
+def read_iinf_exif_item(box):
+    """Returns the ID of the Exif item in an iinf box's payload, or None."""
+    version = ord(box[0:1])
+    # after version, flags and the entry count
+    entries = io.BytesIO(box[8:] if version else box[6:])
+
+    for kind, payload, end in iter_boxes(entries):
+        if kind != b'infe':
+            continue
+        entries.seek(payload)
+        infe = entries.read(end - payload)
+        infe_version = ord(infe[0:1])
+        if infe_version == 2:
+            item, item_type = struct.unpack('>H2x4s', infe[4:12])
+        elif infe_version == 3:
+            item, item_type = struct.unpack('>I2x4s', infe[4:14])
+        else:
+            continue
+        if item_type == b'Exif':
+            return item
+
+    return None
+
+
+def read_iloc(box):
+    """Returns {item ID: file offset of its first extent} from an iloc box's
+    payload, for items stored in the file itself."""
+    version = ord(box[0:1])
+    sizes = ord(box[4:5]) << 8 | ord(box[5:6])
+    offset_size, length_size = sizes >> 12, sizes >> 8 & 15
+    base_offset_size, index_size = sizes >> 4 & 15, sizes & 15
+    position = [6]
+
+    def read(size):
+        start = position[0]
+        position[0] += size
+        value = 0
+        for byte in bytearray(box[start:start + size]):
+            value = value << 8 | byte
+        return value
+
+    locations = {}
+    count = read(4 if version == 2 else 2)
+    for i in range(count):
+        item = read(4 if version == 2 else 2)
+        construction_method = read(2) & 15 if version in (1, 2) else 0
+        read(2)
+        base_offset = read(base_offset_size)
+        extents = read(2)
+        for extent in range(extents):
+            if version in (1, 2):
+                read(index_size)
+            extent_offset = read(offset_size)
+            read(length_size)
+            if extent == 0 and construction_method == 0:
+                locations[item] = base_offset + extent_offset
+
+    return locations
+
+
+@register(['.mp4', '.m4v', '.mov', '.3gp', '.3g2'], [(4, b'ftyp')])
+def read_mp4(f):
+    """MP4 and QuickTime: the creation time in moov's movie header (mvhd),
+    which is in UTC."""
+    moov = find_box(f, b'moov')
+    if moov is None:
+        return None
+
+    mvhd = find_box(f, b'mvhd', *moov)
+    if mvhd is None:
+        return None
+
+    f.seek(mvhd[0])
+    header = f.read(12)
+    if len(header) < 12:
+        return None
+    if ord(header[0:1]) == 1:
+        creation_time = struct.unpack('>Q', header[4:12])[0]
+    else:
+        creation_time = struct.unpack('>I', header[4:8])[0]
+
+    if creation_time == 0:
+        return None
+    return MP4_EPOCH + datetime.timedelta(seconds=creation_time)
+
+
+@register(['.xmp'], [(0, b'<?xpacket'), (0, b'<x:xmpmeta')])
+def read_xmp(f):
+    """XMP sidecars: exif:DateTimeOriginal, else xmp:CreateDate or
+    photoshop:DateCreated. Dates with a timezone are converted to UTC, and
+    returned as aware UTC datetimes; the others are returned naive."""
+    data = f.read(XMP_READ_SIZE)
+    for expression in XMP_DATE_EXPRESSIONS:
+        match = expression.search(data)
+        if match is not None:
+            break
+    else:
+        return None
+
+    parts = [int(part or 0) for part in match.groups()[:6]]
+    try:
+        timestamp = datetime.datetime(*parts)
+    except ValueError:
+        return None
+
+    zone = match.group(7)
+    if zone is None:
+        return timestamp
+
+    zone = zone.decode('ascii')
+    if zone != 'Z':
+        sign = -1 if zone[0] == '-' else 1
+        timestamp -= sign * datetime.timedelta(hours=int(zone[1:3]),
+                                               minutes=int(zone[4:6]))
+    return pytz.utc.localize(timestamp)
@@ -1,25 +1,239 @@
-from PIL import Image
-from PIL.ExifTags import TAGS
+from array import array
+from timeit import default_timer as timer
 import argparse
+import cProfile
+import collections
+import fnmatch
+import itertools
 import os
 import datetime
-import gpxpy
-import gpxpy.gpx
 import pytz
 import json
 import re
+import struct
 import sys
+import zlib
+
+from GpxImageLinkifier.cache import GpxIndexCache, TimestampCache
+from GpxImageLinkifier.exif import replace, write_jpeg_gps
+from GpxImageLinkifier.extractors import by_extension, read_timestamp
+from GpxImageLinkifier.index import GpxTimeIndex, to_epoch
+from GpxImageLinkifier.stats import Stats
+from GpxImageLinkifier.timezones import UtcConverter
+from GpxImageLinkifier.watch import FolderWatcher
+from GpxImageLinkifier.writers import GeoJSONWriter, GPXWriter, TileWriter,\
+    content_text, geojson_feature
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# PIL, gpxpy, lxml, numpy and multiprocessing are imported where they are
+# first used: together they take longer to import than a small run takes.
 
 # constants
 CWD = os.getcwd()
+# images PIL is asked for a timestamp when the header-only readers find none
+PIL_EXTENSIONS = ('.jpg', '.jpeg', '.jpe')
+# images --thumbnails makes previews of; PIL can't decode the others
+THUMBNAIL_EXTENSIONS = PIL_EXTENSIONS + ('.tif', '.tiff')
+# the command line options --manifest jobs default to
+JOB_DEFAULTS = ('output_format', 'offset_gpx', 'offset_images', 'tz_images',
+                'tz_gpx', 'accuracy', 'image_prefix', 'recursive', 'include',
+                'exclude', 'interpolate', 'write_exif', 'shard', 'max_zoom',
+                'thumbnails', 'thumbnail_size')
+
+
+def scan_dir(path):
+    """Returns (name, is directory) for the entries of the directory at path,
+    using scandir when it is available to avoid a stat per entry."""
+    if scandir is not None:
+        return [(entry.name, entry.is_dir()) for entry in scandir(path)]
+
+    return [(name, os.path.isdir(os.path.join(path, name)))
+            for name in os.listdir(path)]
+
+
+def shard_of(relative_path, count):
+    """Returns which of count shards (numbered from 0) the image at
+    relative_path, relative to the image folder, belongs to. Depends only on
+    the path, so every machine and Python version agrees."""
+    path = relative_path.replace(os.sep, '/')
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+    return (zlib.crc32(path) & 0xffffffff) % count
+
+
+def is_gpxpy_gpx(data):
+    """Returns True if data is a gpxpy.gpx.GPX, without importing gpxpy if
+    nothing has yet."""
+    gpx_module = sys.modules.get('gpxpy.gpx')
+    return gpx_module is not None and isinstance(data, gpx_module.GPX)
+
+
+def read_pil_image_timestamp(path):
+    """Gets the naive timestamp of a photo by decoding its exif data with
+    PIL, or None if it has none."""
+    from PIL import Image
+    from PIL.ExifTags import TAGS
+
+    info = {}
+    i = Image.open(path)
+    exif = i._getexif() or {}
+    for tag, value in exif.items():
+        decoded = TAGS.get(tag, tag)
+        info[decoded] = value
+
+    if 'DateTime' not in info:
+        return None
+    return datetime.datetime.strptime(info['DateTime'], '%Y:%m:%d %H:%M:%S')
+
+
+def is_pil_fallback(path, timestamp):
+    return timestamp is None and\
+        os.path.splitext(path)[1].lower() in PIL_EXTENSIONS
+
+
+def read_image_timestamp(path):
+    """Gets the timestamp of a photo, video or sidecar from its headers with
+    the extractor for its type (see extractors.register), falling back to
+    PIL for JPEGs. Returns None if it has none."""
+    timestamp = read_timestamp(path)
+
+    if is_pil_fallback(path, timestamp):
+        timestamp = read_pil_image_timestamp(path)
+
+    return timestamp
+
+
+def read_image_timestamp_counted(path):
+    """read_image_timestamp for stats: returns (timestamp, bytes read from
+    the headers, 1 if it fell back to PIL else 0)."""
+    counts = {}
+    timestamp = read_timestamp(path, counts)
+
+    if is_pil_fallback(path, timestamp):
+        return read_pil_image_timestamp(path), counts['bytes_read'], 1
+
+    return timestamp, counts['bytes_read'], 0
+
+
+def write_image_location(task):
+    """Writes a location, given as (path, latitude, longitude, elevation,
+    time), into the EXIF data of the JPEG at path, unless it holds it already.
+    Returns None, or an error message if it could not be written. A None task
+    does nothing."""
+    if task is None:
+        return None
+
+    path = task[0]
+    try:
+        write_jpeg_gps(*task)
+    except (IOError, OSError, ValueError, struct.error) as e:
+        return '%s: %s' % (path, e)
+
+    return None
+
+
+def thumbnail_name(relative_path):
+    """Returns the path, relative to the thumbnails folder, of the thumbnail
+    of the image at relative_path: the same path for JPEGs, with .jpg added
+    for the rest so that a.tif and a.jpg don't share one."""
+    if os.path.splitext(relative_path)[1].lower() in PIL_EXTENSIONS:
+        return relative_path
+    return relative_path + '.jpg'
+
+
+def write_thumbnail(task):
+    """Writes a JPEG preview, at most size pixels on a side, of the image at
+    source to destination, given as (source, destination, size), unless
+    destination is newer than source. JPEGs are decoded at a reduced scale
+    (see PIL's Image.draft), so a 24 MP photo costs a fraction of a full
+    decode. Returns None, or an error message if it could not be written.
+    A None task does nothing."""
+    if task is None:
+        return None
+
+    from PIL import Image, ImageOps
+
+    source, destination, size = task
+    try:
+        if os.path.exists(destination) and\
+                os.path.getmtime(destination) >= os.path.getmtime(source):
+            return None
+
+        image = Image.open(source)
+        image.draft('RGB', (size, size))
+        # exif_transpose is new in Pillow 6; older PILs leave the preview
+        # unrotated
+        exif_transpose = getattr(ImageOps, 'exif_transpose', None)
+        if exif_transpose is not None:
+            image = exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        directory = os.path.dirname(destination)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # made by another worker meanwhile
+                if not os.path.isdir(directory):
+                    raise
+
+        # written next to it and renamed, so a half written thumbnail never
+        # looks up to date
+        temporary = destination + '.tmp'
+        image.save(temporary, 'JPEG', quality=85)
+        replace(temporary, destination)
+    except (IOError, OSError, ValueError, SyntaxError) as e:
+        return '%s: %s' % (source, e)
+
+    return None
 
 
 class GIL():
 
+    # read_image_timestamp spends nearly all of its time waiting on small
+    # file reads, which release the GIL, so a thread pool keeps workers busy.
+    # Subclasses with CPU bound readers can set this to False to read images
+    # on a process pool instead.
+    timestamp_reader_releases_gil = True
+
+    # the lowercase extensions of the files read in image folders: those of
+    # the registered timestamp extractors
+    supported_file_extensions = by_extension
+
+    # how many images, or list items, iter_matches matches at once. Images
+    # are matched in small batches so that results arrive soon.
+    image_batch_size = 64
+    list_batch_size = 4096
+
+    # the most timestamp cache lookups read_image_timestamps makes ahead of
+    # an image it is reading, to find more for the pool to read meanwhile
+    timestamp_lookahead = 1024
+
+    # the most offsets estimate_offset tries in its first, coarsest pass
+    offset_steps = 4096
+
     error_messages = {
         'bad_file': 'File path %s does not exist or is not read/writable.',
         'bad_dir': 'File path %s does not exist or is not a directory.',
         'bad_timezone': 'Bad timezone: %s',
+        'bad_shard': 'Bad shard: %s. Use i/N, like 1/4.',
+        'bad_thumbnails': 'The thumbnails folder can not be the image folder.',
+        'tiles_path': 'Output format tiles needs an output path: the folder '
+                      'to write tiles to. It can not be used with --watch.',
         'required_param': 'Parameter "%s" is required and cannot be None.'
     }
 
@@ -27,22 +241,75 @@ class GIL():
                  gpx_path=None, image_folder=None, output_path=None,
                  output_format='geojson', offset_gpx='0s', offset_images='0s',
                  accuracy='1m', tz_images='UTC', tz_gpx='UTC', image_prefix='',
-                 isCLI=False):
-
+                 compact=False, workers=1, cache_dir=None, recursive=False,
+                 include=None, exclude=None, estimate_offset=None,
+                 offset_range='12h', interpolate=False, stats=False,
+                 profile=None, watch=False, watch_interval=2.0,
+                 write_exif=False, shard=None, thumbnails=None,
+                 thumbnail_size=256, max_zoom=16, isCLI=False):
+
+        started = timer()
         errors = False
         self.isCLI = isCLI
+        # the messages of the errors write_error reported, like bad input
+        self.errors = []
+        # set while watching, which keeps going: images that can't be read
+        # are reported on stderr and skipped instead of raising
+        self.skip_unreadable = False
+        # wall time per stage and counters are only collected if asked for.
+        self.stats = Stats() if stats else None
+        # find_matches, and CLI output, are run under cProfile if this is a
+        # path to write the profile to.
+        self.profile = profile
+        # compact instances only keep the columns of self.gpx_index, not the
+        # gpxpy objects GPX data was parsed into.
+        self.compact = compact
         self.gpx_datasets = []
+        self.matches = []
+        self.matches_gpxpy = None
+
+        # parse images timezone
+        if self.validate_timezone(tz_images) is False:
+            self.write_error(self.error_messages['bad_timezone'] %
+                             tz_images)
+            errors = True
+        else:
+            self.tz_images = pytz.timezone(tz_images)
+            self.tz_images_converter = UtcConverter(self.tz_images)
+
+        # parse gpx timezone. GPX data is indexed in UTC as it is added, so
+        # this has to happen before any gpx_path is parsed.
+        if self.validate_timezone(tz_gpx) is False:
+            self.write_error(self.error_messages['bad_timezone'] % tz_gpx)
+            errors = True
+            self.tz_gpx = pytz.utc
+        else:
+            self.tz_gpx = pytz.timezone(tz_gpx)
+
+        self.gpx_index = GpxTimeIndex(self.tz_gpx, compact)
+
+        # image timestamps and compiled GPX indexes are cached on disk if a
+        # cache_dir is given
+        if cache_dir is not None:
+            self.timestamp_cache = TimestampCache(cache_dir)
+            self.gpx_index_cache = GpxIndexCache(cache_dir)
+        else:
+            self.timestamp_cache = None
+            self.gpx_index_cache = None
 
         # required arguments
         if gpx_path is not None:
-            if isinstance(gpx_path, str):
+            if isinstance(gpx_path, string_types):
                 if self.validate_file(gpx_path, 'r') is False:
                     self.write_error(self.error_messages['bad_file'] % gpx_path)
                     errors = True
                 else:
                     self.add_gpx_data(os.path.abspath(gpx_path))
-            elif isinstance(gpx_path, gpxpy.gpx.GPX):
+            elif is_gpxpy_gpx(gpx_path):
                 self.add_gpx_data(gpx_path)
+            elif isinstance(gpx_path, GpxTimeIndex):
+                # already indexed, and maybe shared with other instances
+                self.gpx_index = gpx_path
 
         # parse image folder
         if image_folder is not None:
@@ -53,23 +320,16 @@ class GIL():
             else:
                 self.image_folder = os.path.abspath(image_folder)
 
-        # parse images timezone
-        if self.validate_timezone(tz_images) is False:
-            self.write_error(self.error_messages['bad_timezone'] %
-                             tz_images)
-            errors = True
-        else:
-            self.tz_images = pytz.timezone(tz_images)
-
-        # parse gpx timezone
-        if self.validate_timezone(tz_gpx) is False:
-            self.write_error(self.error_messages['bad_timezone'] % tz_gpx)
-            errors = True
-        else:
-            self.tz_gpx = pytz.timezone(tz_gpx)
+        # parse output option. Tiles are written to a folder.
+        if output_format == 'tiles':
+            if output_path is None or watch or\
+                    os.path.isfile(output_path):
+                self.write_error(self.error_messages['tiles_path'])
+                errors = True
+            else:
+                self.output_path = os.path.abspath(output_path)
 
-        # parse output option
-        if output_path is not None:
+        elif output_path is not None:
             if self.validate_file(output_path, 'w') is False:
                 self.write_error(self.error_messages['bad_file'] % output_path)
                 errors = True
@@ -84,6 +344,36 @@ class GIL():
         self.offset_images = self.parse_timeString(offset_images)
         self.accuracy = self.parse_timeString(accuracy)
         self.image_prefix = image_prefix
+        self.workers = workers
+        self.recursive = recursive
+        self.include = include or []
+        self.exclude = exclude or []
+        # interpolate between the track points around each image instead of
+        # snapping it to the nearest one
+        self.interpolate = interpolate
+        self.max_zoom = max_zoom
+
+        # previews of matched images are written to this folder if given,
+        # and it is never searched for images itself
+        self.thumbnails = thumbnails
+        self.thumbnail_size = thumbnail_size
+        if thumbnails is not None and image_folder is not None:
+            relative = os.path.relpath(os.path.abspath(thumbnails),
+                                       os.path.abspath(image_folder))
+            if relative == os.curdir:
+                self.write_error(self.error_messages['bad_thumbnails'])
+                errors = True
+            elif not relative.startswith(os.pardir):
+                self.exclude = self.exclude + [relative]
+
+        # only the images of one shard, as (number from 0, count), are
+        # matched if a shard string like "1/4" is given
+        self.shard = None
+        if shard is not None:
+            self.shard = self.parse_shard(shard)
+            if self.shard is None:
+                self.write_error(self.error_messages['bad_shard'] % shard)
+                errors = True
 
         # automatically find matches and display output if being used from CLI.
         # ---------------------------------------------------------------------
@@ -92,27 +382,67 @@ class GIL():
             if errors is True:
                 return
 
-            self.find_matches(self.image_folder)
-
-            if output_format == 'geojson':
-                result = self.to_geojson()
-            elif output_format == 'gpx':
-                result = self.to_gpx()
-
-            if self.output_path is None:
-                self.write_to_cli(result)
+            # estimate the camera clock offset, then either report it instead
+            # of matching or match with it
+            if estimate_offset is not None:
+                offset, matches, count = self.estimate_offset(
+                    self.image_folder, self.parse_timeString(offset_range))
+                message = 'Estimated offset: --offset-images=%s matches %d of %d images.' % (
+                    self.format_timeString(offset), matches, count)
+
+                if estimate_offset == 'report':
+                    self.write_to_cli(message)
+                    return
+
+                sys.stderr.write(message + '\n')
+                self.offset_images = offset
+
+            if output_format == 'tiles':
+                f = None
+            elif self.output_path is None:
+                f = sys.stdout
             else:
                 f = open(self.output_path, 'w')
-                f.write(result)
+
+            # output is written as matches are found
+            if watch:
+                self.watch(self.image_folder, f, output_format, watch_interval,
+                           write_exif=write_exif)
+            else:
+                matches = self.iter_matches(self.image_folder)
+                if write_exif:
+                    matches = self.write_image_locations(self.image_folder,
+                                                         matches)
+                if self.thumbnails is not None:
+                    matches = self.write_thumbnails(self.image_folder,
+                                                    matches)
+
+                if output_format in ('geojson', 'ndjson'):
+                    self.run_profiled(self.write_geojson, matches, f,
+                                      sequence=output_format == 'ndjson')
+                elif output_format == 'gpx':
+                    self.run_profiled(self.write_gpx, matches, f)
+                elif output_format == 'tiles':
+                    self.run_profiled(self.write_tiles, matches,
+                                      self.output_path, self.max_zoom)
+
+            if f is not None and f is not sys.stdout:
                 f.close()
 
+            if self.stats is not None:
+                self.stats.add_time('total', timer() - started)
+                sys.stderr.write(json.dumps(self.stats.to_dict(), indent=4,
+                                            separators=(',', ': ')) + '\n')
+
     @classmethod
     def parse_arguments(self):
         # argument parsing
         parser = argparse.ArgumentParser(
             description='''Links timestamps in photographs to timestamps in GPX
 data. You can either add GPX data to your images' EXIF data, or output a
-geojson file with waypoints linking images to specific GPX tracks.''',
+geojson file with waypoints linking images to specific GPX tracks. Run
+"gil serve -h" to serve GPX lookups over HTTP instead, and "gil merge -h" to
+combine the outputs of --shard runs.''',
             # usage='',
             # epilog='',
             add_help=True,
@@ -120,14 +450,29 @@ geojson file with waypoints linking images to specific GPX tracks.''',
 
         parser.add_argument('gpx_path',
                             type=str,
+                            nargs='?',
                             help='Path to the GPX file to use.'
                             )
 
         parser.add_argument('image_folder',
                             type=str,
+                            nargs='?',
                             help='Path to the image files to use.'
                             )
 
+        parser.add_argument('--manifest',
+                            '-m',
+                            type=str,
+                            help='''Run the jobs in this JSON file, instead of
+matching gpx_path and image_folder: a list of objects like {"gpx_path":
+"track.gpx", "image_folder": "photos", "output_path": "photos.geojson"}, which
+can also set accuracy, offset_gpx, offset_images, tz_images, tz_gpx,
+output_format, image_prefix, recursive, include, exclude, interpolate,
+write_exif, thumbnails, thumbnail_size, shard, max_zoom and workers. Options
+given on the command line are the defaults for every job. Each GPX file is parsed once however many jobs use it (gpx_path can also be a
+list), and --jobs jobs run at once.'''
+                            )
+
         parser.add_argument('--output-path',
                             '-o',
                             type=str,
@@ -137,12 +482,22 @@ geojson file with waypoints linking images to specific GPX tracks.''',
         parser.add_argument('--output-format',
                             '-t',
                             type=str,
-                            help='The output format. Options are geojson or\
-                            gpx. Defaults to geojson.',
-                            choices=['geojson', 'gpx'],
+                            help='The output format. Options are geojson,\
+                            ndjson (newline-delimited geojson features), gpx\
+                            or tiles (a folder of {z}/{x}/{y}.json map tiles\
+                            of clustered matches, for --output-path).\
+                            Defaults to geojson.',
+                            choices=['geojson', 'ndjson', 'gpx', 'tiles'],
                             default='geojson'
                             )
 
+        parser.add_argument('--max-zoom',
+                            type=int,
+                            help='''The most zoomed in level of tiles output.
+Each tile clusters the matches in each of its 8x8 cells. Defaults to 16.''',
+                            default=16
+                            )
+
         parser.add_argument('--accuracy',
                             '-a',
                             type=str,
@@ -153,6 +508,15 @@ minutes will count as a match. Defaults to 1m.''',
                             default='1m'
                             )
 
+        parser.add_argument('--interpolate',
+                            '-i',
+                            action='store_true',
+                            help='''Place images between the two track points
+taken before and after them, rather than at the nearest one, when both are
+within the accuracy. Tracks logged every 10-30 seconds then place images about
+as well as tracks logged every second.'''
+                            )
+
         parser.add_argument('--offset-gpx',
                             type=str,
                             help='''The amount of time to ADD to GPX timestamps
@@ -175,6 +539,22 @@ timestamps before comparing timestamps on your images.''',
                             default='0s'
                             )
 
+        parser.add_argument('--estimate-offset',
+                            type=str,
+                            help='''Estimate the offset between the camera and
+GPS clocks from the images and GPX data instead of guessing --offset-images.
+"report" prints the offset that matches the most images; "apply" uses it for
+the output.''',
+                            choices=['report', 'apply']
+                            )
+
+        parser.add_argument('--offset-range',
+                            type=str,
+                            help='''How far either side of --offset-images
+--estimate-offset searches, like 2h. Defaults to 12h.''',
+                            default='12h'
+                            )
+
         parser.add_argument('--tz-images',
                             type=str,
                             help='The timezone the image timestamps are in.',
@@ -186,6 +566,101 @@ timestamps before comparing timestamps on your images.''',
                             help='The timezone the GPX timestamps are in.',
                             default='UTC'
                             )
+
+        parser.add_argument('--write-exif',
+                            action='store_true',
+                            help='''Also write the location of each matched
+JPEG into its EXIF data, as GPS tags. Only the EXIF segment is rewritten: the
+image data is copied as is, and each file is replaced atomically. Other matched
+files are output but not written.'''
+                            )
+
+        parser.add_argument('--thumbnails',
+                            type=str,
+                            help='''Also write a JPEG preview of each matched
+image to this folder, at the image's path relative to the image folder, and
+add its path to the output as the "thumbnail" property. JPEGs are decoded at a
+reduced scale. Thumbnails newer than their image are kept.'''
+                            )
+
+        parser.add_argument('--thumbnail-size',
+                            type=int,
+                            help='''The longest side of --thumbnails previews,
+in pixels. Defaults to 256.''',
+                            default=256
+                            )
+
+        parser.add_argument('--recursive',
+                            '-r',
+                            action='store_true',
+                            help='Look for images in subfolders too.'
+                            )
+
+        parser.add_argument('--include',
+                            type=str,
+                            action='append',
+                            help='''Only use images whose path, relative to
+the image folder, matches this pattern, like "2013/*/DSC_*". Can be given more
+than once.'''
+                            )
+
+        parser.add_argument('--exclude',
+                            type=str,
+                            action='append',
+                            help='''Skip images and folders whose path,
+relative to the image folder, matches this pattern. Can be given more than
+once.'''
+                            )
+
+        parser.add_argument('--shard',
+                            type=str,
+                            help='''Only match this share of the images, like
+1/4 for the first quarter, so N machines can split a run between them. Images
+are assigned by a hash of their path, the same on every machine. Combine the
+outputs with "gil merge".'''
+                            )
+
+        parser.add_argument('--jobs',
+                            '-j',
+                            type=int,
+                            help='''The number of images to read at once.
+Defaults to 1.''',
+                            default=1
+                            )
+
+        parser.add_argument('--cache-dir',
+                            type=str,
+                            help='''A directory to cache image timestamps and
+compiled GPX indexes in. Images and GPX files that have not changed since they
+were cached are not read again on later runs.'''
+                            )
+        parser.add_argument('--watch',
+                            '-w',
+                            action='store_true',
+                            help='''Keep running after matching the images in
+image_folder, and append matches for images added to it (or changed) to the
+output as they arrive. Stop with Ctrl-C.'''
+                            )
+
+        parser.add_argument('--watch-interval',
+                            type=float,
+                            help='''How often --watch looks for new images, in
+seconds, where the filesystem cannot tell it. Defaults to 2.''',
+                            default=2.0
+                            )
+
+        parser.add_argument('--stats',
+                            action='store_true',
+                            help='''Print the time spent on each stage and
+counters like images read and matched, bytes read and cache hit rates to
+stderr as JSON when done.'''
+                            )
+
+        parser.add_argument('--profile',
+                            type=str,
+                            help='''Run the matching and output under cProfile
+and write the profile to this path, for pstats or snakeviz.'''
+                            )
         parser.add_argument('--image-prefix',
                             type=str,
                             help='''A string prefix to add to matched image
@@ -194,104 +669,249 @@ filenames in the output data.''',
                             )
 
         args = parser.parse_args()
+        if args.manifest is None and args.image_folder is None:
+            parser.error('gpx_path and image_folder are required, unless '
+                         '--manifest is given')
+
         return args
 
     def add_gpx_data(self, path):
         """Appends new gpx data to self.gpx_datasets. Will parse a gpx file if
         path is a file path, otherwise if path is a gpxpy.gpx.GPX object, it
-        will add the object directly to self.gpx_datasets."""
+        will add the object directly to self.gpx_datasets. Compact instances
+        only add the data to self.gpx_index, streaming files straight into it
+        and returning the index instead of a gpxpy.gpx.GPX object."""
 
-        if isinstance(path, gpxpy.gpx.GPX):
-            self.gpx_datasets.append(path)
-            return path
+        started = timer()
+        points = self.gpx_index.count
+
+        if self.compact and not is_gpxpy_gpx(path):
+            self.gpx_index.add_gpx_file(path, self.gpx_index_cache)
+            parsed_gpx_data = self.gpx_index
         else:
-            gpx_file = open(path, 'r')
-            parsed_gpx_data = gpxpy.parse(gpx_file)
-            self.gpx_datasets.append(parsed_gpx_data)
-            return parsed_gpx_data
+            if is_gpxpy_gpx(path):
+                parsed_gpx_data = path
+            else:
+                import gpxpy
+                gpx_file = open(path, 'r')
+                parsed_gpx_data = gpxpy.parse(gpx_file)
+
+            if not self.compact:
+                self.gpx_datasets.append(parsed_gpx_data)
+            self.gpx_index.add_gpx(parsed_gpx_data)
+
+        if self.stats is not None:
+            self.stats.add_time('gpx', timer() - started)
+            self.stats.count('gpx_points', self.gpx_index.count - points)
+            self.collect_stats()
+
+        return parsed_gpx_data
 
     def localize_image_timestamp(self, ts):
         # localize timestamp to desired timezone, then convert that to UTC.
-        timestamp = self.tz_images.localize(ts)
-
-        return timestamp.astimezone(pytz.utc)
+        # Timestamps that already have a timezone keep it.
+        return self.tz_images_converter.utc(ts)
 
     def get_image_timestamp(self, path):
-        """Gets the timestamp of a photo from its exif data."""
-        info = {}
-        i = Image.open(path)
-        exif = i._getexif()
-        for tag, value in exif.items():
-            decoded = TAGS.get(tag, tag)
-            info[decoded] = value
+        """Gets the timestamp of a photo from its exif data (or of a video or
+        sidecar, see read_image_timestamp), or None if it has none."""
+        timestamp = read_image_timestamp(path)
+        if timestamp is None:
+            return None
+        return self.localize_image_timestamp(timestamp)
 
-        timestamp = datetime.datetime.strptime(info['DateTime'],
-                                               '%Y:%m:%d %H:%M:%S')
+    def get_pil_image_timestamp(self, path):
+        """Gets the naive timestamp of a photo by decoding its exif data with
+        PIL."""
+        return read_pil_image_timestamp(path)
+
+    def read_image_timestamps(self, paths):
+        """Yields the timestamp of each image in paths, in order, as
+        read_image_timestamp returns it. Images in self.timestamp_cache are
+        not read at all."""
+        cache = self.timestamp_cache
+        if cache is None:
+            for timestamp in self.read_uncached_image_timestamps(paths):
+                yield timestamp
+            return
+
+        # Cache hits are yielded as soon as they are looked up. An image that
+        # has to be read starts a reader, which looks up the paths after it
+        # as the pool asks for more, at most timestamp_lookahead of them;
+        # those wait in order behind the image. The reader is only advanced
+        # while one of its images is outstanding.
+        paths = iter(paths)
+        lookups = collections.deque()
+
+        def uncached_paths(first):
+            yield first
+            for path in paths:
+                timestamp, key = cache.get(path)
+                lookups.append((timestamp, key))
+                if timestamp is None:
+                    yield key[0]
+                if len(lookups) >= self.timestamp_lookahead:
+                    return
+
+        reader = None
+        try:
+            while True:
+                if lookups:
+                    timestamp, key = lookups.popleft()
+                else:
+                    path = next(paths, None)
+                    if path is None:
+                        break
+
+                    timestamp, key = cache.get(path)
+                    if timestamp is None:
+                        # the last reader has nothing outstanding
+                        if reader is not None:
+                            reader.close()
+                        reader = self.read_uncached_image_timestamps(
+                            uncached_paths(key[0]))
+
+                if timestamp is None:
+                    timestamp = next(reader)
+                    cache.set(key, timestamp)
+                yield timestamp
+        finally:
+            if reader is not None:
+                reader.close()
+            cache.flush()
+
+    def read_uncached_image_timestamps(self, paths):
+        """Yields the timestamp of each image in paths, in order. With
+        more than one worker the images are read on a pool, keeping at most a
+        few reads per worker in flight. Images that can't be read have no
+        timestamp if self.skip_unreadable."""
+        stats = self.stats
+        if stats is not None:
+            for timestamp, bytes_read, fallback in self.read_image_files(
+                    paths, read_image_timestamp_counted,
+                    self.skip_unreadable, (None, 0, 0)):
+                stats.count('bytes_read', bytes_read)
+                stats.count('pil_fallbacks', fallback)
+                yield timestamp
+            return
+
+        for timestamp in self.read_image_files(paths, read_image_timestamp,
+                                               self.skip_unreadable):
+            yield timestamp
+
+    def read_image_files(self, paths, reader, skip_unreadable=False,
+                         unreadable=None):
+        """Yields reader(path) for each image in paths, in order, on a pool
+        if there is more than one worker. If skip_unreadable, an image whose
+        reader raises is reported on stderr and yields unreadable instead."""
+
+        def result(path, read, *args):
+            if not skip_unreadable:
+                return read(*args)
+            try:
+                return read(*args)
+            except Exception as e:
+                sys.stderr.write('ERROR: %s: %s\n' % (path, e))
+                return unreadable
+
+        if self.workers <= 1:
+            for path in paths:
+                yield result(path, reader, path)
+            return
+
+        if self.timestamp_reader_releases_gil:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.workers)
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(self.workers)
 
-        return self.localize_image_timestamp(timestamp)
+        pending = collections.deque()
+        try:
+            for path in paths:
+                pending.append((path, pool.apply_async(reader, (path,))))
+                if len(pending) >= self.workers * 4:
+                    path, task = pending.popleft()
+                    yield result(path, task.get)
+
+            while pending:
+                path, task = pending.popleft()
+                yield result(path, task.get)
+        finally:
+            pool.terminate()
 
     def find_timestamp_gpx_match(self, target_datetime, gpx_data=None,
                                  accuracyDelta=datetime.timedelta(minutes=1),
                                  offsetGpxDelta=datetime.timedelta(seconds=0),
                                  offsetImageDelta=datetime.timedelta(seconds=0)):
+        """Returns the GPX point closest in time to target_datetime, or None if
+        no point is within accuracyDelta of it. If self.interpolate, the point
+        is interpolated as find_timestamp_gpx_matches does. Searches
+        self.gpx_index unless other gpx_data (a gpxpy.gpx.GPX, a list of
+        them, or a GpxTimeIndex as compact instances' add_gpx_data returns)
+        is given."""
+
+        if gpx_data is None or gpx_data is self.gpx_datasets:
+            index = self.gpx_index
+        else:
+            index = self.build_gpx_index(gpx_data)
 
-        matches = []
+        # offsets are applied to the target rather than every indexed point.
+        target = to_epoch(target_datetime + offsetImageDelta) -\
+            offsetGpxDelta.total_seconds()
 
-        target_datetime = target_datetime + offsetImageDelta
+        # interpolate_many and nearest_many, one target at a time
+        if self.interpolate:
+            return index.interpolate(target, accuracyDelta.total_seconds())
 
-        if gpx_data is None:
-            gpx_data = self.gpx_datasets
+        match = index.nearest(target, accuracyDelta.total_seconds())
 
-        def check_for_match(point):
-            ts = to_tz(point.time + offsetGpxDelta)
+        if match is None:
+            return None
 
-            if abs(ts - target_datetime) < accuracyDelta:
-                matches.append(point)
+        return index.point(match)
 
-        def check_closest_point_match(matches):
-            """Compares GPX points to find which one most closely matches
-            the target"""
+    def find_timestamp_gpx_matches(self, target_datetimes):
+        """Batch version of find_timestamp_gpx_match over self.gpx_index using
+        the instance's accuracy and offsets. Returns one GPX point (or None)
+        per datetime in target_datetimes. If self.interpolate, points are
+        interpolated between the track points around each datetime where
+        they are both within the accuracy."""
+        return self.find_epoch_gpx_matches(
+            [to_epoch(ts) for ts in target_datetimes])
 
-            best_point_match = None
+    def find_epoch_gpx_matches(self, targets):
+        """find_timestamp_gpx_matches for times given as seconds since the
+        UTC epoch."""
+        index = self.gpx_index
+        offset = (self.offset_images - self.offset_gpx).total_seconds()
 
-            for match in matches:
-                if best_point_match is None or\
-                    (abs(to_tz(match.time + offsetGpxDelta) - target_datetime)
-                        < abs(to_tz(best_point_match.time + offsetGpxDelta) - target_datetime)):
-                    best_point_match = match
-
-            return best_point_match
-
-        def to_tz(ts):
-            """localize a timestamp to the same timezone as the GPX data,
-            then return it's UTC equivalent for comparison."""
-            ts = self.tz_gpx.localize(ts)
-            return ts.astimezone(pytz.utc)
-
-        def walk_gpx(data):
-            """walk gpxpy data tracks and waypoints, looking for
-            closest match."""
-            for track in data.tracks:
-                for segment in track.segments:
-                    for point in segment.points:
-                        check_for_match(point)
-
-            for waypoint in data.waypoints:
-                check_for_match(point)
+        if self.interpolate:
+            return index.interpolate_many(
+                targets, self.accuracy.total_seconds(), offset)
+
+        return index.points(index.nearest_many(
+            targets, self.accuracy.total_seconds(), offset))
+
+    def build_gpx_index(self, gpx_data):
+        """Builds a GpxTimeIndex for gpx data that was not added through
+        add_gpx_data. A GpxTimeIndex is used as it is."""
+        if isinstance(gpx_data, GpxTimeIndex):
+            return gpx_data
+
+        index = GpxTimeIndex(self.tz_gpx, self.compact)
 
         if isinstance(gpx_data, list):
-            # gpx_data is internally stored array of gpx datasets. Need an
-            # extra loop.
             for data in gpx_data:
-                walk_gpx(data)
+                index.add_gpx(data)
 
-        elif isinstance(gpx_data, gpxpy.gpx.GPX):
-            # gpx_data is straight up gpxpy track. Start walking it.
-            walk_gpx(gpx_data)
+        elif is_gpxpy_gpx(gpx_data):
+            index.add_gpx(gpx_data)
 
-        return check_closest_point_match(matches)
+        return index
 
     def save_matches_as_gpxpy(self):
+        import gpxpy.gpx
         gpx_data = gpxpy.gpx.GPX()
 
         # Create points:
@@ -300,7 +920,7 @@ filenames in the output data.''',
                 longitude=match['location'].longitude,
                 latitude=match['location'].latitude,
                 elevation=match['location'].elevation,
-                name=str(match['content'])))
+                name=content_text(match['content'])))
 
         self.matches_gpxpy = gpx_data
 
@@ -309,17 +929,46 @@ filenames in the output data.''',
     # -------------------------------------------------------------------------
 
     def parse_timeString(self, timestring):
-        """Parses a timestring like "1m2s" or "3h2m1s" into a timedelta"""
+        """Parses a timestring like "1m2s", "3h2m1s" or "-4m56s" into a
+        timedelta"""
+        timestring = timestring.strip()
+        sign = -1 if timestring.startswith('-') else 1
+        timestring = timestring.lstrip('+-')
         expression = '((?P<days>[0-9]*)[dD])*((?P<hours>[0-9]*)[hH])*((?P<minutes>[0-9]*)[mM])*((?P<seconds>[0-9]*)[sS])*'
         time = re.search(expression, timestring)
         days = int(time.group('days')) if time.group('days') is not None else 0
         hours = int(time.group('hours')) if time.group('hours') is not None else 0
         minutes = int(time.group('minutes')) if time.group('minutes') is not None else 0
         seconds = int(time.group('seconds')) if time.group('seconds') is not None else 0
-        return datetime.timedelta(days=days,
-                                  hours=hours,
-                                  minutes=minutes,
-                                  seconds=seconds)
+        return sign * datetime.timedelta(days=days,
+                                         hours=hours,
+                                         minutes=minutes,
+                                         seconds=seconds)
+
+    def parse_shard(self, shard):
+        """Parses a shard string like "1/4", the first of 4, into (0, 4).
+        Returns None if it is not one."""
+        match = re.match(r'\s*(\d+)\s*/\s*(\d+)\s*$', shard)
+        if match is None:
+            return None
+
+        number, count = int(match.group(1)), int(match.group(2))
+        if not 1 <= number <= count:
+            return None
+        return number - 1, count
+
+    def format_timeString(self, delta):
+        """Formats a timedelta as a timestring parse_timeString reads back,
+        like "-4m56s". Fractions of a second are dropped."""
+        seconds = int(delta.total_seconds())
+        sign = '-' if seconds < 0 else ''
+        minutes, seconds = divmod(abs(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        days, hours = divmod(hours, 24)
+        timestring = ''.join('%d%s' % (value, unit) for value, unit in
+                             [(days, 'd'), (hours, 'h'), (minutes, 'm'),
+                              (seconds, 's')] if value)
+        return sign + (timestring or '0s')
 
     def validate_timezone(self, timezoneString):
         try:
@@ -354,6 +1003,7 @@ filenames in the output data.''',
         f.close
 
     def write_error(self, output):
+        self.errors.append(output)
         self.write_to_cli('ERROR: ' + output)
 
     # -------------------------------------------------------------------------
@@ -368,93 +1018,463 @@ filenames in the output data.''',
             "features": []
         }
 
+        started = timer()
+
         for match in self.matches:
-            geojson_python['features'].append({
-                "type": "Feature",
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": [
-                        match["location"].longitude,
-                        match["location"].latitude,
-                        match["location"].elevation
-                    ]
-                },
-                "properties": {
-                    "content": self.image_prefix + str(match["content"])
-                }
-            })
-
-        return json.dumps(geojson_python, indent=4)
+            geojson_python['features'].append(
+                geojson_feature(match, self.image_prefix))
+
+        output = json.dumps(geojson_python, indent=4)
+
+        if self.stats is not None:
+            self.stats.add_time('output', timer() - started)
+        return output
+
+    def write_geojson(self, matches, f, sequence=False, indent=None):
+        """Streams matches (any iterable, like iter_matches) to the file
+        object f as a GeoJSON FeatureCollection, or as newline-delimited
+        GeoJSON if sequence is True. Returns the number of features written."""
+        return self.write_matches(
+            GeoJSONWriter(f, self.image_prefix, sequence, indent), matches)
+
+    def write_gpx(self, matches, f):
+        """Streams matches (any iterable, like iter_matches) to the file
+        object f as GPX waypoints. Returns the number of waypoints written."""
+        return self.write_matches(GPXWriter(f, self.image_prefix), matches)
+
+    def write_tiles(self, matches, path, max_zoom=16):
+        """Streams matches (any iterable, like iter_matches) to the folder at
+        path as tiles of clusters for zooms 0 to max_zoom (see TileWriter).
+        Returns the number of matches written."""
+        return self.write_matches(
+            TileWriter(path, self.image_prefix, max_zoom), matches)
+
+    def write_matches(self, writer, matches):
+        """Writes matches with one of the writers in writers.py and closes
+        it. Returns the number of matches written."""
+        stats = self.stats
+        if stats is not None:
+            started = timer()
+            finding = stats.times['read'] + stats.times['match']
+
+        writer.write_all(matches)
+        writer.close()
+
+        # matches may be found as they are written; that is not output time.
+        if stats is not None:
+            stats.add_time('output', timer() - started - (
+                stats.times['read'] + stats.times['match'] - finding))
+
+        return writer.count
 
     def to_xml(self):
         """returns GPX XML of the matches found."""
-        return self.matches_gpxpy.to_xml()
+        started = timer()
+
+        if self.matches_gpxpy is None:
+            self.save_matches_as_gpxpy()
+        output = self.matches_gpxpy.to_xml()
+
+        if self.stats is not None:
+            self.stats.add_time('output', timer() - started)
+        return output
+
+    def collect_stats(self):
+        """Copies the counters kept by self.gpx_index and the caches into
+        self.stats."""
+        counts = self.stats.counts
+        counts['lookups'] = self.gpx_index.lookups
+        counts['points_examined'] = self.gpx_index.points_examined
+
+        for name in ['timestamp_cache', 'gpx_index_cache']:
+            cache = getattr(self, name)
+            if cache is not None:
+                counts[name + '_hits'] = cache.hits
+                counts[name + '_misses'] = cache.misses
+
+    def run_profiled(self, function, *args, **kwargs):
+        """Returns function(*args, **kwargs), run under cProfile if
+        self.profile is set, in which case the profile is written to that
+        path for pstats. Only the calling thread is profiled."""
+        if self.profile is None:
+            return function(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args, **kwargs)
+        finally:
+            profiler.dump_stats(self.profile)
 
     # -------------------------------------------------------------------------
     # Actionable methods
     # -------------------------------------------------------------------------
 
-    def find_matches(self, content):
-        """finds GPX timestamp matches for the content passed in. Content can
-        be either 1) an image path string or 2) a list/dict of objects with a
-        timestamp property."""
-        gpx_data = self.gpx_datasets
-        gpx_matches = []
-        supported_file_extensions = [
-            '.jpg',
-            '.JPG',
-            '.jpg',
-            '.jpeg'
-        ]
-
-        def add_match(content, gpx_match):
-            if (gpx_match is not None):
-                gpx_matches.append({
-                    "content": content,
-                    "location": gpx_match
-                })
-
-        if isinstance(content, str):
-            # content is an image path.
-            abs_image_path = os.path.abspath(content)
-            images = os.listdir(os.path.abspath(content))
-
-            for image in images:
-                image_path = os.path.join(abs_image_path, image)
-                file_name, file_extension = os.path.splitext(image_path)
-
-                # only loop through supported files
-                if file_extension in supported_file_extensions:
-                    match = self.find_timestamp_gpx_match(
-                        self.get_image_timestamp(image_path),
-                        gpx_data,
-                        accuracyDelta=self.accuracy,
-                        offsetGpxDelta=self.offset_gpx,
-                        offsetImageDelta=self.offset_images)
-
-                    add_match(image, match)
+    def walk_images(self, folder):
+        """Yields (relative path, absolute path) for every supported image in
+        folder, sorted by name within each directory so the order does not
+        depend on the filesystem. Descends into subdirectories if
+        self.recursive. self.include and self.exclude are lists of fnmatch
+        patterns matched against relative paths; excluded directories are not
+        descended into."""
+        folder = os.path.abspath(folder)
+        directories = ['']
+
+        while directories:
+            directory = directories.pop()
+            entries = sorted(scan_dir(os.path.join(folder, directory)))
+            subdirectories = []
+            found = 0
+
+            if self.stats is not None:
+                files = sum(1 for name, is_dir in entries if not is_dir)
+                self.stats.count('images_scanned', files)
+                self.stats.count('images_skipped', files)
+
+            for name, is_dir in entries:
+                relative_path = os.path.join(directory, name)
+
+                if is_dir:
+                    if self.recursive and not self.is_excluded(relative_path):
+                        subdirectories.append(relative_path)
+                    continue
+
+                if not self.is_wanted_image(relative_path):
+                    continue
+
+                found += 1
+                yield relative_path, os.path.join(folder, relative_path)
+
+            if self.stats is not None:
+                self.stats.count('images_skipped', -found)
+
+            directories.extend(reversed(subdirectories))
+
+    def is_excluded(self, relative_path):
+        return any(fnmatch.fnmatch(relative_path, pattern)
+                   for pattern in self.exclude)
+
+    def is_wanted_image(self, relative_path):
+        """Whether a file, by its path relative to the image folder, is an
+        image walk_images yields if its folder is walked: a supported file
+        that is included, not excluded and in self.shard."""
+        # only loop through supported files
+        if os.path.splitext(relative_path)[1].lower() not in\
+                self.supported_file_extensions:
+            return False
+
+        if self.is_excluded(relative_path):
+            return False
+
+        if self.shard is not None and\
+                shard_of(relative_path, self.shard[1]) != self.shard[0]:
+            return False
+
+        return not self.include or any(
+            fnmatch.fnmatch(relative_path, pattern)
+            for pattern in self.include)
+
+    def select_images(self, folder, relative_paths):
+        """Yields (relative path, absolute path) for the files at
+        relative_paths in folder that walk_images would yield."""
+        folder = os.path.abspath(folder)
+
+        for relative_path in relative_paths:
+            directory = os.path.dirname(relative_path)
+            if directory and not self.recursive:
+                continue
+
+            # images in excluded folders are not wanted either
+            parents = []
+            while directory:
+                parents.append(directory)
+                directory = os.path.dirname(directory)
+
+            if not any(self.is_excluded(parent) for parent in parents) and\
+                    self.is_wanted_image(relative_path):
+                yield relative_path, os.path.join(folder, relative_path)
+
+    def iter_timestamps(self, content, names=None):
+        """Yields (item, localized timestamp) for the content passed in, as
+        iter_matches takes it: image names for an image folder path string,
+        or the objects of a list that have a timestamp property."""
+        for item, timestamp in self.iter_raw_timestamps(content, names):
+            yield item, self.localize_image_timestamp(timestamp)
+
+    def iter_raw_timestamps(self, content, names=None):
+        """iter_timestamps without the localization: timestamps are yielded
+        as they were read, naive ones in self.tz_images."""
+        if isinstance(content, string_types):
+            if names is None:
+                images = self.walk_images(content)
+            else:
+                images = self.select_images(content, names)
+            names = collections.deque()
+
+            def image_paths():
+                for name, path in images:
+                    names.append(name)
+                    yield path
+
+            for timestamp in self.read_image_timestamps(image_paths()):
+                name = names.popleft()
+                # files without a timestamp can't be matched
+                if timestamp is not None:
+                    yield name, timestamp
+                elif self.stats is not None:
+                    self.stats.count('images_no_timestamp')
 
         elif isinstance(content, list):
-            # content is a dict or list, no need for image exif parsing
+            # content is a list, no need for image exif parsing
             for item in content:
-                if 'timestamp' in item and isinstance(item['timestamp'], datetime.datetime):
-                    match = self.find_timestamp_gpx_match(
-                        self.localize_image_timestamp(item['timestamp']),
-                        gpx_data,
-                        accuracyDelta=self.accuracy,
-                        offsetGpxDelta=self.offset_gpx,
-                        offsetImageDelta=self.offset_images)
+                if 'timestamp' in item and\
+                        isinstance(item['timestamp'], datetime.datetime):
+                    yield item, item['timestamp']
+
+    def iter_matches(self, content, names=None):
+        """Yields a GPX timestamp match for the content passed in as soon as
+        it is found. Content can be either 1) an image folder path string or
+        2) a list of objects with a timestamp property. For a folder, names
+        can list the images (relative to it) to match instead of walking it.
+        Contents are matched against the index in small batches, so memory
+        use does not grow with the number of images."""
+        if isinstance(content, string_types):
+            batch_size = self.image_batch_size
+        else:
+            batch_size = self.list_batch_size
+
+        items = self.iter_raw_timestamps(content, names)
+        epochs = self.tz_images_converter.epochs
+
+        stats = self.stats
+
+        while True:
+            started = timer()
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                break
+
+            read = timer()
+            gpx_matches = self.find_epoch_gpx_matches(
+                epochs([timestamp for item, timestamp in batch]))
+
+            if stats is not None:
+                stats.add_time('read', read - started)
+                stats.add_time('match', timer() - read)
+                stats.count('images_read', len(batch))
+                stats.count('images_matched',
+                            len(gpx_matches) - gpx_matches.count(None))
+                self.collect_stats()
+
+            for (item, timestamp), gpx_match in zip(batch, gpx_matches):
+                if gpx_match is not None:
+                    yield {
+                        "content": item,
+                        "location": gpx_match
+                    }
+
+    def watch(self, folder, f, output_format='ndjson', interval=2.0,
+              polling=False, write_exif=False):
+        """Writes the matches of the images in folder to the file object f,
+        then keeps watching folder and appends the matches of images that
+        are added or changed, until interrupted (KeyboardInterrupt). Each new
+        image costs one timestamp read and one lookup. output_format is as
+        for the CLI. GeoJSON and GPX files are kept complete between
+        additions if f can seek. See FolderWatcher for interval and
+        polling. If write_exif, locations are written into the images too,
+        which doesn't count as changing them. Thumbnails are written as for
+        the CLI. Images that can't be read are reported on stderr and
+        skipped, so that one corrupt file doesn't end the watch."""
+        if output_format == 'gpx':
+            writer = GPXWriter(f, self.image_prefix)
+        else:
+            writer = GeoJSONWriter(f, self.image_prefix,
+                                   sequence=output_format == 'ndjson')
 
-                    add_match(item, match)
+        seekable = f is not sys.stdout and hasattr(f, 'seek')
+        # watch before the first walk, so nothing copied in meanwhile is
+        # missed
+        watcher = FolderWatcher(folder, self.recursive, interval, polling)
 
-        self.matches = gpx_matches
-        self.save_matches_as_gpxpy()
+        self.skip_unreadable = True
+        try:
+            matches = self.iter_matches(folder)
+
+            for names in itertools.chain([None], watcher.changes()):
+                if names is not None:
+                    matches = self.iter_matches(folder, names)
+                if write_exif:
+                    written = []
+                    matches = self.write_image_locations(folder, matches,
+                                                         written)
+                if self.thumbnails is not None:
+                    matches = self.write_thumbnails(folder, matches)
+                writer.write_all(matches)
+                if write_exif:
+                    watcher.ignore(written)
+
+                if seekable:
+                    writer.checkpoint()
+                else:
+                    f.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.skip_unreadable = False
+            watcher.close()
+            writer.close()
+
+        return writer.count
+
+    def write_image_locations(self, folder, matches, written=None):
+        """Writes the location of each of matches, of images in folder, into
+        the image's EXIF data (see write_jpeg_gps), on a pool if there is
+        more than one worker. Only JPEGs are written; RAW, HEIF, video and
+        XMP matches are passed on as they are. Yields every match as its
+        image is written. Images that can't be written are reported on
+        stderr; the relative paths of the ones written are appended to
+        written if it is given."""
+        pending = collections.deque()
+
+        def tasks():
+            for match in matches:
+                if os.path.splitext(match['content'])[1].lower() not in\
+                        PIL_EXTENSIONS:
+                    pending.append((match, False))
+                    yield None
+                    continue
+
+                pending.append((match, True))
+                location = match['location']
+                yield (os.path.join(folder, match['content']),
+                       location.latitude, location.longitude,
+                       location.elevation, location.time)
+
+        for error in self.read_image_files(tasks(), write_image_location):
+            match, jpeg = pending.popleft()
+            if error is not None:
+                sys.stderr.write('ERROR: ' + error + '\n')
+            elif jpeg:
+                if written is not None:
+                    written.append(match['content'])
+                if self.stats is not None:
+                    self.stats.count('images_written')
+            yield match
+
+    def write_thumbnails(self, folder, matches):
+        """Writes a thumbnail (see write_thumbnail) of the image of each of
+        matches, of images in folder, to the same relative path in
+        self.thumbnails, on a pool if there is more than one worker. Yields
+        the matches as their thumbnails are written, with the thumbnail's
+        path in 'thumbnail'. Matches of files PIL can't decode, and those
+        whose thumbnail can't be written (reported on stderr), have none."""
+        pending = collections.deque()
+
+        def tasks():
+            for match in matches:
+                name = match['content']
+                if os.path.splitext(name)[1].lower() not in\
+                        THUMBNAIL_EXTENSIONS:
+                    pending.append((match, None))
+                    yield None
+                    continue
+
+                thumbnail = os.path.join(self.thumbnails, thumbnail_name(name))
+                pending.append((match, thumbnail))
+                yield (os.path.join(folder, name), thumbnail,
+                       self.thumbnail_size)
+
+        for error in self.read_image_files(tasks(), write_thumbnail):
+            match, thumbnail = pending.popleft()
+            if error is not None:
+                sys.stderr.write('ERROR: ' + error + '\n')
+            elif thumbnail is not None:
+                match['thumbnail'] = thumbnail.replace(os.sep, '/')
+                if self.stats is not None:
+                    self.stats.count('images_thumbnailed')
+            yield match
+
+    def estimate_offset(self, content, offset_range=datetime.timedelta(hours=12),
+                        resolution=datetime.timedelta(seconds=1)):
+        """Estimates the camera clock offset of the content passed in (as for
+        find_matches). Timestamps are read once, then offsets up to
+        offset_range either side of self.offset_images are searched for the
+        one that matches the most of them to GPX points within
+        self.accuracy, closest in total. The search is coarse-to-fine: a
+        grid with the accuracy as its step finds every offset that matches
+        anything, then the grid around the best one is narrowed down to
+        resolution. Returns (offset_images, matches, count) where count is
+        the number of timestamps read."""
+        base = (self.offset_images - self.offset_gpx).total_seconds()
+        targets = array('d', sorted(
+            to_epoch(timestamp) + base
+            for item, timestamp in self.iter_timestamps(content)))
+
+        accuracy = self.accuracy.total_seconds()
+        resolution = max(resolution.total_seconds(), 1e-3)
+        low = -abs(offset_range.total_seconds())
+
+        # the coarsest step still lands within accuracy of any offset that
+        # matches, unless that takes too many steps.
+        step = max(accuracy, resolution, -2.0 * low / self.offset_steps)
+        offsets = [low + step * i for i in range(int(-2.0 * low / step) + 1)]
+
+        def score(offset):
+            matches, residual = self.gpx_index.offset_score(targets, accuracy,
+                                                            offset)
+            # most matches, then the closest, then the smallest offset
+            return matches, -residual, -abs(offset)
+
+        best = max(offsets, key=score)
+
+        while step > resolution:
+            center = best
+            step = max(step / 8.0, resolution)
+            offsets = [center + step * i for i in range(-8, 9)]
+            best = max(offsets + [center], key=score)
+
+        best = round(best / resolution) * resolution
+        matches = score(best)[0]
+
+        return (self.offset_images + datetime.timedelta(seconds=best),
+                matches, len(targets))
 
-        return gpx_matches
+    def find_matches(self, content):
+        """finds GPX timestamp matches for the content passed in. Content can
+        be either 1) an image path string or 2) a list/dict of objects with a
+        timestamp property."""
+        self.matches = self.run_profiled(list, self.iter_matches(content))
+        # the gpxpy waypoints of the matches are only built when asked for,
+        # by save_matches_as_gpxpy or to_xml
+        self.matches_gpxpy = None
+
+        return self.matches
 
 
 def main():
+    if sys.argv[1:2] == ['serve']:
+        # imported here, the server module imports GIL from this one
+        from GpxImageLinkifier.server import main as serve
+        return serve(sys.argv[2:])
+
+    if sys.argv[1:2] == ['merge']:
+        from GpxImageLinkifier.merge import main as merge
+        return merge(sys.argv[2:])
+
     args = GIL.parse_arguments()
+    if args.manifest is not None:
+        # imported here, the manifest module imports GIL from this one
+        from GpxImageLinkifier.manifest import run_manifest
+        defaults = dict((option, getattr(args, option))
+                        for option in JOB_DEFAULTS)
+        # jobs' own paths are relative to the manifest, this one isn't
+        if args.thumbnails is not None:
+            defaults['thumbnails'] = os.path.abspath(args.thumbnails)
+        return run_manifest(args.manifest,
+                            defaults=defaults,
+                            concurrency=args.jobs,
+                            cache_dir=args.cache_dir,
+                            stats=args.stats)
+
     GIL(gpx_path=args.gpx_path,
         image_folder=args.image_folder,
         image_prefix=args.image_prefix,
@@ -465,8 +1485,26 @@ def main():
         tz_images=args.tz_images,
         tz_gpx=args.tz_gpx,
         accuracy=args.accuracy,
+        compact=True,
+        workers=args.jobs,
+        cache_dir=args.cache_dir,
+        recursive=args.recursive,
+        include=args.include,
+        exclude=args.exclude,
+        estimate_offset=args.estimate_offset,
+        offset_range=args.offset_range,
+        interpolate=args.interpolate,
+        stats=args.stats,
+        profile=args.profile,
+        watch=args.watch,
+        watch_interval=args.watch_interval,
+        write_exif=args.write_exif,
+        shard=args.shard,
+        thumbnails=args.thumbnails,
+        thumbnail_size=args.thumbnail_size,
+        max_zoom=args.max_zoom,
         isCLI=True)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
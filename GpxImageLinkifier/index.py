@@ -0,0 +1,616 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import datetime
+import re
+
+import pytz
+
+from GpxImageLinkifier.timezones import DAY, EPOCH, EPOCH_ORDINAL,\
+    UtcConverter
+
+# numpy is optional, and slow to import, so it is imported by load_numpy the
+# first time it could be used. None once it turns out not to be installed.
+NOT_IMPORTED = object()
+numpy = NOT_IMPORTED
+
+# constants
+NAN = float('nan')
+INF = float('inf')
+GPX_TIME_EXPRESSION = re.compile(
+    r'\s*((\d{4})-(\d\d)-(\d\d))T(\d\d):(\d\d):(\d\d)(?:\.\d+)?Z\s*$')
+
+
+def load_numpy():
+    """Returns the numpy module, importing it on first use, or None if it
+    is not installed."""
+    global numpy
+    if numpy is NOT_IMPORTED:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+def to_epoch(ts):
+    """Converts a timezone-aware datetime to seconds since the UTC epoch."""
+    return (ts - EPOCH).total_seconds()
+
+
+def is_sorted(values):
+    return all(values[i] <= values[i + 1] for i in range(len(values) - 1))
+
+
+def sort_columns(columns):
+    """Stable sorts parallel columns by the first one. Columns of points are
+    lists, any other column is returned as an array('d')."""
+    times = columns[0]
+    order = sorted(range(len(times)), key=times.__getitem__)
+
+    return [[column[i] for i in order] if isinstance(column, list)
+            else array('d', [column[i] for i in order])
+            for column in columns]
+
+
+def numpy_column(column):
+    """Returns a column of numbers as a numpy array without copying it."""
+    if isinstance(column, numpy.ndarray):
+        return column
+    return numpy.frombuffer(column, dtype=numpy.float64)
+
+
+class GpxPoint(object):
+    """A lightweight GPX point returned by a compact GpxTimeIndex in place of
+    a gpxpy point. time is a UTC datetime."""
+
+    __slots__ = ('latitude', 'longitude', 'elevation', 'time')
+
+    def __init__(self, latitude, longitude, elevation=None, time=None):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.elevation = elevation
+        self.time = time
+
+    def __eq__(self, other):
+        return isinstance(other, GpxPoint) and\
+            (self.latitude, self.longitude, self.elevation, self.time) ==\
+            (other.latitude, other.longitude, other.elevation, other.time)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'GpxPoint(%r, %r, %r, %r)' % (self.latitude, self.longitude,
+                                             self.elevation, self.time)
+
+
+class GpxRun():
+    """The points of one track segment, or the waypoints of one dataset,
+    sorted by time. position is the position of the run's first point among
+    all the points of its GpxTimeIndex, in the order they were added. track
+    is False for waypoints, which are not positions along a path."""
+
+    def __init__(self, position, times, latitudes, longitudes, elevations,
+                 points=None, track=True):
+        self.position = position
+        self.track = track
+        self.times = times
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.elevations = elevations
+        self.points = points
+        self.start = float(times[0])
+        self.end = float(times[-1])
+        # the points a bisection of the run looks at
+        self.probes = len(times).bit_length()
+
+    def __len__(self):
+        return len(self.times)
+
+    def nearest(self, target):
+        """Returns (delta, i) for the point of the run closest to the epoch
+        time target. Ties go to the earlier point, and to the first of points
+        sharing a timestamp."""
+        times = self.times
+        i = bisect_left(times, target)
+
+        if i == 0:
+            return times[0] - target, 0
+
+        # first of any points sharing the preceding timestamp
+        before = bisect_left(times, times[i - 1], 0, i - 1)
+
+        if i < len(times) and times[i] - target < target - times[before]:
+            return times[i] - target, i
+
+        return target - times[before], before
+
+    def interpolate(self, target):
+        """Returns (gap, i, fraction) for the two points of the run
+        bracketing the epoch time target, times[i] < target < times[i + 1],
+        where gap is the time between them and fraction how far along it
+        target is. Returns None if target is not strictly between two
+        points."""
+        times = self.times
+        i = bisect_right(times, target)
+
+        if i == 0 or i == len(times) or times[i - 1] == target:
+            return None
+
+        gap = times[i] - times[i - 1]
+        return gap, i - 1, (target - times[i - 1]) / gap
+
+
+class GpxTimeIndex():
+    """GPX points indexed by their UTC epoch time, so that lookups are a
+    bisection instead of a walk over every point.
+
+    Points are kept in sorted runs, one per track segment plus one for the
+    waypoints of each dataset. An interval tree over the runs' [start, end]
+    bounds lets a lookup only search the runs near the target time, however
+    many datasets are loaded. Each run keeps times, latitudes, longitudes and
+    elevations as parallel columns (missing elevations are NaN). Unless
+    compact is True the original gpxpy points are kept too and returned by
+    point()."""
+
+    def __init__(self, tz=pytz.utc, compact=False):
+        self.tz = tz
+        self.converter = UtcConverter(tz)
+        self.compact = compact
+        self.runs = []
+        self.count = 0
+        self._run_positions = []
+        self._tree = None
+        self._merged = None
+        self._columns = None
+        self._run_firsts = None
+        self._day_epochs = {}
+        # lookups made, and the points their bisections looked at
+        self.lookups = 0
+        self.points_examined = 0
+
+    def __len__(self):
+        return self.count
+
+    # every point, merged into one timeline sorted by time.
+    times = property(lambda self: self.merged()[1])
+    latitudes = property(lambda self: self.merged()[2])
+    longitudes = property(lambda self: self.merged()[3])
+    elevations = property(lambda self: self.merged()[4])
+
+    def point_epoch(self, ts):
+        """localize a GPX timestamp to the GPX timezone and return its UTC
+        epoch time."""
+        return self.converter.epoch(ts)
+
+    def text_epoch(self, text):
+        """Parses a GPX timestamp like 2012-08-25T20:59:20.1530Z as a time in
+        the GPX timezone and returns its UTC epoch time. Fractional seconds
+        are dropped the way gpxpy drops them. Returns None for anything
+        else."""
+        match = GPX_TIME_EXPRESSION.match(text or '')
+        if match is None:
+            return None
+
+        parts = [int(part) for part in match.groups()[1:]]
+
+        # track points mostly share a date, so only do calendar and timezone
+        # math once a day. Days the UTC offset changes on are False, and
+        # converted one timestamp at a time.
+        day = match.group(1)
+        day_epoch = self._day_epochs.get(day)
+        if day_epoch is None:
+            ordinal = datetime.date(*parts[:3]).toordinal()
+            offset = self.converter.day_offset(ordinal)
+            day_epoch = False if offset is None else\
+                (ordinal - EPOCH_ORDINAL) * DAY - offset
+            self._day_epochs[day] = day_epoch
+
+        if day_epoch is False:
+            return self.point_epoch(datetime.datetime(*parts))
+        return float(day_epoch + parts[3] * 3600 + parts[4] * 60 + parts[5])
+
+    def point(self, position):
+        """Returns the point at position, as the original gpxpy point or as
+        a GpxPoint when compact."""
+        run = self.runs[bisect_right(self._run_positions, position) - 1]
+        i = position - run.position
+
+        if run.points is not None:
+            return run.points[i]
+
+        elevation = float(run.elevations[i])
+        return GpxPoint(float(run.latitudes[i]), float(run.longitudes[i]),
+                        None if elevation != elevation else elevation,
+                        EPOCH + datetime.timedelta(
+                            seconds=float(run.times[i])))
+
+    def points(self, positions):
+        """Batch version of point: returns the point at each of positions, or
+        None for a None position. The GpxPoints of a compact index are built
+        from numpy columns when it is installed, once per distinct position:
+        like the gpxpy points of other indexes, repeats share one."""
+        if load_numpy() is None or not self.compact or\
+                any(run.points is not None for run in self.runs):
+            return [None if position is None else self.point(position)
+                    for position in positions]
+
+        found = [position for position in positions if position is not None]
+        if not found:
+            return [None] * len(positions)
+
+        distinct, order = numpy.unique(numpy.array(found, dtype=numpy.intp),
+                                       return_inverse=True)
+        times, latitudes, longitudes, elevations = [
+            column[distinct].tolist() for column in self.columns()]
+
+        epoch = EPOCH
+        timedelta = datetime.timedelta
+        points = [GpxPoint(latitude, longitude,
+                           None if elevation != elevation else elevation,
+                           epoch + timedelta(seconds=time))
+                  for time, latitude, longitude, elevation in zip(
+                      times, latitudes, longitudes, elevations)]
+        built = iter([points[i] for i in order.tolist()])
+        return [None if position is None else next(built)
+                for position in positions]
+
+    def add_gpx(self, data):
+        """Indexes the track points and waypoints of a gpxpy.gpx.GPX object,
+        one run per track segment and one for the waypoints."""
+
+        def add_run(points, track=True):
+            points = [point for point in points if point.time is not None]
+            self.add_run(
+                array('d', self.converter.epochs(
+                    point.time for point in points)),
+                array('d', [point.latitude for point in points]),
+                array('d', [point.longitude for point in points]),
+                array('d', [NAN if point.elevation is None
+                            else point.elevation for point in points]),
+                None if self.compact else points, track=track)
+
+        for track in data.tracks:
+            for segment in track.segments:
+                add_run(segment.points)
+
+        add_run(data.waypoints, track=False)
+
+    def add_gpx_file(self, path, cache=None):
+        """Indexes the track points and waypoints of a GPX file without
+        building a gpxpy.gpx.GPX object. Elements are parsed incrementally and
+        discarded as soon as they are read, so memory does not grow with the
+        size of the XML. If a GpxIndexCache is given, a compiled index of the
+        file is used instead when there is one, and saved when there isn't.
+        Only for compact indexes."""
+        if cache is not None:
+            runs = cache.load(path, self.tz.zone)
+            if runs is not None:
+                for columns, track in runs:
+                    self.add_run(*columns, presorted=True, track=track)
+                return
+
+        # lxml takes a while to import, and cached files don't need it
+        from lxml import etree
+
+        def new_columns():
+            return (array('d'), array('d'), array('d'), array('d'))
+
+        runs = []
+        track_columns = new_columns()
+        waypoint_columns = new_columns()
+
+        for event, element in etree.iterparse(
+                path, events=('end',),
+                tag=('{*}trkpt', '{*}wpt', '{*}trkseg')):
+            name = element.tag.rpartition('}')[2]
+
+            if name == 'trkseg':
+                runs.append(track_columns)
+                track_columns = new_columns()
+            else:
+                epoch = None
+                elevation = NAN
+
+                for child in element:
+                    child_name = child.tag.rpartition('}')[2]
+                    if child_name == 'time':
+                        epoch = self.text_epoch(child.text)
+                    elif child_name == 'ele' and child.text:
+                        elevation = float(child.text)
+
+                if epoch is not None:
+                    times, latitudes, longitudes, elevations =\
+                        track_columns if name == 'trkpt' else waypoint_columns
+                    times.append(epoch)
+                    latitudes.append(float(element.get('lat')))
+                    longitudes.append(float(element.get('lon')))
+                    elevations.append(elevation)
+
+            # drop the element and everything parsed before it
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+        # track points before waypoints, the same order add_gpx uses.
+        runs = [(columns, True) for columns in runs]
+        runs.append((track_columns, True))
+        runs.append((waypoint_columns, False))
+        runs = [(columns if is_sorted(columns[0]) else sort_columns(columns),
+                 track)
+                for columns, track in runs if len(columns[0]) > 0]
+
+        if cache is not None:
+            cache.save(path, self.tz.zone, runs)
+
+        for columns, track in runs:
+            self.add_run(*columns, presorted=True, track=track)
+
+    def add_run(self, times, latitudes, longitudes, elevations, points=None,
+                presorted=False, track=True):
+        """Adds a run of points, given as parallel columns. The run is sorted
+        (stably) unless presorted is True; columns that need no sorting are
+        kept as they are, so memory-mapped columns stay mapped. track is
+        False for a run of waypoints."""
+        if len(times) == 0:
+            return
+
+        if not presorted and not is_sorted(times):
+            columns = [times, latitudes, longitudes, elevations]
+            if points is not None:
+                columns.append(list(points))
+            columns = sort_columns(columns)
+            times, latitudes, longitudes, elevations = columns[:4]
+            if points is not None:
+                points = columns[4]
+
+        self.runs.append(GpxRun(self.count, times, latitudes, longitudes,
+                                elevations, points, track))
+        self._run_positions.append(self.count)
+        self.count += len(times)
+        self._tree = None
+        self._merged = None
+        self._columns = None
+        self._run_firsts = None
+
+    def add_index(self, other):
+        """Adds the runs of another compact index, sharing their columns
+        rather than copying them."""
+        for run in other.runs:
+            self.add_run(run.times, run.latitudes, run.longitudes,
+                         run.elevations, presorted=True, track=run.track)
+
+    def overlapping_runs(self, low, high):
+        """Returns the runs whose [start, end] overlaps [low, high]."""
+        if self._tree is None:
+            self.build_tree()
+
+        order, starts, tree, size = self._tree
+        limit = bisect_right(starts, high)
+        runs = []
+
+        # walk down from the root, skipping subtrees that start after high
+        # or end before low.
+        stack = [(1, 0, size)]
+        while stack:
+            node, node_low, node_high = stack.pop()
+            if node_low >= limit or tree[node] < low:
+                continue
+            if node >= size:
+                runs.append(order[node - size])
+            else:
+                middle = (node_low + node_high) // 2
+                stack.append((2 * node + 1, middle, node_high))
+                stack.append((2 * node, node_low, middle))
+
+        return runs
+
+    def build_tree(self):
+        """Builds the interval tree over run bounds: runs sorted by start,
+        with a binary tree of the latest end below each node."""
+        order = sorted(self.runs, key=lambda run: run.start)
+        size = 1
+        while size < len(order):
+            size *= 2
+
+        tree = [float('-inf')] * (2 * size)
+        for i, run in enumerate(order):
+            tree[size + i] = run.end
+        for node in range(size - 1, 0, -1):
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+
+        self._tree = (order, [run.start for run in order], tree, size)
+
+    def nearest(self, target, accuracy):
+        """Returns the position of the point closest to the epoch time
+        target, or None if no point is strictly within accuracy seconds of
+        it. Ties go to the earlier point, then to the first added."""
+        best = None
+        self.lookups += 1
+
+        for run in self.overlapping_runs(target - accuracy, target + accuracy):
+            self.points_examined += run.probes
+            delta, i = run.nearest(target)
+            key = (delta, run.times[i], run.position + i)
+            if best is None or key < best:
+                best = key
+
+        if best is None or best[0] >= accuracy:
+            return None
+
+        return best[2]
+
+    def interpolate(self, target, accuracy):
+        """Returns a GpxPoint at the epoch time target, linearly interpolated
+        between the two track points bracketing it, if both are strictly
+        within accuracy seconds of it. The closest pair wins if several
+        segments bracket target. Otherwise returns the nearest point, as
+        point() would, or None if no point is within accuracy."""
+        best = None
+
+        for run in self.overlapping_runs(target - accuracy, target + accuracy):
+            if not run.track:
+                continue
+
+            self.points_examined += run.probes
+            bracket = run.interpolate(target)
+            if bracket is None:
+                continue
+
+            gap, i, fraction = bracket
+            if target - run.times[i] < accuracy and\
+                    run.times[i + 1] - target < accuracy and\
+                    (best is None or gap < best[0]):
+                best = (gap, run, i, fraction)
+
+        if best is None:
+            position = self.nearest(target, accuracy)
+            return None if position is None else self.point(position)
+
+        self.lookups += 1
+        gap, run, i, fraction = best
+
+        def between(column):
+            start = float(column[i])
+            return start + (float(column[i + 1]) - start) * fraction
+
+        latitude = between(run.latitudes)
+        longitude = between(run.longitudes)
+        elevation = between(run.elevations)
+
+        # take the short way across the antimeridian
+        if abs(run.longitudes[i + 1] - run.longitudes[i]) > 180:
+            start = float(run.longitudes[i])
+            end = float(run.longitudes[i + 1])
+            end += 360 if end < start else -360
+            longitude = (start + (end - start) * fraction + 180) % 360 - 180
+
+        return GpxPoint(latitude, longitude,
+                        None if elevation != elevation else elevation,
+                        EPOCH + datetime.timedelta(seconds=target))
+
+    def interpolate_many(self, targets, accuracy, offset=0.0):
+        """Batch version of interpolate. Adds offset seconds to every epoch
+        time in targets and returns a list of points (or None for no
+        match)."""
+        return [self.interpolate(target + offset, accuracy)
+                for target in targets]
+
+    def columns(self):
+        """Returns (times, latitudes, longitudes, elevations) of every point,
+        in position order, as numpy arrays. Built on first use after runs
+        are added; needs numpy."""
+        if self._columns is None:
+            self._columns = [
+                numpy.concatenate([numpy_column(getattr(run, name))
+                                   for run in self.runs])
+                if self.runs else numpy.zeros(0)
+                for name in ('times', 'latitudes', 'longitudes',
+                             'elevations')]
+
+        return self._columns
+
+    def merged(self):
+        """Returns (positions, times, latitudes, longitudes, elevations) of
+        every point, stable sorted by time into one timeline. Built on first
+        use after runs are added."""
+        if self._merged is not None:
+            return self._merged
+
+        if load_numpy() is not None:
+            columns = self.columns()
+            positions = numpy.argsort(columns[0], kind='mergesort')
+            self._merged = [positions] + [column[positions]
+                                          for column in columns]
+        else:
+            concatenated = []
+            for name in ('times', 'latitudes', 'longitudes', 'elevations'):
+                column = array('d')
+                for run in self.runs:
+                    column.extend(getattr(run, name))
+                concatenated.append(column)
+            positions = sorted(range(self.count),
+                               key=concatenated[0].__getitem__)
+            self._merged = [positions] + [
+                array('d', [column[i] for i in positions])
+                for column in concatenated]
+
+        return self._merged
+
+    def nearest_many(self, targets, accuracy, offset=0.0):
+        """Batch version of nearest. Adds offset seconds to every epoch time in
+        targets and returns a list of point positions (or None for no match).
+        Uses numpy, on the merged timeline, when it is installed."""
+        if load_numpy() is None or self.count == 0:
+            return [self.nearest(target + offset, accuracy)
+                    for target in targets]
+
+        positions, times = self.merged()[:2]
+
+        if self._run_firsts is None:
+            # index of the first point sharing each point's timestamp
+            run_starts = numpy.ones(len(times), dtype=bool)
+            run_starts[1:] = times[1:] != times[:-1]
+            self._run_firsts = numpy.maximum.accumulate(
+                numpy.where(run_starts, numpy.arange(len(times)), 0))
+
+        count = len(times)
+        targets = numpy.asarray(targets, dtype=numpy.float64) + offset
+        self.lookups += len(targets)
+        self.points_examined += len(targets) * count.bit_length()
+
+        after = numpy.searchsorted(times, targets, side='left')
+        before = self._run_firsts[numpy.clip(after - 1, 0, count - 1)]
+        after_clipped = numpy.clip(after, 0, count - 1)
+
+        delta_before = numpy.where(after > 0, targets - times[before],
+                                   numpy.inf)
+        delta_after = numpy.where(after < count,
+                                  times[after_clipped] - targets, numpy.inf)
+
+        use_after = delta_after < delta_before
+        best = positions[numpy.where(use_after, after_clipped, before)]
+        found = numpy.minimum(delta_before, delta_after) < accuracy
+
+        best = best.astype(object)
+        best[~found] = None
+        return best.tolist()
+
+    def offset_score(self, targets, accuracy, offset=0.0):
+        """Returns (matches, residual) for the epoch times in targets shifted
+        by offset seconds: how many are strictly within accuracy seconds of a
+        point, and the sum of their distances to the nearest point."""
+        times = self.merged()[1]
+        count = len(times)
+
+        if count == 0:
+            return 0, 0.0
+
+        if load_numpy() is not None:
+            if not isinstance(targets, (array, numpy.ndarray)):
+                targets = array('d', targets)
+            targets = numpy_column(targets) + offset
+            after = numpy.searchsorted(times, targets)
+            deltas = numpy.minimum(
+                numpy.where(after > 0,
+                            targets - times[numpy.maximum(after - 1, 0)],
+                            numpy.inf),
+                numpy.where(after < count,
+                            times[numpy.minimum(after, count - 1)] - targets,
+                            numpy.inf))
+            deltas = deltas[deltas < accuracy]
+            return len(deltas), float(deltas.sum())
+
+        matches = 0
+        residual = 0.0
+        for target in targets:
+            target += offset
+            after = bisect_left(times, target)
+            delta = min(target - times[after - 1] if after > 0 else INF,
+                        times[after] - target if after < count else INF)
+            if delta < accuracy:
+                matches += 1
+                residual += delta
+
+        return matches, residual
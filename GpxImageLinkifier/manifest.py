@@ -0,0 +1,173 @@
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer as timer
+import json
+import os
+import sys
+
+import pytz
+
+from GpxImageLinkifier.cache import GpxIndexCache
+from GpxImageLinkifier.exif import replace
+from GpxImageLinkifier.gil import GIL
+from GpxImageLinkifier.index import GpxTimeIndex
+
+# the GIL keyword arguments a job can set
+JOB_OPTIONS = ('gpx_path', 'image_folder', 'output_path', 'output_format',
+               'offset_gpx', 'offset_images', 'accuracy', 'tz_images',
+               'tz_gpx', 'image_prefix', 'recursive', 'include', 'exclude',
+               'interpolate', 'write_exif', 'thumbnails', 'thumbnail_size',
+               'shard', 'max_zoom', 'workers')
+PATH_OPTIONS = ('image_folder', 'output_path')
+
+
+def native_path(path):
+    """Returns path as a native str. On Python 2 the unicode strings of the
+    manifest are encoded to the file system encoding (or UTF-8, if it can't
+    encode them, as under LANG=C), so that folder scans yield byte strings
+    whatever the locale, like they do for paths from the command line."""
+    if not isinstance(path, str):
+        try:
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+        except UnicodeEncodeError:
+            path = path.encode('utf-8')
+    return path
+
+
+def read_manifest(path, defaults=None):
+    """Reads the jobs in the JSON manifest at path: a list of objects of GIL
+    keyword arguments, which override defaults. Relative paths are relative
+    to the manifest, paths (and image_prefix, which is joined to them) are
+    native strings, and each job's gpx_path becomes a list. Raises
+    ValueError if a job is incomplete or sets anything else."""
+    with open(path) as f:
+        entries = json.load(f)
+
+    if not isinstance(entries, list):
+        raise ValueError('%s is not a list of jobs' % path)
+
+    folder = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for number, entry in enumerate(entries, 1):
+        unknown = sorted(set(entry) - set(JOB_OPTIONS))
+        if unknown:
+            raise ValueError('Job %d: unknown options %s' %
+                             (number, ', '.join(unknown)))
+
+        missing = [option for option in ('gpx_path',) + PATH_OPTIONS
+                   if option not in entry]
+        if missing:
+            raise ValueError('Job %d: missing %s' %
+                             (number, ', '.join(missing)))
+
+        job = dict(defaults or {})
+        job.update(entry)
+
+        gpx_paths = job['gpx_path']
+        if not isinstance(gpx_paths, list):
+            gpx_paths = [gpx_paths]
+        job['gpx_path'] = [native_path(os.path.join(folder, gpx_path))
+                           for gpx_path in gpx_paths]
+        for option in PATH_OPTIONS:
+            job[option] = native_path(os.path.join(folder, job[option]))
+        if job.get('thumbnails') is not None:
+            job['thumbnails'] = native_path(
+                os.path.join(folder, job['thumbnails']))
+        if job.get('image_prefix') is not None:
+            job['image_prefix'] = native_path(job['image_prefix'])
+
+        jobs.append(job)
+
+    return jobs
+
+
+def load_gpx_index(path, tz='UTC', cache_dir=None):
+    """Returns a compact GpxTimeIndex of the GPX file at path."""
+    index = GpxTimeIndex(pytz.timezone(tz), compact=True)
+    cache = GpxIndexCache(cache_dir) if cache_dir is not None else None
+    index.add_gpx_file(path, cache)
+    return index
+
+
+def run_manifest(path, defaults=None, concurrency=1, cache_dir=None,
+                 stats=False):
+    """Runs the jobs in the manifest at path (see read_manifest) like the
+    command line would, concurrency of them at once. Every distinct GPX file
+    is parsed once, before any job runs, and jobs share the indexes. Errors
+    are reported per job, and a job that fails leaves no output file behind:
+    jobs write to a temporary file next to their output_path and rename it
+    when they are done. Returns the number of jobs that failed."""
+    started = timer()
+    try:
+        jobs = read_manifest(path, defaults)
+    except (IOError, ValueError) as e:
+        sys.stderr.write('ERROR: %s\n' % e)
+        return 1
+
+    pool = ThreadPool(max(1, concurrency))
+    try:
+        keys = sorted(set((gpx_path, job.get('tz_gpx') or 'UTC')
+                          for job in jobs for gpx_path in job['gpx_path']))
+
+        def load(key):
+            try:
+                return load_gpx_index(key[0], key[1], cache_dir)
+            except Exception as e:
+                return e
+
+        indexes = dict(zip(keys, pool.map(load, keys)))
+
+        def run(numbered_job):
+            number, job = numbered_job
+            # tiles are written to a folder, the other formats to a file
+            partial = None
+            if job.get('output_format') != 'tiles':
+                partial = '%s.%d.partial' % (job['output_path'], os.getpid())
+            try:
+                tz = job.get('tz_gpx') or 'UTC'
+                job_indexes = [indexes[(gpx_path, tz)]
+                               for gpx_path in job['gpx_path']]
+                for index in job_indexes:
+                    if isinstance(index, Exception):
+                        raise index
+
+                if len(job_indexes) == 1:
+                    gpx_index = job_indexes[0]
+                else:
+                    gpx_index = GpxTimeIndex(pytz.timezone(tz), compact=True)
+                    for index in job_indexes:
+                        gpx_index.add_index(index)
+
+                options = dict(job, gpx_path=gpx_index)
+                if partial is not None:
+                    options['output_path'] = partial
+                gil = GIL(compact=True, cache_dir=cache_dir, isCLI=True,
+                          **options)
+                # bad options are reported, not raised, by GIL
+                if gil.errors:
+                    raise ValueError('; '.join(gil.errors))
+                if partial is not None:
+                    replace(partial, job['output_path'])
+            except Exception as e:
+                sys.stderr.write('ERROR: job %d: %s\n' % (number, e))
+                if partial is not None and os.path.exists(partial):
+                    os.remove(partial)
+                return False
+
+            return True
+
+        results = pool.map(run, enumerate(jobs, 1))
+    finally:
+        pool.terminate()
+
+    failed = results.count(False)
+    if stats:
+        seconds = timer() - started
+        sys.stderr.write(json.dumps({
+            'jobs': len(jobs),
+            'failed': failed,
+            'gpx_files': len(keys),
+            'seconds': round(seconds, 6),
+            'jobs_per_second': round(len(jobs) / seconds, 2),
+        }, indent=4, sort_keys=True, separators=(',', ': ')) + '\n')
+
+    return failed
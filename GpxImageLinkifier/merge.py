@@ -0,0 +1,171 @@
+import argparse
+import heapq
+import itertools
+import json
+import os
+import re
+import sys
+from xml.sax.saxutils import unescape
+
+from GpxImageLinkifier.writers import GeoJSONWriter, GPXWriter
+
+GPX_NAME_EXPRESSION = re.compile(r'<name>(.*)</name>')
+
+
+def content_key(content):
+    """Sorts image paths (relative to the image folder, maybe prefixed) in
+    the order GIL.walk_images yields them: by name within each folder, files
+    before subfolders."""
+    parts = content.replace(os.sep, '/').split('/')
+    return [(1, part) for part in parts[:-1]] + [(0, parts[-1])]
+
+
+def geojson_features(lines):
+    """Yields (sort key, line) for the feature lines of GeoJSON or NDJSON
+    output, without the commas between features."""
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line == GeoJSONWriter.tail.strip():
+            return
+        if line.endswith(','):
+            line = line[:-1]
+        if not line:
+            continue
+
+        try:
+            content = json.loads(line)['properties']['content']
+        except (ValueError, KeyError, TypeError):
+            raise ValueError('Not a feature line: %s' % line[:80])
+        yield content_key(content), line
+
+
+def gpx_features(lines):
+    """Yields (sort key, line) for the <wpt> lines of GPX output."""
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line == GPXWriter.tail.strip():
+            return
+
+        match = GPX_NAME_EXPRESSION.search(line)
+        if not line.startswith('<wpt') or match is None:
+            raise ValueError('Not a waypoint line: %s' % line[:80])
+        yield content_key(unescape(match.group(1))), line
+
+
+def read_part(f):
+    """Returns the format of the gil output in the file object f (geojson,
+    ndjson, gpx, or None if it is empty) and an iterator of (sort key, line)
+    over its matches, one per line as gil writes them."""
+    first = f.readline()
+    if not first:
+        return None, iter([])
+
+    if first == GPXWriter.header.splitlines(True)[0]:
+        # the rest of the header is the <gpx> element
+        f.readline()
+        return 'gpx', gpx_features(f)
+
+    if first == GeoJSONWriter.header:
+        return 'geojson', geojson_features(f)
+
+    return 'ndjson', geojson_features(itertools.chain([first], f))
+
+
+def numbered(features, number):
+    """Adds the part number to the (sort key, line) pairs of a part, to break
+    ties so that lines are never compared."""
+    for key, line in features:
+        yield key, number, line
+
+
+def merge_outputs(paths, f):
+    """Merges the gil outputs at paths, like those of the shards of one run,
+    into the file object f, in the order a single run would have written
+    them. Each part has to be in walk order already, as gil writes it; only
+    one line of each is held in memory. Returns the number of matches.
+    Raises ValueError if the parts are of different formats or are not
+    gil's line-per-match output."""
+    files = []
+    streams = []
+    try:
+        formats = set()
+        for number, path in enumerate(paths):
+            files.append(open(path))
+            output_format, features = read_part(files[-1])
+            if output_format is not None:
+                formats.add(output_format)
+
+            streams.append(numbered(features, number))
+
+        if len(formats) > 1:
+            raise ValueError('Parts are of different formats: %s' %
+                             ', '.join(sorted(formats)))
+        output_format = formats.pop() if formats else 'ndjson'
+
+        if output_format == 'geojson':
+            f.write(GeoJSONWriter.header)
+        elif output_format == 'gpx':
+            f.write(GPXWriter.header)
+
+        count = 0
+        for key, number, line in heapq.merge(*streams):
+            if output_format == 'geojson':
+                f.write((count and ',\n' or '') + line)
+            else:
+                f.write(line + '\n')
+            count += 1
+
+        if output_format == 'geojson':
+            f.write(GeoJSONWriter.tail)
+        elif output_format == 'gpx':
+            f.write(GPXWriter.tail)
+        f.flush()
+
+        return count
+    finally:
+        for part in files:
+            part.close()
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='gil merge',
+        description='''Merges the outputs of "gil --shard" runs into one, in
+the order a single run would have written it. Reads one line of each output at
+a time.''',
+    )
+
+    parser.add_argument('parts',
+                        type=str,
+                        nargs='+',
+                        help='''The geojson, ndjson or gpx outputs to merge,
+all of the same format.'''
+                        )
+
+    parser.add_argument('--output-path',
+                        '-o',
+                        type=str,
+                        help='Output file path. Defaults to stdout.'
+                        )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    if args.output_path is None:
+        f = sys.stdout
+    else:
+        f = open(args.output_path, 'w')
+
+    try:
+        merge_outputs(args.parts, f)
+    except (IOError, ValueError) as e:
+        sys.stderr.write('ERROR: %s\n' % e)
+        return 1
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    return 0
@@ -0,0 +1,361 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import pytz
+
+from GpxImageLinkifier.gil import GIL
+from GpxImageLinkifier.index import EPOCH
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+
+TIMESTAMP_EXPRESSION = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d+))?'
+    r'(Z|[+-]\d\d:?\d\d)?$')
+
+
+def parse_timestamp(text):
+    """Parses an ISO 8601 timestamp like 2012-08-25T20:59:20, with optional
+    fractional seconds and a Z or +hh:mm suffix. Returns a naive datetime,
+    or a UTC one if the timestamp had a timezone. Raises ValueError for
+    anything else."""
+    match = TIMESTAMP_EXPRESSION.match(text.strip())
+    if match is None:
+        raise ValueError('Bad timestamp: %s' % text)
+
+    parts = [int(part) for part in match.groups()[:6]]
+    fraction = match.group(7)
+    microseconds = int((fraction + '000000')[:6]) if fraction else 0
+    ts = datetime.datetime(*parts, microsecond=microseconds)
+
+    zone = match.group(8)
+    if zone is None:
+        return ts
+    if zone != 'Z':
+        sign = -1 if zone[0] == '-' else 1
+        zone = zone[1:].replace(':', '')
+        ts -= sign * datetime.timedelta(hours=int(zone[:2]),
+                                        minutes=int(zone[2:]))
+    return pytz.utc.localize(ts)
+
+
+def gpx_files(paths):
+    """Returns the GPX files at paths, which are files or folders of .gpx
+    files, sorted within each folder."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name)
+                         for name in sorted(os.listdir(path))
+                         if name.lower().endswith('.gpx'))
+        else:
+            files.append(path)
+    return files
+
+
+class LookupService():
+    """Keeps the GPX files at paths (files, or folders of .gpx files) loaded
+    in a compact GIL built with options, and answers lookups against it from
+    any number of threads. reload() rebuilds the GIL if files were added,
+    changed or removed, and swaps it in once it is ready, so lookups never
+    wait on a reload."""
+
+    def __init__(self, paths, **options):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.options = options
+        self.lock = threading.Lock()
+        self.signature = None
+        self.gil = None
+        self.loaded = None
+        self.lookups = 0
+        self.reload()
+
+    def files_signature(self):
+        signature = []
+        for path in gpx_files(self.paths):
+            stat = os.stat(path)
+            signature.append((path, stat.st_size, stat.st_mtime))
+        return signature
+
+    def reload(self):
+        """Loads the GPX files again if they changed. Returns True if they
+        were."""
+        with self.lock:
+            signature = self.files_signature()
+            if signature == self.signature:
+                return False
+
+            gil = GIL(compact=True, **self.options)
+            for path, size, mtime in signature:
+                gil.add_gpx_data(path)
+
+            # build the lookup structures now rather than on the first lookup
+            gil.find_timestamp_gpx_matches([EPOCH])
+
+            self.gil = gil
+            self.signature = signature
+            self.loaded = time.time()
+            return True
+
+    def lookup(self, timestamps):
+        """Returns the location of each timestamp string, as a dict, or None
+        where there is no match."""
+        gil = self.gil
+        targets = []
+        for text in timestamps:
+            ts = parse_timestamp(text)
+            if ts.tzinfo is None:
+                ts = gil.localize_image_timestamp(ts)
+            targets.append(ts)
+
+        self.lookups += len(targets)
+        return [None if point is None else {
+            'latitude': point.latitude,
+            'longitude': point.longitude,
+            'elevation': point.elevation,
+            'time': point.time.strftime('%Y-%m-%dT%H:%M:%SZ')
+            if point.time is not None else None,
+        } for point in gil.find_timestamp_gpx_matches(targets)]
+
+    def status(self):
+        return {
+            'files': [path for path, size, mtime in self.signature],
+            'points': self.gil.gpx_index.count,
+            'loaded': datetime.datetime.utcfromtimestamp(
+                self.loaded).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'lookups': self.lookups,
+        }
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    """HTTP/JSON interface of a LookupService:
+
+    POST /lookup with {"timestamps": ["2012-08-25T20:59:20", ...]} returns
+    {"locations": [{"latitude": ..., "longitude": ..., "elevation": ...,
+    "time": ...} or null, ...]}, one per timestamp. Timestamps without a
+    timezone are in the service's --tz-images.
+
+    POST /reload loads the GPX files again if they changed, and GET /status
+    describes what is loaded."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, self.server.service.status())
+        else:
+            self.send_json(404, {'error': 'Not found: %s' % self.path})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+
+        if self.path == '/reload':
+            self.send_json(200, {'reloaded': self.server.service.reload()})
+            return
+
+        if self.path != '/lookup':
+            self.send_json(404, {'error': 'Not found: %s' % self.path})
+            return
+
+        try:
+            timestamps = json.loads(body.decode('utf-8'))['timestamps']
+            if not isinstance(timestamps, list):
+                raise ValueError('timestamps must be a list')
+            locations = self.server.service.lookup(timestamps)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+
+        self.send_json(200, {'locations': locations})
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    quiet = False
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    quiet = False
+
+    def get_request(self):
+        request, client_address = UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('unix', 0)
+
+
+def make_server(service, host='127.0.0.1', port=8042, socket_path=None,
+                quiet=False):
+    """Returns a threading HTTP server for service on host:port, or on the
+    Unix socket at socket_path if it is given. Call serve_forever() on
+    it."""
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, LookupHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), LookupHandler)
+
+    server.service = service
+    server.quiet = quiet
+    return server
+
+
+def reload_periodically(service, interval):
+    """Reloads service every interval seconds, on a daemon thread."""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                service.reload()
+            except Exception as e:
+                sys.stderr.write('ERROR: reload failed: %s\n' % e)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='gil serve',
+        description='''Serves GPX timestamp lookups over HTTP/JSON, keeping the
+GPX data loaded between requests. POST {"timestamps": [...]} to /lookup to get
+the location of each timestamp.''',
+    )
+
+    parser.add_argument('gpx_paths',
+                        type=str,
+                        nargs='+',
+                        help='''GPX files, or folders of .gpx files, to serve.
+Files added to the folders are loaded on reload.'''
+                        )
+
+    parser.add_argument('--host',
+                        type=str,
+                        help='The address to listen on. Defaults to 127.0.0.1.',
+                        default='127.0.0.1'
+                        )
+
+    parser.add_argument('--port',
+                        '-p',
+                        type=int,
+                        help='The port to listen on. Defaults to 8042.',
+                        default=8042
+                        )
+
+    parser.add_argument('--socket',
+                        type=str,
+                        help='''Listen on a Unix socket at this path instead
+of a port.'''
+                        )
+
+    parser.add_argument('--reload-interval',
+                        type=float,
+                        help='''Check the GPX files for changes this often, in
+seconds, and reload them if they changed. 0 only reloads on POST /reload.
+Defaults to 5.''',
+                        default=5.0
+                        )
+
+    parser.add_argument('--accuracy',
+                        '-a',
+                        type=str,
+                        help='The timeframe that determines a positive match.\
+                        Defaults to 1m.',
+                        default='1m'
+                        )
+
+    parser.add_argument('--offset-gpx',
+                        type=str,
+                        help='The amount of time to ADD to GPX timestamps.',
+                        default='0s'
+                        )
+
+    parser.add_argument('--offset-images',
+                        type=str,
+                        help='The amount of time to ADD to looked up timestamps.',
+                        default='0s'
+                        )
+
+    parser.add_argument('--tz-images',
+                        type=str,
+                        help='''The timezone of looked up timestamps that do
+not have one.''',
+                        default='UTC'
+                        )
+
+    parser.add_argument('--tz-gpx',
+                        type=str,
+                        help='The timezone the GPX timestamps are in.',
+                        default='UTC'
+                        )
+
+    parser.add_argument('--interpolate',
+                        '-i',
+                        action='store_true',
+                        help='''Interpolate between the track points around
+each timestamp.'''
+                        )
+
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        help='A directory to cache compiled GPX indexes in.'
+                        )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    service = LookupService(args.gpx_paths,
+                            accuracy=args.accuracy,
+                            offset_gpx=args.offset_gpx,
+                            offset_images=args.offset_images,
+                            tz_images=args.tz_images,
+                            tz_gpx=args.tz_gpx,
+                            interpolate=args.interpolate,
+                            cache_dir=args.cache_dir)
+
+    if args.reload_interval > 0:
+        reload_periodically(service, args.reload_interval)
+
+    server = make_server(service, args.host, args.port, args.socket)
+    sys.stderr.write('Serving %d GPX points on %s\n' % (
+        service.gil.gpx_index.count,
+        args.socket or '%s:%d' % (args.host, args.port)))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
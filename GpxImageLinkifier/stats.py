@@ -0,0 +1,64 @@
+import collections
+
+
+class Stats():
+    """Wall time per stage and counters of the work a GIL did, collected when
+    it is created with stats=True. times holds seconds per stage (gpx, read,
+    match, output); counts holds the counters, as named in to_dict. Both add
+    up over every call on the GIL. Every image scanned is either skipped (not
+    wanted), has no timestamp, or is read."""
+
+    def __init__(self):
+        self.times = collections.OrderedDict(
+            (stage, 0.0) for stage in ('gpx', 'read', 'match', 'output'))
+        self.counts = collections.defaultdict(int)
+
+    def add_time(self, stage, seconds):
+        self.times[stage] = self.times.get(stage, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def to_dict(self):
+        """Returns the stats as nested dicts, ready for json.dumps."""
+        counts = self.counts
+
+        def rate(part, whole):
+            return round(float(part) / whole, 4) if whole else None
+
+        def cache(name):
+            hits = counts[name + '_hits']
+            misses = counts[name + '_misses']
+            return collections.OrderedDict([
+                ('hits', hits),
+                ('misses', misses),
+                ('hit_rate', rate(hits, hits + misses)),
+            ])
+
+        return collections.OrderedDict([
+            ('seconds', collections.OrderedDict(
+                (stage, round(seconds, 6))
+                for stage, seconds in self.times.items())),
+            ('images', collections.OrderedDict([
+                ('scanned', counts['images_scanned']),
+                ('skipped', counts['images_skipped']),
+                ('no_timestamp', counts['images_no_timestamp']),
+                ('read', counts['images_read']),
+                ('matched', counts['images_matched']),
+                ('unmatched', counts['images_read'] -
+                 counts['images_matched']),
+                ('written', counts['images_written']),
+                ('thumbnailed', counts['images_thumbnailed']),
+            ])),
+            ('gpx_points', counts['gpx_points']),
+            ('lookups', collections.OrderedDict([
+                ('count', counts['lookups']),
+                ('points_examined', counts['points_examined']),
+                ('points_examined_per_lookup',
+                 rate(counts['points_examined'], counts['lookups'])),
+            ])),
+            ('bytes_read', counts['bytes_read']),
+            ('pil_fallbacks', counts['pil_fallbacks']),
+            ('timestamp_cache', cache('timestamp_cache')),
+            ('gpx_index_cache', cache('gpx_index_cache')),
+        ])
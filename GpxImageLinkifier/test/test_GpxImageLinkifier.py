@@ -1,10 +1,29 @@
+import contextlib
 import datetime
 import pytz
 from GpxImageLinkifier import GIL
+from GpxImageLinkifier import index
+from GpxImageLinkifier import exif
+from GpxImageLinkifier import extractors
+from GpxImageLinkifier import manifest
+from GpxImageLinkifier import merge
+from GpxImageLinkifier import server
+from GpxImageLinkifier.cache import stat_key
+from GpxImageLinkifier.timezones import UtcConverter
+from GpxImageLinkifier.watch import FolderWatcher
+from GpxImageLinkifier.writers import GeoJSONWriter, TileWriter
 import gpxpy
 import gpxpy.gpx
 import os
 import json
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import urllib2
+from StringIO import StringIO
 
 # EXIF timestamps for test images:
 # test_files/image_files/jpg/IMG_7106.JPG             2013:05:25 18:40:43
@@ -29,6 +48,25 @@ gil1 = GIL(TEST_GPX_PATH1, TEST_IMAGE_FOLDER_PATH1)
 gil2 = GIL(TEST_GPX_PATH2, TEST_IMAGE_FOLDER_PATH2)
 
 
+def waypoint_gpx(elevation=None):
+    """a GPX file with one waypoint, three seconds before TEST_IMAGE_PATH"""
+    gpx_data = gpxpy.gpx.GPX()
+    gpx_data.waypoints.append(gpxpy.gpx.GPXWaypoint(
+        latitude=46.787799, longitude=-121.733713, elevation=elevation,
+        time=datetime.datetime(2013, 5, 25, 18, 40, 40)))
+    return gpx_data
+
+
+@contextlib.contextmanager
+def temporary_folder():
+    """a temporary folder that is removed with its contents afterwards"""
+    folder = tempfile.mkdtemp()
+    try:
+        yield folder
+    finally:
+        shutil.rmtree(folder)
+
+
 def test_find_match_non_image():
     """find_matches works with lists if properly formatted."""
 
@@ -77,6 +115,150 @@ get_image_timestamp method"""
     assert dt == ts
 
 
+def test_read_exif_datetime():
+    """the header-only reader returns the same timestamp PIL does, and None
+    for files it can't handle"""
+    assert exif.read_exif_datetime(TEST_IMAGE_PATH) ==\
+        gil1.get_pil_image_timestamp(TEST_IMAGE_PATH)
+    assert exif.read_exif_datetime(TEST_GPX_PATH1) is None
+
+
+def test_find_matches_workers():
+    """reading images on a worker pool gives the same, sorted, matches"""
+    gpx_data = waypoint_gpx()
+
+    with temporary_folder() as image_folder:
+        for n in range(12):
+            shutil.copy(TEST_IMAGE_PATH,
+                        os.path.join(image_folder, 'image_%02d.jpg' % n))
+
+        expected = ['image_%02d.jpg' % n for n in range(12)]
+
+        for workers in [1, 3]:
+            gil = GIL(gpx_path=gpx_data, workers=workers)
+            matches = gil.find_matches(image_folder)
+            assert [match['content'] for match in matches] == expected
+
+
+def test_iter_matches_recursive():
+    """iter_matches walks nested folders, honouring include/exclude
+    patterns and matching extensions case-insensitively"""
+    gpx_data = waypoint_gpx()
+
+    with temporary_folder() as image_folder:
+        for name in ['a.JPEG', '2013/05/b.jpg', '2013/06/c.Jpg',
+                     '2013/06/skip/d.jpg', 'notes.txt']:
+            path = os.path.join(image_folder, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            shutil.copy(TEST_IMAGE_PATH, path)
+
+        gil = GIL(gpx_path=gpx_data)
+        assert [match['content'] for match in gil.iter_matches(image_folder)] ==\
+            ['a.JPEG']
+
+        gil = GIL(gpx_path=gpx_data, recursive=True, exclude=['*/skip'])
+        matches = gil.iter_matches(image_folder)
+        assert next(matches)['content'] == 'a.JPEG'
+        assert [match['content'] for match in matches] ==\
+            ['2013/05/b.jpg', '2013/06/c.Jpg']
+
+        gil = GIL(gpx_path=gpx_data, recursive=True, include=['2013/06/*'])
+        assert [match['content'] for match in gil.find_matches(image_folder)] ==\
+            ['2013/06/c.Jpg', '2013/06/skip/d.jpg']
+
+
+def test_timestamp_cache():
+    """cached image timestamps are reused until the image changes"""
+    with temporary_folder() as image_folder:
+        cache_dir = os.path.join(image_folder, 'cache')
+        image_path = os.path.join(image_folder, 'image.jpg')
+        shutil.copy(TEST_IMAGE_PATH, image_path)
+        for hits, misses in [(0, 1), (1, 0)]:
+            gil = GIL(cache_dir=cache_dir)
+            assert list(gil.read_image_timestamps([image_path])) ==\
+                [datetime.datetime(2013, 5, 25, 18, 40, 43)]
+            assert gil.timestamp_cache.hits == hits
+            assert gil.timestamp_cache.misses == misses
+
+        # a changed file is read again
+        os.utime(image_path, (0, 0))
+        gil = GIL(cache_dir=cache_dir)
+        list(gil.read_image_timestamps([image_path]))
+        assert gil.timestamp_cache.misses == 1
+
+        # hits are yielded as they are looked up, in order around misses
+        other_path = os.path.join(image_folder, 'other.jpg')
+        shutil.copy(TEST_IMAGE_PATH, other_path)
+        given = []
+
+        def paths():
+            for path in [image_path] * 3 + [other_path] + [image_path] * 3:
+                given.append(path)
+                yield path
+
+        gil = GIL(cache_dir=cache_dir, workers=2)
+        gil.timestamp_lookahead = 2
+        timestamps = gil.read_image_timestamps(paths())
+        assert next(timestamps) == datetime.datetime(2013, 5, 25, 18, 40, 43)
+        assert len(given) == 1
+        assert len(list(timestamps)) == 6
+        assert (gil.timestamp_cache.hits, gil.timestamp_cache.misses) ==\
+            (6, 1)
+        gil.timestamp_cache.close()
+
+        # the cache file of earlier versions is migrated and deleted
+        os.remove(os.path.join(cache_dir, 'timestamps2.sqlite'))
+        old_path = os.path.join(cache_dir, 'timestamps.sqlite')
+        connection = sqlite3.connect(old_path)
+        connection.execute('''CREATE TABLE timestamps (path TEXT PRIMARY KEY,
+            size INTEGER, mtime_ns INTEGER, timestamp INTEGER, used INTEGER)''')
+        connection.execute('INSERT INTO timestamps VALUES (?, ?, ?, ?, ?)',
+                           (os.path.abspath(image_path),) +
+                           stat_key(image_path) + (0, 0))
+        connection.commit()
+        connection.close()
+
+        gil = GIL(cache_dir=cache_dir)
+        assert not os.path.exists(old_path)
+        assert list(gil.read_image_timestamps([image_path])) ==\
+            [datetime.datetime(1970, 1, 1)]
+
+
+def test_gpx_index_cache():
+    """compact instances with a cache_dir reuse compiled GPX indexes"""
+    with temporary_folder() as cache_dir:
+        gil = GIL(TEST_GPX_PATH2, compact=True, cache_dir=cache_dir,
+                  tz_gpx='US/Pacific')
+        cached_gil = GIL(TEST_GPX_PATH2, compact=True, cache_dir=cache_dir,
+                         tz_gpx='US/Pacific')
+
+        assert len(os.listdir(os.path.join(cache_dir, 'gpx'))) == 2
+        assert list(cached_gil.gpx_index.times) == list(gil.gpx_index.times)
+        assert list(cached_gil.gpx_index.latitudes) ==\
+            list(gil.gpx_index.latitudes)
+        assert cached_gil.gpx_index.point(3) == gil.gpx_index.point(3)
+
+        points = cached_gil.gpx_index.points([3, None, 5, 3])
+        assert points == [gil.gpx_index.point(3), None,
+                          gil.gpx_index.point(5), gil.gpx_index.point(3)]
+        assert points[0] is points[3]
+
+        # empty and truncated indexes are rebuilt
+        index_path = cached_gil.gpx_index_cache.index_path(TEST_GPX_PATH2,
+                                                           'US/Pacific')
+        size = os.path.getsize(index_path)
+        for length in [0, size // 2]:
+            with open(index_path, 'r+b') as f:
+                f.truncate(length)
+            rebuilt_gil = GIL(TEST_GPX_PATH2, compact=True,
+                              cache_dir=cache_dir, tz_gpx='US/Pacific')
+            assert rebuilt_gil.gpx_index_cache.misses == 1
+            assert list(rebuilt_gil.gpx_index.times) ==\
+                list(gil.gpx_index.times)
+            assert os.path.getsize(index_path) == size
+
+
 def test_find_timestamp_gpx_match():
     """find_timestamp_gpx_match returns a gpx point that most closely matches
     the image's timestamp"""
@@ -89,6 +271,107 @@ def test_find_timestamp_gpx_match():
     assert point.latitude == 46.787799
     assert point.longitude == -121.733713
 
+    # compact instances return their index, which is searched as it is
+    gil = GIL(compact=True)
+    point = gil.find_timestamp_gpx_match(valid_date,
+                                         gil.add_gpx_data(TEST_GPX_PATH1))
+
+    assert point.latitude == 46.787799
+    assert point.longitude == -121.733713
+
+
+def test_find_timestamp_gpx_match_index():
+    """the time index covers waypoints and every added dataset, returning the
+    nearest point within accuracy"""
+    gil = GIL(TEST_GPX_PATH2, accuracy='2s')
+    gil.add_gpx_data(TEST_GPX_PATH1)
+
+    # waypoint "Start of skyline trail" is at 2012-08-25T21:01:26
+    waypoint_date = pytz.utc.localize(datetime.datetime(2012, 8, 25, 21, 1, 27))
+    point = gil.find_timestamp_gpx_match(waypoint_date,
+                                         accuracyDelta=gil.accuracy)
+
+    assert point.latitude == 46.788691
+    assert point.longitude == -121.732516
+
+    # nothing within 2 seconds
+    far_date = pytz.utc.localize(datetime.datetime(2012, 8, 25, 21, 1, 30))
+    assert gil.find_timestamp_gpx_match(far_date,
+                                        accuracyDelta=gil.accuracy) is None
+
+
+def test_find_matches_batch():
+    """find_matches gives the same result with and without numpy"""
+    gil = GIL(TEST_GPX_PATH2, accuracy='30s', offset_images='10s')
+    start = datetime.datetime(2013, 6, 29, 22, 0, 0)
+    testlist = [{"timestamp": start + datetime.timedelta(seconds=n * 7)}
+                for n in range(2000)]
+
+    numpy = index.numpy
+    try:
+        index.numpy = None
+        expected = [match['location'] for match in gil.find_matches(testlist)]
+    finally:
+        index.numpy = numpy
+
+    result = [match['location'] for match in gil.find_matches(testlist)]
+
+    assert len(expected) > 0
+    assert result == expected
+
+
+def test_compact():
+    """compact instances drop the gpxpy objects but match the same points"""
+    testlist = [
+        {
+            "foo": 'correct',
+            "timestamp": datetime.datetime.strptime('2012-08-25T20:59:20.1530Z', '%Y-%m-%dT%H:%M:%S.%fZ')
+        }
+    ]
+    gil = GIL(TEST_GPX_PATH1, compact=True)
+
+    assert len(gil.gpx_datasets) == 0
+    assert len(gil.gpx_index) == 12
+
+    match = gil.find_matches(testlist)[0]['location']
+
+    assert isinstance(match, index.GpxPoint)
+    assert match.latitude == 46.787799
+    assert match.longitude == -121.733713
+    assert match.elevation == 1646
+
+    geojson = json.loads(gil.to_geojson())
+    assert geojson['features'][0]['geometry']['coordinates'] ==\
+        [-121.733713, 46.787799, 1646]
+    assert gpxpy.parse(gil.to_xml()).waypoints[0].latitude == 46.787799
+
+
+def test_compact_streaming():
+    """compact instances stream GPX files into the same index gpxpy builds"""
+    for tz in ['UTC', 'US/Pacific']:
+        gil = GIL(TEST_GPX_PATH2, tz_gpx=tz)
+        compact_gil = GIL(TEST_GPX_PATH2, tz_gpx=tz, compact=True)
+
+        assert list(compact_gil.gpx_index.times) == list(gil.gpx_index.times)
+        assert list(compact_gil.gpx_index.latitudes) == list(gil.gpx_index.latitudes)
+        assert list(compact_gil.gpx_index.longitudes) == list(gil.gpx_index.longitudes)
+
+
+def test_overlapping_runs():
+    """lookups only search the track segments near the target time"""
+    gil = GIL(TEST_GPX_PATH1)
+    gil.add_gpx_data(TEST_GPX_PATH2)
+    runs = gil.gpx_index.runs
+
+    # 1 track segment and waypoints per file
+    assert len(runs) == 4
+
+    target = runs[0].start
+    overlapping = gil.gpx_index.overlapping_runs(target - 60, target + 60)
+    assert runs[0] in overlapping
+    assert runs[2] not in overlapping
+    assert runs[3] not in overlapping
+
 
 def test_parse_timeString():
     """tests if the timestring parser works"""
@@ -166,6 +449,34 @@ def test_timezones():
                 assert len(gil.find_matches(content)) == 0
 
 
+def test_utc_converter():
+    """Cached timezone conversion gives what pytz localize() gives, around
+    DST transitions and for ambiguous and nonexistent times too"""
+    for zone in ['America/Los_Angeles', 'Europe/London', 'Australia/Lord_Howe',
+                 'America/Sao_Paulo', 'Asia/Kolkata', 'UTC']:
+        tz = pytz.timezone(zone)
+        converter = UtcConverter(tz)
+        gpx_index = index.GpxTimeIndex(tz)
+        timestamps = []
+        epochs = []
+        for start in [datetime.datetime(2013, 3, 9), datetime.datetime(2013, 3, 30),
+                      datetime.datetime(2013, 10, 5), datetime.datetime(2013, 11, 2),
+                      datetime.datetime(2013, 10, 19), datetime.datetime(2014, 2, 15)]:
+            for minutes in range(0, 3 * 24 * 60, 10):
+                ts = start + datetime.timedelta(minutes=minutes, seconds=7)
+                expected = tz.localize(ts).astimezone(pytz.utc)
+                assert converter.utc(ts) == expected
+                assert converter.epoch(ts) == gpx_index.point_epoch(ts) ==\
+                    gpx_index.text_epoch(ts.strftime('%Y-%m-%dT%H:%M:%SZ')) ==\
+                    (expected - index.EPOCH).total_seconds()
+                timestamps.append(ts)
+                epochs.append(converter.epoch(ts))
+
+        assert UtcConverter(tz).epochs(timestamps) == epochs
+        assert converter.epochs([pytz.utc.localize(start)]) ==\
+            [(pytz.utc.localize(start) - index.EPOCH).total_seconds()]
+
+
 def test_to_xml():
     """to_xml returns valid xml"""
     # should work
@@ -206,5 +517,623 @@ def test_to_geojson():
     assert gpxpy_data['features'][0]['geometry']['coordinates'][1] == match_latitude
 
 
+def test_write_geojson():
+    """write_geojson streams the same features as to_geojson, as a
+    FeatureCollection or one feature per line"""
+    testlist = [
+        {
+            "foo": 'correct',
+            "timestamp": datetime.datetime.strptime('2012-08-25T20:59:20.1530Z', '%Y-%m-%dT%H:%M:%S.%fZ')
+        }
+    ]
+
+    gil1.find_matches(testlist)
+    expected = json.loads(gil1.to_geojson())
+
+    f = StringIO()
+    assert gil1.write_geojson(gil1.iter_matches(testlist), f) == 1
+    assert json.loads(f.getvalue()) == expected
+
+    f = StringIO()
+    gil1.write_geojson(gil1.iter_matches(testlist * 3), f, sequence=True)
+    lines = f.getvalue().splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[0]) == expected['features'][0]
+
+
+def test_write_gpx():
+    """write_gpx streams the same waypoints as to_xml, without building
+    gpxpy objects"""
+    testlist = [
+        {
+            "foo": 'correct',
+            "timestamp": datetime.datetime.strptime('2012-08-25T20:59:20.1530Z', '%Y-%m-%dT%H:%M:%S.%fZ')
+        }
+    ]
+
+    gil = GIL(TEST_GPX_PATH1)
+    gil.find_matches(testlist)
+    assert gil.matches_gpxpy is None
+    expected = gpxpy.parse(gil.to_xml()).waypoints[0]
+
+    f = StringIO()
+    assert gil.write_gpx(gil.iter_matches(testlist * 3), f) == 3
+    waypoints = gpxpy.parse(f.getvalue()).waypoints
+
+    assert len(waypoints) == 3
+    assert waypoints[0].latitude == expected.latitude
+    assert waypoints[0].longitude == expected.longitude
+    assert waypoints[0].elevation == expected.elevation
+    assert waypoints[0].name == expected.name
+
+
+def test_write_tiles():
+    """Tiles output clusters matches per zoom level into small tile files,
+    and replaces the tiles of an earlier run"""
+    # two photos in Seattle, close together, and one in Tacoma
+    matches = [{'content': name, 'location': index.GpxPoint(latitude, longitude)}
+               for name, latitude, longitude in [
+                   ('a.jpg', 47.6062, -122.3321), ('b.jpg', 47.6063, -122.3322),
+                   ('c.jpg', 47.2529, -122.4443)]]
+
+    def read(path):
+        with open(os.path.join(folder, path)) as f:
+            return json.load(f)
+
+    with temporary_folder() as folder:
+        gil = GIL(image_prefix='photos/')
+        assert gil.write_tiles(iter(matches), folder, max_zoom=12) == 3
+
+        metadata = read('tiles.json')
+        assert metadata['count'] == 3 and metadata['max_zoom'] == 12
+        assert metadata['bounds'] == [-122.4443, 47.2529, -122.3321, 47.6063]
+
+        clusters = read('0/0/0.json')['clusters']
+        assert [(cluster['count'], cluster['content']) for cluster in clusters] ==\
+            [(3, 'photos/a.jpg')]
+        assert abs(clusters[0]['latitude'] - 47.48846667) < 1e-6
+
+        tiles = [os.path.join(directory, name)
+                 for directory, directories, names in os.walk(
+                     os.path.join(folder, '12')) for name in names]
+        clusters = [cluster for tile in tiles for cluster in read(tile)['clusters']]
+        assert sorted((cluster['count'], cluster['content'])
+                      for cluster in clusters) ==\
+            [(1, 'photos/c.jpg'), (2, 'photos/a.jpg')]
+        assert metadata['tiles'] == sum(
+            len(names) for directory, directories, names in os.walk(folder)) - 1
+
+        # clusters spilled to disk to bound memory make the same tiles
+        def all_tiles():
+            return dict((os.path.join(directory, name), read(
+                os.path.join(directory, name)))
+                for directory, directories, names in os.walk(folder)
+                for name in names)
+
+        written = all_tiles()
+        writer = TileWriter(folder, 'photos/', max_zoom=12, max_clusters=5)
+        writer.write_all(matches)
+        writer.close()
+        assert all_tiles() == written
+
+        gil.write_tiles(matches[:1], folder, max_zoom=2)
+        assert sorted(os.listdir(folder)) == ['0', '1', '2', 'tiles.json']
+        assert read('tiles.json')['tiles'] == 3
+
+
+def test_estimate_offset():
+    """estimate_offset finds the camera clock offset of images, like the ~4m56s
+    the Ranier camera was ahead of the GPS"""
+    gil = GIL(TEST_GPX_PATH1, accuracy='10s')
+    content = [{"timestamp": datetime.datetime.utcfromtimestamp(time + 296)}
+               for time in gil.gpx_index.times]
+
+    numpy = index.numpy
+    try:
+        index.numpy = None
+        expected = gil.estimate_offset(content)
+    finally:
+        index.numpy = numpy
+
+    offset, matches, count = gil.estimate_offset(content)
+
+    assert expected == (offset, matches, count)
+    assert offset == datetime.timedelta(minutes=-4, seconds=-56)
+    assert matches == count == len(content)
+
+    assert gil.format_timeString(offset) == '-4m56s'
+    assert gil.parse_timeString('-4m56s') == offset
+
+
+def test_interpolate():
+    """interpolating gils place images between the track points around them,
+    if both are within the accuracy"""
+    points = GIL(TEST_GPX_PATH1).gpx_datasets[0].tracks[0].segments[0].points
+    before, after = points[0], points[1]
+    middle = before.time + (after.time - before.time) / 2
+    testlist = [{"timestamp": middle}, {"timestamp": before.time}]
+
+    for compact in [False, True]:
+        gil = GIL(TEST_GPX_PATH1, accuracy='1m', interpolate=True,
+                  compact=compact)
+        location, exact = [match['location']
+                           for match in gil.find_matches(testlist)]
+
+        assert abs(location.latitude - (before.latitude + after.latitude) / 2) < 1e-9
+        assert abs(location.longitude - (before.longitude + after.longitude) / 2) < 1e-9
+        assert (exact.latitude, exact.longitude) == (before.latitude, before.longitude)
+
+        # single lookups interpolate too
+        single = gil.find_timestamp_gpx_match(pytz.utc.localize(middle),
+                                              accuracyDelta=gil.accuracy)
+        assert (single.latitude, single.longitude) ==\
+            (location.latitude, location.longitude)
+
+    # with one of the points too far away, the nearest one is used
+    before, after = [(before, after) for before, after in zip(points, points[1:])
+                     if after.time - before.time > datetime.timedelta(seconds=8)][0]
+    gil = GIL(TEST_GPX_PATH1, accuracy='5s', interpolate=True)
+    testlist = [{"timestamp": before.time + datetime.timedelta(seconds=3)}]
+    location = gil.find_matches(testlist)[0]['location']
+    assert (location.latitude, location.longitude) == (before.latitude, before.longitude)
+
+
+def test_stats():
+    """stats=True collects stage times and counters, and profile writes a
+    cProfile profile of find_matches"""
+    gpx_data = waypoint_gpx()
+
+    with temporary_folder() as image_folder:
+        profile = os.path.join(image_folder, 'find_matches.prof')
+        for name in ['a.jpg', 'b.jpg', 'notes.txt']:
+            shutil.copy(TEST_IMAGE_PATH, os.path.join(image_folder, name))
+        with open(os.path.join(image_folder, 'c.xmp'), 'w') as f:
+            f.write('<x:xmpmeta xmlns:x="adobe:ns:meta/"/>')
+
+        assert GIL(gpx_path=gpx_data).stats is None
+
+        gil = GIL(gpx_path=gpx_data, stats=True, profile=profile)
+        assert len(gil.find_matches(image_folder)) == 2
+        stats = json.loads(json.dumps(gil.stats.to_dict()))
+
+        assert stats['images'] == {'scanned': 4, 'skipped': 1,
+                                   'no_timestamp': 1, 'read': 2,
+                                   'matched': 2, 'unmatched': 0,
+                                   'written': 0, 'thumbnailed': 0}
+        images = stats['images']
+        assert images['scanned'] == images['skipped'] +\
+            images['no_timestamp'] + images['read']
+        assert stats['gpx_points'] == 1
+        assert stats['lookups']['count'] == 2
+        assert stats['bytes_read'] > 0
+        assert stats['timestamp_cache']['hit_rate'] is None
+        assert os.path.getsize(profile) > 0
+
+
+def test_watch():
+    """FolderWatcher notices images added after it starts, with inotify or by
+    polling, and iter_matches can match just those"""
+    gpx_data = waypoint_gpx()
+
+    with temporary_folder() as image_folder:
+        shutil.copy(TEST_IMAGE_PATH, os.path.join(image_folder, 'a.jpg'))
+
+        for polling in [False, True]:
+            watcher = FolderWatcher(image_folder, interval=0.05,
+                                    polling=polling)
+            try:
+                assert watcher.wait(0) == []
+                name = 'b%d.jpg' % polling
+                shutil.copy(TEST_IMAGE_PATH, os.path.join(image_folder, name))
+                assert watcher.wait(5) == [name]
+            finally:
+                watcher.close()
+
+        gil = GIL(gpx_path=gpx_data)
+        matches = gil.iter_matches(image_folder, ['b1.jpg', 'notes.txt'])
+        assert [match['content'] for match in matches] == ['b1.jpg']
+
+        # while watching, a corrupt image is reported and skipped
+        with open(os.path.join(image_folder, 'c.jpg'), 'wb') as f:
+            f.write(b'\xff\xd8 not a jpeg')
+        for workers in [1, 2]:
+            gil = GIL(gpx_path=gpx_data, workers=workers)
+            try:
+                list(gil.iter_matches(image_folder, ['c.jpg', 'a.jpg']))
+                assert False
+            except IOError:
+                pass
+
+            gil.skip_unreadable = True
+            sys.stderr = StringIO()
+            try:
+                matches = gil.iter_matches(image_folder, ['c.jpg', 'a.jpg'])
+                assert [match['content'] for match in matches] == ['a.jpg']
+                assert 'c.jpg' in sys.stderr.getvalue()
+            finally:
+                sys.stderr = sys.__stderr__
+        os.remove(os.path.join(image_folder, 'c.jpg'))
+
+        # geojson output stays complete as matches are appended
+        path = os.path.join(image_folder, 'out.geojson')
+        with open(path, 'w') as f:
+            writer = GeoJSONWriter(f)
+            for count in [1, 2]:
+                writer.write_all(gil.iter_matches(image_folder, ['a.jpg']))
+                writer.checkpoint()
+                with open(path) as written:
+                    assert len(json.load(written)['features']) == count
+
+
+def test_write_exif():
+    """--write-exif adds GPS tags without touching the image data, and
+    replaces the ones it wrote before"""
+    from PIL import Image
+    gpx_data = waypoint_gpx(elevation=1646.2)
+
+    def image_data(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        # from the start of scan, which can't appear in EXIF thumbnails'
+        # scan data
+        return data[data.rindex(b'\xff\xda'):]
+
+    with temporary_folder() as image_folder:
+        path = os.path.join(image_folder, 'a.jpg')
+        shutil.copy(TEST_IMAGE_PATH, path)
+        gil = GIL(gpx_path=gpx_data, compact=True, workers=2)
+        matches = gil.find_matches(image_folder)
+
+        Image.new('RGB', (16, 16)).save(os.path.join(image_folder, 'b.jpg'))
+        with open(os.path.join(image_folder, 'c.jpg'), 'wb') as f:
+            f.write(b'not a jpeg')
+        with open(os.path.join(image_folder, 'd.xmp'), 'wb') as f:
+            f.write(b'<x:xmpmeta xmlns:x="adobe:ns:meta/"/>')
+        matches.append({'content': 'c.jpg',
+                        'location': matches[0]['location']})
+        matches.append({'content': 'd.xmp',
+                        'location': matches[0]['location']})
+        written = []
+        sys.stderr = StringIO()
+        try:
+            # every match is passed on, written or not
+            assert list(gil.write_image_locations(image_folder, matches,
+                                                  written)) == matches
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = sys.__stderr__
+        assert written == ['a.jpg']
+        assert 'c.jpg' in errors and 'd.xmp' not in errors
+        assert image_data(path) == image_data(TEST_IMAGE_PATH)
+        assert exif.read_exif_datetime(path) ==\
+            exif.read_exif_datetime(TEST_IMAGE_PATH)
+
+        gps = Image.open(path)._getexif()[34853]
+        assert gps[1] == 'N' and gps[3] == 'W'
+        assert [float(n) / d for n, d in gps[2]] == [46, 47, 16.0764]
+        assert gps[6] == (1646200, 1000)
+        assert gps[29] == '2013:05:25'
+
+        size = os.path.getsize(path)
+        exif.write_jpeg_gps(path, 46.787799, -121.733713, 1646.2)
+        assert os.path.getsize(path) < size
+        exif.write_jpeg_gps(os.path.join(image_folder, 'b.jpg'), -1.5, 2.5)
+        gps = Image.open(os.path.join(image_folder, 'b.jpg'))._getexif()[34853]
+        assert gps[1] == 'S' and gps[2] == ((1, 1), (30, 1), (0, 10000))
+        assert sorted(os.listdir(image_folder)) ==\
+            ['a.jpg', 'b.jpg', 'c.jpg', 'd.xmp']
+
+        # files that hold the location already are left alone, so their
+        # cached timestamps stay valid
+        assert exif.write_jpeg_gps(path, 46.787799, -121.733713,
+                                   1646.2) is False
+        for name in ['b.jpg', 'c.jpg', 'd.xmp']:
+            os.remove(os.path.join(image_folder, name))
+        with temporary_folder() as cache_dir:
+            mtimes = []
+            for run in range(3):
+                gil = GIL(gpx_path=gpx_data, image_folder=image_folder,
+                          output_path=os.path.join(cache_dir, 'out.geojson'),
+                          write_exif=True, cache_dir=cache_dir, isCLI=True)
+                mtimes.append(os.stat(path).st_mtime)
+            assert mtimes[1] == mtimes[2]
+            assert (gil.timestamp_cache.hits, gil.timestamp_cache.misses) ==\
+                (1, 0)
+
+
+def test_extractors():
+    """Timestamps are read from the headers of TIFF based RAW files, HEIF,
+    video and XMP sidecars, recognised by content before extension"""
+    def box(kind, payload):
+        return struct.pack('>I', 8 + len(payload)) + kind + payload
+
+    tiff = b'II*\x00' + struct.pack('<IHHHIII', 8, 1, 0x0132, 2, 20, 26, 0) +\
+        b'2013:05:25 18:40:43\x00'
+    seconds = (datetime.datetime(2013, 5, 25, 18, 40, 43) -
+               datetime.datetime(1904, 1, 1)).days * 86400 + 67243
+    mp4 = box(b'ftyp', b'isom\x00\x00\x02\x00') + box(b'moov', box(
+        b'mvhd', b'\x00' * 4 + struct.pack('>I', seconds) + b'\x00' * 92))
+
+    ftyp = box(b'ftyp', b'heic\x00\x00\x00\x00mif1heic')
+    iinf = box(b'iinf', b'\x00' * 4 + struct.pack('>H', 1) + box(
+        b'infe', b'\x02\x00\x00\x00' + struct.pack('>HH', 7, 0) + b'Exif\x00'))
+    meta_size = 8 + 4 + len(iinf) + 8 + 22
+    iloc = box(b'iloc', b'\x00' * 4 + b'\x44\x00' + struct.pack(
+        '>HHHHII', 1, 7, 0, 1, len(ftyp) + meta_size + 8, len(tiff) + 4))
+    heif = ftyp + box(b'meta', b'\x00' * 4 + iinf + iloc) +\
+        box(b'mdat', struct.pack('>I', 0) + tiff)
+
+    xmp = b'''<?xpacket begin=""?><x:xmpmeta><rdf:Description
+        xmp:CreateDate="2013-05-25T11:40:43.25-07:00"/></x:xmpmeta>'''
+
+    with temporary_folder() as image_folder:
+        for name, data in [('a.nef', tiff), ('b.mp4', mp4), ('c.heic', heif),
+                           ('d.xmp', xmp), ('e.jpg', tiff),
+                           ('f.mov', mp4[:16]), ('g.txt', tiff)]:
+            with open(os.path.join(image_folder, name), 'wb') as f:
+                f.write(data)
+
+        utc = pytz.utc.localize(datetime.datetime(2013, 5, 25, 18, 40, 43))
+        read = lambda name: extractors.read_timestamp(
+            os.path.join(image_folder, name))
+        assert read('a.nef') == read('e.jpg') == read('c.heic') ==\
+            utc.replace(tzinfo=None)
+        assert read('b.mp4') == read('d.xmp') == utc
+        assert read('f.mov') is None
+
+        gpx_data = waypoint_gpx()
+        # only the timestamps without a timezone are in tz_images, and
+        # g.txt isn't looked at
+        gil = GIL(gpx_path=gpx_data, tz_images='America/Los_Angeles')
+        matches = gil.find_matches(image_folder)
+        assert sorted(match['content'] for match in matches) ==\
+            ['b.mp4', 'd.xmp']
+
+
+def test_shard_merge():
+    """--shard runs split the images between them, and merging their outputs
+    gives what a single run writes"""
+    gpx_data = waypoint_gpx()
+
+    with temporary_folder() as image_folder, \
+            temporary_folder() as output_folder:
+        for name in ['b.jpg', 'a/c.jpg', 'a/b/d.jpg', 'a/a & b.jpg', 'z.jpg',
+                     'a/b/a.jpg', 'c/e.jpg', 'ab.jpg', 'a.jpg', 'c/a/f.jpg']:
+            path = os.path.join(image_folder, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            shutil.copy(TEST_IMAGE_PATH, path)
+
+        def run(output_format, shard=None, path=None):
+            gil = GIL(gpx_path=gpx_data, recursive=True, shard=shard,
+                      image_prefix='photos/')
+            f = open(path, 'w') if path else StringIO()
+            matches = gil.iter_matches(image_folder)
+            if output_format == 'gpx':
+                gil.write_gpx(matches, f)
+            else:
+                gil.write_geojson(matches, f, output_format == 'ndjson')
+            return f.getvalue() if path is None else f.close()
+
+        shards = []
+        for output_format in ['geojson', 'ndjson', 'gpx']:
+            paths = [os.path.join(output_folder, '%d.%s' % (i, output_format))
+                     for i in range(3)]
+            for i, path in enumerate(paths):
+                run(output_format, '%d/3' % (i + 1), path)
+                with open(path) as f:
+                    shards.append(f.read().count('photos/'))
+
+            merged = StringIO()
+            assert merge.merge_outputs(paths, merged) == 10
+            assert merged.getvalue() == run(output_format)
+
+        assert shards[:3] == shards[3:6] == shards[6:] and sum(shards[:3]) == 10
+        assert max(shards) < 10
+        assert GIL(shard='4/3').shard is None
+
+
+def test_thumbnails():
+    """--thumbnails writes small previews of matched images, records them in
+    the output and keeps the ones that are up to date"""
+    from PIL import Image
+    gpx_data = waypoint_gpx()
+
+    with temporary_folder() as image_folder:
+        exif_data = Image.open(TEST_IMAGE_PATH).info['exif']
+        os.makedirs(os.path.join(image_folder, 'day1'))
+        Image.new('RGB', (1200, 800), 'red').save(
+            os.path.join(image_folder, 'day1', 'a.jpg'), exif=exif_data)
+        shutil.copy(TEST_IMAGE_PATH, os.path.join(image_folder, 'b.jpg'))
+        with open(os.path.join(image_folder, 'c.xmp'), 'w') as f:
+            f.write('<x:xmpmeta xmp:CreateDate="2013-05-25T18:40:43Z"/>')
+
+        thumbnails = os.path.join(image_folder, 'thumbs')
+        output_path = os.path.join(image_folder, 'out.geojson')
+
+        def run():
+            GIL(gpx_path=gpx_data, image_folder=image_folder,
+                output_path=output_path, recursive=True, workers=2,
+                thumbnails=thumbnails, thumbnail_size=100, isCLI=True)
+            with open(output_path) as f:
+                return dict((feature['properties']['content'],
+                             feature['properties'].get('thumbnail'))
+                            for feature in json.load(f)['features'])
+
+        a_thumbnail = os.path.join(thumbnails, 'day1', 'a.jpg')
+        assert run() == {'b.jpg': os.path.join(thumbnails, 'b.jpg'),
+                         'c.xmp': None, 'day1/a.jpg': a_thumbnail}
+        assert max(Image.open(a_thumbnail).size) == 100
+        assert Image.open(os.path.join(thumbnails, 'b.jpg')).size == (10, 8)
+
+        # the thumbnails folder isn't searched for images, and thumbnails
+        # are only written again if their image changed
+        os.utime(a_thumbnail, (0, 1))
+        assert len(run()) == 3
+        assert os.path.getmtime(a_thumbnail) > 1
+        os.utime(a_thumbnail, (4000000000, 4000000000))
+        run()
+        assert os.path.getmtime(a_thumbnail) == 4000000000
+
+        # PILs older than Pillow 6 have no exif_transpose, and write the
+        # previews unrotated
+        from PIL import ImageOps
+        exif_transpose = ImageOps.exif_transpose
+        del ImageOps.exif_transpose
+        try:
+            old_thumbnail = os.path.join(thumbnails, 'old.jpg')
+            assert sys.modules[GIL.__module__].write_thumbnail(
+                (os.path.join(image_folder, 'b.jpg'), old_thumbnail, 100)) is\
+                None
+            assert Image.open(old_thumbnail).size == (10, 8)
+        finally:
+            ImageOps.exif_transpose = exif_transpose
+
+
+def test_serve():
+    """gil serve answers batches of timestamp lookups over HTTP and picks up
+    GPX files added to its folder when reloaded"""
+    with temporary_folder() as gpx_folder:
+        shutil.copy(TEST_GPX_PATH1, gpx_folder)
+        service = server.LookupService([gpx_folder], accuracy='5s',
+                                       tz_images='America/Los_Angeles')
+        httpd = server.make_server(service, port=0, quiet=True)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+
+        def post(path, data):
+            request = urllib2.Request(url + path, json.dumps(data),
+                                      {'Content-Type': 'application/json'})
+            return json.load(urllib2.urlopen(request))
+
+        try:
+            locations = post('/lookup', {'timestamps': [
+                '2012-08-25T20:59:21Z', '2012-08-25T13:59:33',
+                '2012-08-25T22:59:20+02:00',
+                '2000-01-01T00:00:00Z']})['locations']
+            assert [(location['latitude'], location['longitude'])
+                    for location in locations[:3]] ==\
+                [(46.787799, -121.733713), (46.788014, -121.733551),
+                 (46.787799, -121.733713)]
+            assert locations[3] is None
+
+            try:
+                post('/lookup', {'timestamps': ['yesterday']})
+                assert False
+            except urllib2.HTTPError as e:
+                assert e.code == 400
+
+            points = json.load(urllib2.urlopen(url + '/status'))['points']
+            assert post('/reload', {}) == {'reloaded': False}
+            shutil.copy(TEST_GPX_PATH2, gpx_folder)
+            assert post('/reload', {}) == {'reloaded': True}
+            status = json.load(urllib2.urlopen(url + '/status'))
+            assert status['points'] > points
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+
+def test_manifest():
+    """--manifest runs every job, parsing each GPX file once"""
+    from PIL import Image
+    loaded = []
+    load_gpx_index = manifest.load_gpx_index
+
+    def counting_load_gpx_index(path, *args):
+        loaded.append(os.path.basename(path))
+        return load_gpx_index(path, *args)
+
+    gpx_data = waypoint_gpx()
+
+    with temporary_folder() as folder:
+        os.mkdir(os.path.join(folder, 'images'))
+        shutil.copy(TEST_IMAGE_PATH, os.path.join(folder, 'images'))
+        with open(os.path.join(folder, 'track.gpx'), 'w') as f:
+            f.write(gpx_data.to_xml())
+        jobs = [{'gpx_path': 'track.gpx', 'image_folder': 'images',
+                 'output_path': 'a.geojson', 'thumbnails': 'thumbs',
+                 'thumbnail_size': 4},
+                {'gpx_path': [TEST_GPX_PATH1, 'track.gpx'],
+                 'image_folder': 'images', 'output_path': 'b.ndjson',
+                 'output_format': 'ndjson'},
+                {'gpx_path': 'missing.gpx', 'image_folder': 'images',
+                 'output_path': 'c.geojson'},
+                {'gpx_path': 'track.gpx', 'image_folder': 'images',
+                 'output_path': 'd.geojson', 'tz_images': 'Nowhere/Else'}]
+        with open(os.path.join(folder, 'jobs.json'), 'w') as f:
+            json.dump(jobs, f)
+
+        manifest.load_gpx_index = counting_load_gpx_index
+        sys.stderr = StringIO()
+        try:
+            assert manifest.run_manifest(os.path.join(folder, 'jobs.json'),
+                                         concurrency=2) == 2
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = sys.__stderr__
+            manifest.load_gpx_index = load_gpx_index
+        assert 'ERROR: job 3: ' in errors and\
+            'ERROR: job 4: Bad timezone: Nowhere/Else' in errors
+        assert sorted(loaded) == sorted([os.path.basename(TEST_GPX_PATH1),
+                                         'missing.gpx', 'track.gpx'])
+
+        # thumbnails are relative to the manifest too
+        thumbnail = os.path.join(folder, 'thumbs',
+                                 os.path.basename(TEST_IMAGE_PATH))
+        with open(os.path.join(folder, 'a.geojson')) as f:
+            assert [feature['properties']['thumbnail'] for feature in
+                    json.load(f)['features']] == [thumbnail]
+        assert max(Image.open(thumbnail).size) == 4
+        with open(os.path.join(folder, 'b.ndjson')) as f:
+            assert len(f.readlines()) == 1
+        # failed jobs leave no (partial) output
+        assert sorted(name for name in os.listdir(folder)
+                      if name[0] in 'abcd') == ['a.geojson', 'b.ndjson']
+
+        jobs.append({'gpx_path': 'track.gpx', 'images': 'images'})
+        with open(os.path.join(folder, 'jobs.json'), 'w') as f:
+            json.dump(jobs, f)
+        try:
+            manifest.read_manifest(os.path.join(folder, 'jobs.json'))
+            assert False
+        except ValueError:
+            pass
+
+
+def test_manifest_non_ascii():
+    """manifest paths and image names need not be ASCII"""
+    gpx_data = waypoint_gpx()
+
+    with temporary_folder() as folder:
+        images = os.path.join(folder, u'b\xe4der'.encode('utf-8'))
+        os.mkdir(images)
+        shutil.copy(TEST_IMAGE_PATH,
+                    os.path.join(images, u'caf\xe9.jpg'.encode('utf-8')))
+        with open(os.path.join(folder, 'track.gpx'), 'w') as f:
+            f.write(gpx_data.to_xml())
+        jobs = [{'gpx_path': 'track.gpx', 'image_folder': u'b\xe4der',
+                 'output_path': 'a.geojson', 'image_prefix': u'img/'},
+                {'gpx_path': 'track.gpx', 'image_folder': u'b\xe4der',
+                 'output_path': 'b.gpx', 'output_format': 'gpx'}]
+        with open(os.path.join(folder, 'jobs.json'), 'w') as f:
+            json.dump(jobs, f)
+
+        assert manifest.run_manifest(os.path.join(folder, 'jobs.json')) == 0
+        with open(os.path.join(folder, 'a.geojson')) as f:
+            assert [feature['properties']['content'] for feature in
+                    json.load(f)['features']] == [u'img/caf\xe9.jpg']
+        with open(os.path.join(folder, 'b.gpx')) as f:
+            assert u'<name>caf\xe9.jpg</name>'.encode('utf-8') in f.read()
+
+    # unicode content is written as is
+    f = StringIO()
+    GeoJSONWriter(f).write({'location': gpxpy.gpx.GPXWaypoint(
+        latitude=1.0, longitude=2.0), 'content': u'caf\xe9.jpg'})
+    feature = json.loads(f.getvalue() + ']}')['features'][0]
+    assert feature['properties']['content'] == u'caf\xe9.jpg'
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,107 @@
+import datetime
+
+import pytz
+
+EPOCH = pytz.utc.localize(datetime.datetime(1970, 1, 1))
+EPOCH_ORDINAL = EPOCH.toordinal()
+NAIVE_EPOCH = EPOCH.replace(tzinfo=None)
+DAY = 86400
+
+
+class UtcConverter():
+    """Converts naive datetimes in the pytz timezone tz to UTC exactly as
+    tz.localize(ts).astimezone(pytz.utc) does, without calling pytz for every
+    datetime. The UTC offset is looked up once per local day and cached: on
+    days with the same offset at both midnights, whichever way an ambiguous
+    midnight is read, every time has that offset, so times convert with
+    arithmetic. Days with a DST transition (or any other offset change) are
+    left to pytz, so ambiguous and nonexistent times get what localize()
+    gives them: standard time, the way is_dst=False reads them."""
+
+    def __init__(self, tz):
+        self.tz = tz
+        # UTC offset in seconds by proleptic Gregorian ordinal of the local
+        # day, or None for days pytz converts
+        self.day_offsets = {}
+        # the UTC epoch as a naive local datetime, by ordinal of the local
+        # day it holds for, or None for days pytz converts
+        self.local_epochs = {}
+
+    def day_offset(self, ordinal):
+        offset = self.day_offsets.get(ordinal, False)
+        if offset is not False:
+            return offset
+
+        if self.tz is pytz.utc:
+            offset = 0
+        else:
+            offsets = set()
+            for day in (ordinal, ordinal + 1):
+                midnight = datetime.datetime.fromordinal(day)
+                for is_dst in (False, True):
+                    offsets.add(self.tz.localize(
+                        midnight, is_dst=is_dst).utcoffset())
+
+            if len(offsets) == 1:
+                offset = offsets.pop()
+                offset = offset.days * DAY + offset.seconds
+            else:
+                offset = None
+
+        self.day_offsets[ordinal] = offset
+        return offset
+
+    def local_epoch(self, ordinal):
+        local_epoch = self.local_epochs.get(ordinal, False)
+        if local_epoch is False:
+            offset = self.day_offset(ordinal)
+            local_epoch = None if offset is None else\
+                NAIVE_EPOCH + datetime.timedelta(seconds=offset)
+            self.local_epochs[ordinal] = local_epoch
+        return local_epoch
+
+    def utc(self, ts):
+        """Returns the naive datetime ts, in tz, as a UTC datetime. Aware
+        datetimes are converted to UTC as they are."""
+        if ts.tzinfo is not None:
+            return ts.astimezone(pytz.utc)
+
+        offset = self.day_offset(ts.toordinal())
+        if offset is None:
+            return self.tz.localize(ts).astimezone(pytz.utc)
+
+        return (ts - datetime.timedelta(seconds=offset)).replace(
+            tzinfo=pytz.utc)
+
+    def epoch(self, ts):
+        """Returns ts, naive in tz or aware, as seconds since the UTC epoch:
+        the same float as (utc(ts) - EPOCH).total_seconds()."""
+        if ts.tzinfo is None:
+            offset = self.day_offset(ts.toordinal())
+            if offset is not None:
+                seconds = (ts.toordinal() - EPOCH_ORDINAL) * DAY +\
+                    ts.hour * 3600 + ts.minute * 60 + ts.second - offset
+                return (seconds * 1000000 + ts.microsecond) / 1e6
+
+        return (self.utc(ts) - EPOCH).total_seconds()
+
+    def epochs(self, timestamps):
+        """epoch() of a batch of datetimes, as a list. A naive datetime costs
+        one subtraction, from the local epoch of its day."""
+        local_epochs = self.local_epochs
+        epochs = []
+        append = epochs.append
+
+        for ts in timestamps:
+            if ts.tzinfo is None:
+                ordinal = ts.toordinal()
+                local_epoch = local_epochs.get(ordinal, False)
+                if local_epoch is False:
+                    local_epoch = self.local_epoch(ordinal)
+                if local_epoch is not None:
+                    append((ts - local_epoch).total_seconds())
+                    continue
+
+            append(self.epoch(ts))
+
+        return epochs
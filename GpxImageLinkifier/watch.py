@@ -0,0 +1,233 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('=iIII')
+
+# after a change, wait this long for more before reporting them together
+SETTLE_SECONDS = 0.2
+
+
+def load_inotify():
+    """Returns libc if it has inotify, else None."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+
+def file_key(path):
+    """Returns (size, mtime) of the file at path, or None if it is gone."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+class FolderWatcher():
+    """Notices files that are added to or changed in folder (and its
+    subfolders, if recursive) after it is created. Uses inotify where libc
+    has it and polls the folder every interval seconds otherwise, or if
+    polling is True. Files are only reported once they have been written:
+    when they are closed with inotify, or when they have the same size and
+    mtime on two polls in a row."""
+
+    def __init__(self, folder, recursive=False, interval=2.0, polling=False):
+        self.folder = os.path.abspath(folder)
+        self.recursive = recursive
+        self.interval = interval
+        self.fd = None
+        self.directories = {}
+        self.pending = {}
+
+        libc = None if polling else load_inotify()
+        if libc is not None:
+            self.libc = libc
+            self.fd = libc.inotify_init1(IN_NONBLOCK)
+            if self.fd < 0:
+                self.fd = None
+            elif not self.add_watch(''):
+                self.close()
+
+        # everything there already counts as seen
+        self.seen = self.scan()
+
+    def add_watch(self, directory):
+        """Watches the folder's subdirectory directory (and its
+        subdirectories, if recursive). Returns False if inotify refused."""
+        path = os.path.join(self.folder, directory)
+        encoded_path = path
+        if not isinstance(path, bytes):
+            encoded_path = path.encode(sys.getfilesystemencoding())
+        wd = self.libc.inotify_add_watch(self.fd, encoded_path, WATCH_MASK)
+        if wd < 0:
+            return ctypes.get_errno() == errno.ENOENT
+
+        self.directories[wd] = directory
+
+        if self.recursive:
+            for name in sorted(os.listdir(path)):
+                if os.path.isdir(os.path.join(path, name)):
+                    if not self.add_watch(os.path.join(directory, name)):
+                        return False
+
+        return True
+
+    def scan(self, directory=''):
+        """Returns {relative path: (size, mtime)} of the files in the
+        folder's subdirectory directory."""
+        files = {}
+        directories = [directory]
+
+        while directories:
+            directory = directories.pop()
+            path = os.path.join(self.folder, directory)
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+
+            for name in names:
+                relative_path = os.path.join(directory, name)
+                if os.path.isdir(os.path.join(path, name)):
+                    if self.recursive:
+                        directories.append(relative_path)
+                    continue
+
+                key = file_key(os.path.join(path, name))
+                if key is not None:
+                    files[relative_path] = key
+
+        return files
+
+    def changed(self, keys):
+        """Returns the relative paths in keys, sorted, whose (size, mtime)
+        has not been seen, and marks them seen."""
+        changed = []
+        for relative_path, key in keys.items():
+            if key is not None and self.seen.get(relative_path) != key:
+                self.seen[relative_path] = key
+                changed.append(relative_path)
+        return sorted(changed)
+
+    def ignore(self, relative_paths):
+        """Marks the files at relative_paths seen as they are now, so that
+        changes the caller made to them are not reported."""
+        for relative_path in relative_paths:
+            key = file_key(os.path.join(self.folder, relative_path))
+            if key is not None:
+                self.seen[relative_path] = key
+                self.pending.pop(relative_path, None)
+
+    def wait(self, timeout=None):
+        """Waits up to timeout seconds (forever if None) for files to be
+        added or changed and returns their relative paths, or an empty list
+        if there were none."""
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            if self.fd is None:
+                changes = self.poll()
+            else:
+                changes = self.read_events(self.interval)
+
+            if changes:
+                return changes
+
+            if deadline is not None and time.time() >= deadline:
+                return []
+
+            if self.fd is None:
+                time.sleep(self.interval if deadline is None else
+                           max(0, min(self.interval, deadline - time.time())))
+
+    def changes(self):
+        """Yields lists of added or changed relative paths as they come."""
+        while True:
+            yield self.wait()
+
+    def poll(self):
+        """Scans the folder once. Returns the files that changed since the
+        last poll but not since the one before, so that files still being
+        copied are left for later."""
+        files = self.scan()
+        stable = dict((relative_path, key)
+                      for relative_path, key in files.items()
+                      if self.seen.get(relative_path) != key and
+                      self.pending.get(relative_path) == key)
+        self.pending = dict((relative_path, key)
+                            for relative_path, key in files.items()
+                            if self.seen.get(relative_path) != key)
+        return self.changed(stable)
+
+    def read_events(self, timeout):
+        """Waits up to timeout seconds for inotify events, then for them to
+        settle, and returns the files they changed."""
+        keys = {}
+
+        while select.select([self.fd], [], [], timeout)[0]:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data,
+                                                                    offset)
+                name = data[offset + EVENT_HEADER.size:
+                            offset + EVENT_HEADER.size + length]
+                name = name.rstrip(b'\x00')
+                if not isinstance(name, str):
+                    name = os.fsdecode(name)
+                offset += EVENT_HEADER.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, look at everything
+                    keys.update(self.scan())
+                    continue
+
+                directory = self.directories.get(wd)
+                if directory is None:
+                    continue
+
+                relative_path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                        # files copied in before the watch was added
+                        self.add_watch(relative_path)
+                        keys.update(self.scan(relative_path))
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    keys[relative_path] = file_key(
+                        os.path.join(self.folder, relative_path))
+
+            timeout = SETTLE_SECONDS
+
+        return self.changed(keys)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,364 @@
+import heapq
+import itertools
+import json
+import math
+import os
+import shutil
+import tempfile
+from xml.sax.saxutils import escape, quoteattr
+
+# the latitudes Web Mercator tiles cover
+MAX_LATITUDE = 85.0511287798
+
+
+def content_text(content):
+    """Returns the content of a match as text: image paths, byte or unicode,
+    as they are, and anything else (like the items of list input) as str()."""
+    if isinstance(content, (bytes, type(u''))):
+        return content
+    return str(content)
+
+
+def geojson_feature(match, image_prefix=''):
+    """Returns the GeoJSON feature of a match as a dict. The path of its
+    thumbnail, if it has one, is in the "thumbnail" property."""
+    feature = {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [
+                match["location"].longitude,
+                match["location"].latitude,
+                match["location"].elevation
+            ]
+        },
+        "properties": {
+            "content": image_prefix + content_text(match["content"])
+        }
+    }
+
+    if match.get("thumbnail") is not None:
+        feature["properties"]["thumbnail"] = match["thumbnail"]
+
+    return feature
+
+
+class GeoJSONWriter():
+    """Writes matches to the file object f one feature at a time, either as a
+    GeoJSON FeatureCollection or, with sequence=True, as newline-delimited
+    GeoJSON (one feature per line, unless indented). Only the current feature is
+    held in memory. Call close() to finish the FeatureCollection."""
+
+    header = '{"type": "FeatureCollection", "features": [\n'
+    tail = '\n]}\n'
+
+    def __init__(self, f, image_prefix='', sequence=False, indent=None):
+        self.f = f
+        self.image_prefix = image_prefix
+        self.sequence = sequence
+        self.indent = indent
+        self.count = 0
+
+        if indent is None:
+            self.separators = (',', ':')
+        else:
+            self.separators = (',', ': ')
+
+        if not sequence:
+            self.f.write(self.header)
+
+    def write(self, match):
+        feature = json.dumps(geojson_feature(match, self.image_prefix),
+                             indent=self.indent, separators=self.separators)
+
+        if self.sequence:
+            self.f.write(feature + '\n')
+        else:
+            self.f.write((self.count and ',\n' or '') + feature)
+
+        self.count += 1
+
+    def write_all(self, matches):
+        for match in matches:
+            self.write(match)
+
+    def checkpoint(self):
+        """Makes what was written so far a complete document, which the
+        next write continues. Only for files that can seek."""
+        if not self.sequence:
+            write_tail(self.f, self.tail)
+        self.f.flush()
+
+    def close(self):
+        if not self.sequence:
+            self.f.write(self.tail)
+        self.f.flush()
+
+
+class GPXWriter():
+    """Writes matches to the file object f as the waypoints of a GPX 1.0
+    document, one <wpt> per line, without building gpxpy objects. Each
+    waypoint is named after its (prefixed) content. Call close() to finish
+    the document."""
+
+    header = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<gpx xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+              'xmlns="http://www.topografix.com/GPX/1/0" version="1.0" '
+              'xsi:schemaLocation="http://www.topografix.com/GPX/1/0 '
+              'http://www.topografix.com/GPX/1/0/gpx.xsd" '
+              'creator="GpxImageLinkifier">\n')
+    tail = '</gpx>\n'
+
+    def __init__(self, f, image_prefix=''):
+        self.f = f
+        self.image_prefix = image_prefix
+        self.count = 0
+
+        self.f.write(self.header)
+
+    def write(self, match):
+        location = match["location"]
+        waypoint = '<wpt lat=%s lon=%s>' % (quoteattr(repr(location.latitude)),
+                                            quoteattr(repr(location.longitude)))
+
+        if location.elevation is not None:
+            waypoint += '<ele>%r</ele>' % location.elevation
+
+        name = escape(self.image_prefix + content_text(match["content"]))
+        if not isinstance(name, str):
+            # unicode on Python 2; the document is declared UTF-8
+            name = name.encode('utf-8')
+        self.f.write(waypoint + '<name>%s</name></wpt>\n' % name)
+
+        self.count += 1
+
+    def write_all(self, matches):
+        for match in matches:
+            self.write(match)
+
+    def checkpoint(self):
+        """Makes what was written so far a complete document, which the
+        next write continues. Only for files that can seek."""
+        write_tail(self.f, self.tail)
+        self.f.flush()
+
+    def close(self):
+        self.f.write(self.tail)
+        self.f.flush()
+
+
+def write_tail(f, tail):
+    """Writes the closing tail of a document to f, then seeks back to
+    before it so that whatever is written next replaces it."""
+    position = f.tell()
+    f.write(tail)
+    f.seek(position)
+
+
+def world_position(latitude, longitude):
+    """Returns the Web Mercator position of a point as (x, y), each from 0 to
+    1, with y growing southwards: the fraction of the zoom 0 tile it is
+    at."""
+    latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    sine = math.sin(math.radians(latitude))
+    return ((longitude + 180.0) / 360.0,
+            0.5 - math.log((1 + sine) / (1 - sine)) / (4 * math.pi))
+
+
+class TileWriter():
+    """Writes matches to the folder path as clusters per zoom level, for web
+    maps to fetch only the tiles in view: {z}/{x}/{y}.json files for each
+    Web Mercator tile (numbered like OpenStreetMap's) of zooms 0 to max_zoom
+    that has matches in it. The matches in each of the cells_per_side x
+    cells_per_side cells of a tile form one cluster, listed in the tile with
+    its count, mean position, and the content (and thumbnail) of its first
+    match to represent it.
+
+    Matches are added to their cluster at every zoom as they come and are
+    not kept. At most max_clusters clusters are held in memory: when there
+    are more, they are written to a temporary file, sorted, and the files
+    are merged when the tiles are written, so memory use does not grow with
+    the number of matches. Call close() to write the tiles, along with
+    tiles.json describing them."""
+
+    cells_per_side = 8
+    metadata_name = 'tiles.json'
+
+    def __init__(self, path, image_prefix='', max_zoom=16,
+                 max_clusters=100000):
+        self.path = path
+        self.image_prefix = image_prefix
+        self.max_zoom = max_zoom
+        self.max_clusters = max_clusters
+        self.count = 0
+        self.bounds = None
+        # {(zoom, cell x, cell y): [count, latitude sum, longitude sum,
+        # number of the first match, representative]}
+        self.clusters = {}
+        self.spills = []
+
+    def write(self, match):
+        location = match["location"]
+        latitude, longitude = location.latitude, location.longitude
+
+        x, y = world_position(latitude, longitude)
+        cells = self.cells_per_side << self.max_zoom
+        x = min(int(x * cells), cells - 1)
+        y = min(int(y * cells), cells - 1)
+
+        clusters = self.clusters
+        representative = None
+        for zoom in range(self.max_zoom, -1, -1):
+            cluster = clusters.get((zoom, x, y))
+            if cluster is None:
+                if representative is None:
+                    representative = {
+                        "content": self.image_prefix + content_text(
+                            match["content"])}
+                    if match.get("thumbnail") is not None:
+                        representative["thumbnail"] = match["thumbnail"]
+                clusters[(zoom, x, y)] = [1, latitude, longitude, self.count,
+                                          representative]
+            else:
+                cluster[0] += 1
+                cluster[1] += latitude
+                cluster[2] += longitude
+            x >>= 1
+            y >>= 1
+
+        if self.bounds is None:
+            self.bounds = [longitude, latitude, longitude, latitude]
+        else:
+            bounds = self.bounds
+            bounds[0] = min(bounds[0], longitude)
+            bounds[1] = min(bounds[1], latitude)
+            bounds[2] = max(bounds[2], longitude)
+            bounds[3] = max(bounds[3], latitude)
+
+        self.count += 1
+        if len(clusters) >= self.max_clusters:
+            self.spill()
+
+    def write_all(self, matches):
+        for match in matches:
+            self.write(match)
+
+    def sorted_clusters(self):
+        """Returns the clusters in memory as [zoom, tile x, tile y, cell x,
+        cell y, count, latitude sum, longitude sum, first match number,
+        representative] lists, sorted so that the cells of each tile are
+        together, and forgets them."""
+        shift = self.cells_per_side.bit_length() - 1
+        clusters = sorted([zoom, x >> shift, y >> shift, x, y] + cluster
+                          for (zoom, x, y), cluster in self.clusters.items())
+        self.clusters = {}
+        return clusters
+
+    def spill(self):
+        """Moves the clusters in memory to a temporary file, one JSON list
+        per line, in sorted order."""
+        f = tempfile.TemporaryFile('w+')
+        for cluster in self.sorted_clusters():
+            f.write(json.dumps(cluster, separators=(',', ':')) + '\n')
+        f.seek(0)
+        self.spills.append(f)
+
+    def merged_clusters(self):
+        """Yields the clusters of the temporary files and memory, sorted as
+        sorted_clusters sorts them, combining the parts of each cluster."""
+        streams = [(json.loads(line) for line in f) for f in self.spills]
+        streams.append(iter(self.sorted_clusters()))
+
+        cluster = None
+        for key, number, part in heapq.merge(
+                *[numbered_clusters(stream, number)
+                  for number, stream in enumerate(streams)]):
+            if cluster is not None and key == cluster[:5]:
+                cluster[5] += part[5]
+                cluster[6] += part[6]
+                cluster[7] += part[7]
+                if part[8] < cluster[8]:
+                    cluster[8:] = part[8:]
+                continue
+
+            if cluster is not None:
+                yield cluster
+            cluster = part
+
+        if cluster is not None:
+            yield cluster
+
+    def close(self):
+        self.remove_tiles()
+
+        tiles = 0
+        tile = None
+        tile_clusters = []
+        try:
+            for cluster in itertools.chain(self.merged_clusters(), [None]):
+                if tile_clusters and (
+                        cluster is None or cluster[:3] != tile):
+                    self.write_tile(tile, tile_clusters)
+                    tiles += 1
+                    tile_clusters = []
+                if cluster is None:
+                    break
+
+                tile = cluster[:3]
+                count = cluster[5]
+                summary = {
+                    "latitude": round(cluster[6] / count, 7),
+                    "longitude": round(cluster[7] / count, 7),
+                    "count": count,
+                }
+                summary.update(cluster[9])
+                tile_clusters.append(summary)
+        finally:
+            for f in self.spills:
+                f.close()
+            self.spills = []
+
+        with open(os.path.join(self.path, self.metadata_name), 'w') as f:
+            json.dump({
+                "count": self.count,
+                "bounds": self.bounds,
+                "min_zoom": 0,
+                "max_zoom": self.max_zoom,
+                "tiles": tiles,
+                "template": "{z}/{x}/{y}.json",
+            }, f, indent=4, sort_keys=True, separators=(',', ': '))
+
+    def write_tile(self, tile, clusters):
+        zoom, x, y = tile
+        folder = os.path.join(self.path, str(zoom), str(x))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, '%d.json' % y), 'w') as f:
+            json.dump({"clusters": clusters}, f, separators=(',', ':'),
+                      sort_keys=True)
+
+    def remove_tiles(self):
+        """Creates the folder, or removes the zoom folders of the tiles an
+        earlier TileWriter wrote to it, so no tile is left over from it."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+            return
+
+        metadata_path = os.path.join(self.path, self.metadata_name)
+        if not os.path.isfile(metadata_path):
+            return
+
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        for zoom in range(metadata["min_zoom"], metadata["max_zoom"] + 1):
+            folder = os.path.join(self.path, str(zoom))
+            if os.path.isdir(folder):
+                shutil.rmtree(folder)
+        os.remove(metadata_path)
+
+
+def numbered_clusters(clusters, number):
+    """Yields (sort key, number, cluster) for clusters from merged_clusters'
+    stream number, so that heapq.merge never compares clusters themselves."""
+    for cluster in clusters:
+        yield cluster[:5], number, cluster
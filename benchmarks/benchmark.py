@@ -0,0 +1,371 @@
+"""Times each stage of GpxImageLinkifier on synthetic GPX files and EXIF-only
+JPEGs, and prints the results as JSON so runs of different versions can be
+compared. Run it from a checkout:
+
+    python benchmarks/benchmark.py --points 100000 --images 2000
+
+Every stage is run --repeat times and the fastest run is reported."""
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from GpxImageLinkifier import GIL  # noqa: E402
+from GpxImageLinkifier import index  # noqa: E402
+
+GPX_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="GpxImageLinkifier benchmark" xmlns="http://www.topografix.com/GPX/1/1">
+'''
+
+EXIF_DATETIME_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+
+def gpx_time(ts):
+    # GPX times are read in the GPX timezone, so they are written naive.
+    return ts.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def write_gpx(path, start, points, segments, waypoints, interval, rng):
+    """Writes a GPX file with one track of points spread over segments, every
+    interval seconds from the naive datetime start, and waypoints at random
+    times along it. Returns the time of the last point."""
+    latitude, longitude = 46.78, -121.73
+    per_segment = max(1, points // max(1, segments))
+    ts = start
+
+    with open(path, 'w') as f:
+        f.write(GPX_HEADER)
+
+        for i in range(waypoints):
+            waypoint_ts = start + datetime.timedelta(
+                seconds=rng.uniform(0, points * interval))
+            f.write('<wpt lat="%.6f" lon="%.6f"><ele>1500.0</ele>'
+                    '<time>%s</time><name>waypoint %d</name></wpt>\n' % (
+                        latitude, longitude, gpx_time(waypoint_ts), i))
+
+        f.write('<trk><name>benchmark</name>\n<trkseg>\n')
+        for i in range(points):
+            if i and i % per_segment == 0:
+                f.write('</trkseg>\n<trkseg>\n')
+            latitude += rng.uniform(-1, 1) * 1e-5
+            longitude += rng.uniform(-1, 1) * 1e-5
+            f.write('<trkpt lat="%.6f" lon="%.6f"><ele>%.1f</ele>'
+                    '<time>%s</time></trkpt>\n' % (
+                        latitude, longitude, 1500 + i % 100, gpx_time(ts)))
+            ts += datetime.timedelta(seconds=interval)
+        f.write('</trkseg>\n</trk>\n</gpx>\n')
+
+    return ts
+
+
+def exif_jpeg(ts):
+    """Returns a JPEG with nothing but an APP1 segment holding the naive
+    datetime ts as its EXIF DateTime and DateTimeOriginal."""
+    text = ts.strftime(EXIF_DATETIME_FORMAT).encode('ascii') + b'\x00'
+
+    # IFD0 at 8 holds DateTime and the EXIF IFD pointer; the EXIF IFD at 38
+    # holds DateTimeOriginal; the strings follow at 56 and 76.
+    tiff = b'II*\x00' + struct.pack('<I', 8)
+    tiff += struct.pack('<H', 2)
+    tiff += struct.pack('<HHII', 0x0132, 2, len(text), 56)
+    tiff += struct.pack('<HHII', 0x8769, 4, 1, 38)
+    tiff += struct.pack('<I', 0)
+    tiff += struct.pack('<H', 1)
+    tiff += struct.pack('<HHII', 0x9003, 2, len(text), 76)
+    tiff += struct.pack('<I', 0)
+    tiff += text + text
+
+    payload = b'Exif\x00\x00' + tiff
+    return (b'\xff\xd8\xff\xe1' + struct.pack('>H', len(payload) + 2) +
+            payload + b'\xff\xd9')
+
+
+def image_times(start, end, count, distribution, rng):
+    """Returns count naive datetimes between start and end, either spread
+    uniformly or in bursts of up to 30 shots a few seconds apart."""
+    span = (end - start).total_seconds()
+
+    if distribution == 'uniform':
+        offsets = [rng.uniform(0, span) for i in range(count)]
+    else:
+        offsets = []
+        while len(offsets) < count:
+            burst = rng.uniform(0, span)
+            for i in range(min(rng.randint(1, 30), count - len(offsets))):
+                offsets.append(min(span, burst + i * rng.uniform(0.5, 5)))
+
+    return [start + datetime.timedelta(seconds=int(offset))
+            for offset in sorted(offsets)]
+
+
+def make_corpus(directory, args):
+    """Generates args.datasets GPX files, one after the other in time, and
+    args.images JPEGs timed along them. Returns (gpx paths, image folder,
+    image timestamps, list item timestamps)."""
+    rng = random.Random(args.seed)
+    start = datetime.datetime(2013, 6, 29, 8, 0, 0)
+    gpx_paths = []
+    ts = start
+
+    for i in range(args.datasets):
+        path = os.path.join(directory, 'track-%d.gpx' % i)
+        ts = write_gpx(path, ts, args.points, args.segments, args.waypoints,
+                       args.interval, rng)
+        gpx_paths.append(path)
+
+    image_folder = os.path.join(directory, 'images')
+    if os.path.isdir(image_folder):
+        shutil.rmtree(image_folder)
+    os.mkdir(image_folder)
+    timestamps = image_times(start, ts, args.images, args.distribution, rng)
+
+    for i, image_ts in enumerate(timestamps):
+        with open(os.path.join(image_folder, 'IMG_%06d.jpg' % i), 'wb') as f:
+            f.write(exif_jpeg(image_ts))
+
+    if args.items is None:
+        items = timestamps
+    else:
+        items = image_times(start, ts, args.items, args.distribution, rng)
+
+    return gpx_paths, image_folder, timestamps, items
+
+
+class NullFile():
+    """A file object that only counts what is written to it."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+
+def measure(repeat, setup, run):
+    """Returns the fastest of repeat timings of run(setup()), and what the
+    last run returned."""
+    best = None
+    for i in range(repeat):
+        state = setup()
+        started = timer()
+        result = run(state)
+        elapsed = timer() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_benchmarks(args, directory):
+    started = timer()
+    gpx_paths, image_folder, timestamps, items = make_corpus(directory, args)
+    image_paths = sorted(os.path.join(image_folder, name)
+                         for name in os.listdir(image_folder))
+    corpus_seconds = timer() - started
+
+    options = dict(tz_gpx=args.tz, tz_images=args.tz, accuracy=args.accuracy,
+                   workers=args.jobs, interpolate=args.interpolate)
+    points = args.datasets * args.points
+    # stages are reported in the order they run
+    stages = collections.OrderedDict()
+
+    def record(name, seconds, count):
+        stages[name] = {
+            'seconds': round(seconds, 6),
+            'count': count,
+            'per_second': round(count / seconds, 1) if seconds else None,
+        }
+
+    def load(compact, cache_dir=None):
+        gil = GIL(compact=compact, cache_dir=cache_dir, **options)
+        for path in gpx_paths:
+            gil.add_gpx_data(path)
+        return gil
+
+    seconds, gil = measure(args.repeat, lambda: None,
+                           lambda state: load(False))
+    record('add_gpx_data', seconds, points)
+
+    seconds, compact_gil = measure(args.repeat, lambda: None,
+                                   lambda state: load(True))
+    record('add_gpx_data_compact', seconds, points)
+
+    cache_dir = os.path.join(directory, 'cache')
+    load(True, cache_dir)
+    seconds, cached_gil = measure(args.repeat, lambda: None,
+                                  lambda state: load(True, cache_dir))
+    record('add_gpx_data_cached', seconds, points)
+
+    seconds, result = measure(
+        args.repeat, lambda: None,
+        lambda state: [gil.get_image_timestamp(path) for path in image_paths])
+    record('get_image_timestamp', seconds, len(image_paths))
+
+    localized = [gil.localize_image_timestamp(ts) for ts in timestamps]
+    seconds, result = measure(
+        args.repeat, lambda: None,
+        lambda state: [gil.find_timestamp_gpx_match(
+            ts, accuracyDelta=gil.accuracy) for ts in localized])
+    record('find_timestamp_gpx_match', seconds, len(localized))
+
+    content = [{'timestamp': ts} for ts in items]
+    seconds, matches = measure(args.repeat, lambda: None,
+                               lambda state: gil.find_matches(content))
+    record('find_matches', seconds, len(content))
+
+    seconds, result = measure(args.repeat, lambda: None,
+                              lambda state: compact_gil.find_matches(content))
+    record('find_matches_compact', seconds, len(content))
+
+    seconds, result = measure(
+        args.repeat, lambda: None,
+        lambda state: compact_gil.find_matches(image_folder))
+    record('find_matches_folder', seconds, len(image_paths))
+
+    seconds, result = measure(args.repeat, lambda: None,
+                              lambda state: gil.to_geojson())
+    record('to_geojson', seconds, len(matches))
+
+    def to_xml(state):
+        gil.matches_gpxpy = None
+        return gil.to_xml()
+
+    seconds, result = measure(args.repeat, lambda: None, to_xml)
+    record('to_xml', seconds, len(matches))
+
+    seconds, result = measure(
+        args.repeat, NullFile,
+        lambda f: compact_gil.write_geojson(iter(matches), f))
+    record('write_geojson', seconds, len(matches))
+
+    seconds, result = measure(args.repeat, NullFile,
+                              lambda f: compact_gil.write_gpx(iter(matches), f))
+    record('write_gpx', seconds, len(matches))
+
+    return collections.OrderedDict([
+        ('benchmark', 'GpxImageLinkifier'),
+        ('version', package_version()),
+        ('commit', git_commit()),
+        ('python', platform.python_version()),
+        ('numpy', index.load_numpy() is not None),
+        ('parameters', collections.OrderedDict(
+            (key, value) for key, value in sorted(vars(args).items())
+            if key not in ('output', 'keep'))),
+        ('corpus', collections.OrderedDict([
+            ('points', points),
+            ('images', len(image_paths)),
+            ('items', len(content)),
+            ('matches', len(matches)),
+            ('seconds', round(corpus_seconds, 6)),
+        ])),
+        ('stages', stages),
+    ])
+
+
+def package_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('GpxImageLinkifier').version
+    except Exception:
+        return None
+
+
+def git_commit():
+    """Returns the commit of the checkout being benchmarked, if it is one."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='''Times each stage of GpxImageLinkifier on a synthetic
+corpus and prints the results as JSON.''')
+
+    parser.add_argument('--points', type=int, default=20000,
+                        help='Track points per GPX file. Defaults to 20000.')
+    parser.add_argument('--segments', type=int, default=4,
+                        help='Track segments per GPX file. Defaults to 4.')
+    parser.add_argument('--waypoints', type=int, default=10,
+                        help='Waypoints per GPX file. Defaults to 10.')
+    parser.add_argument('--datasets', type=int, default=1,
+                        help='''Number of GPX files, one after the other in
+time. Defaults to 1.''')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='Seconds between track points. Defaults to 1.')
+    parser.add_argument('--tz', type=str, default='UTC',
+                        help='''Timezone of the GPX and image timestamps.
+Defaults to UTC.''')
+    parser.add_argument('--images', type=int, default=500,
+                        help='Number of JPEGs. Defaults to 500.')
+    parser.add_argument('--items', type=int,
+                        help='''Number of list items find_matches matches,
+timed like the images. Defaults to --images.''')
+    parser.add_argument('--distribution', type=str, default='uniform',
+                        choices=['uniform', 'bursts'],
+                        help='''How image timestamps are spread over the
+tracks: uniformly, or in bursts of shots a few seconds apart. Defaults to
+uniform.''')
+    parser.add_argument('--accuracy', type=str, default='1m',
+                        help='The accuracy to match with. Defaults to 1m.')
+    parser.add_argument('--interpolate', action='store_true',
+                        help='Match with interpolation.')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Images to read at once. Defaults to 1.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='''Runs of each stage; the fastest is reported.
+Defaults to 3.''')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed of the corpus. Defaults to 0.')
+    parser.add_argument('--output', '-o', type=str,
+                        help='Write the JSON results here instead of stdout.')
+    parser.add_argument('--keep', type=str,
+                        help='''Generate the corpus in this directory and
+keep it, instead of a temporary one.''')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    if args.keep:
+        directory = args.keep
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    else:
+        directory = tempfile.mkdtemp()
+
+    try:
+        results = run_benchmarks(args, directory)
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory)
+
+    output = json.dumps(results, indent=4, separators=(',', ': '))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
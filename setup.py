@@ -18,6 +18,9 @@ setup(
         "lxml==3.2.1",
         "pytz"
     ],
+    extras_require={
+        'numpy': ["numpy"],
+    },
     entry_points={
         'console_scripts': [
             'gil = GpxImageLinkifier.gil:main',